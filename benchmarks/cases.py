@@ -0,0 +1,137 @@
+import itertools
+
+from airnow import AirNowFetcher
+from cache import TTLCache
+from clock import VirtualClock
+from datetime import date, datetime, timedelta
+from eventplan import EventPlanner
+from fakes import FakeAirNowAPI, FakeScheduler, createObservations
+from location import Location
+from solartable import SolarTimeTable
+from statestore import MemoryStateBackend, StateStore
+from tasks.airquality import AirQualityTask
+from tasks.lunartime import LunarTimeTask
+from tasks.solartime import SolarTimeTask
+from typing import Callable, List
+from util import tupleToDateTime
+
+
+class Benchmark(object):
+    """
+    A named piece of work to time. The setup runs once before every repeat
+    and returns the callable that is timed; it is called `number` times.
+    """
+
+    def __init__(self, name: str, setup: Callable[[], Callable[[], object]], number: int):
+        self.name = name
+        self.setup = setup
+        self.number = number
+
+
+LOCATION = Location("chicago", "Chicago", "Illinois", "America/Chicago", 41.88, -87.63)
+# A fixed moment, so every run computes the same ephemeris
+AS_OF = LOCATION.getTimeZone().localize(datetime(2023, 6, 1, 21, 30))
+DAYS = [date(2023, 1, 1) + timedelta(days=i) for i in range(365)]
+# More locations than the tasks a virtual scheduler would once run at a single instant
+PLAN_LOCATIONS = [Location("plan-{}".format(i), "Plan {}".format(i), "Illinois", "America/Chicago", 25.0 + i * 0.4, -120.0 + i * 0.8)
+                  for i in range(60)]
+
+
+def createBenchmarks() -> List[Benchmark]:
+    """
+    Build every benchmark. Requires the application root to point at a
+    scratch directory, because the state benchmarks write files.
+
+    Returns:
+        Benchmark[]: The benchmarks, in the order they run
+    """
+
+    store = StateStore()
+    # The ephemeris cache keeps the days around the clock of the task
+    lunar_task = LunarTimeTask(FakeScheduler(VirtualClock(AS_OF.timestamp())), LOCATION, store)
+    lunar_task._setup()
+    lunar_task.now = AS_OF
+    solar_task = SolarTimeTask(FakeScheduler(), LOCATION, store)
+    solar_task._setup()
+    solar_table = SolarTimeTable([LOCATION])
+    table_task = SolarTimeTask(FakeScheduler(), LOCATION, store, solar_table)
+    table_task._setup()
+    observations = createObservations(10000)
+    fetcher = AirNowFetcher("benchmark", AirQualityTask.EXECUTION_INTERVAL_SECONDS)
+    fetcher._api = FakeAirNowAPI(observations[:3])
+    air_task = AirQualityTask(FakeScheduler(), LOCATION, store, fetcher)
+    air_task._setup()
+
+    lunar_time = lunar_task._getLunarTimeCurrent()
+    solar_time = solar_task._getSolarTime(AS_OF.date())
+    prior_observation, current_observation = observations[0], _firstOfOtherCategory(observations)
+
+    def coldLunar(method: Callable[[datetime], object]) -> Callable[[], Callable[[], object]]:
+        # Each call asks for another day with an empty ephemeris cache, like the first run of the day
+        def setup():
+            LunarTimeTask._EPHEMERIS_CACHE = TTLCache(4096)
+            days = itertools.cycle(AS_OF + timedelta(days=i) for i in range(30))
+            return lambda: method(next(days))
+        return setup
+
+    def warmLunar():
+        lunar_task._getLunarTime(AS_OF, True)
+        return lambda: lunar_task._getLunarTime(AS_OF, True)
+
+    def astralSun():
+        days = itertools.cycle(DAYS)
+        return lambda: solar_task._getSolarTime(next(days))
+
+    def tableLookup():
+        solar_table.getYear(2023)
+        days = itertools.cycle(DAYS)
+        return lambda: table_task._getSolarTime(next(days))
+
+    def stateLoad():
+        store.save("lunartime", LOCATION.key, lunar_time, lunar_task._dumpConverter)
+        store.flush()
+        return lambda: StateStore().load("lunartime", LOCATION.key)
+
+    def stateSaveAndFlush():
+        def run():
+            store.save("lunartime", LOCATION.key, lunar_time, lunar_task._dumpConverter)
+            store.flush()
+        return run
+
+    def tweetSolar():
+        solar_task.today = AS_OF.date()
+        return lambda: solar_task._tweetSolarTime(solar_time)
+
+    def planDay():
+        planner = EventPlanner(FakeScheduler(),
+                               StateStore(backend=MemoryStateBackend()),
+                               lambda: PLAN_LOCATIONS,
+                               solarTable=SolarTimeTable(PLAN_LOCATIONS))
+
+        # Each repeat computes the moon times again, like the planning of another day
+        LunarTimeTask._EPHEMERIS_CACHE = TTLCache(4096)
+        return lambda: planner._plan(PLAN_LOCATIONS, AS_OF.timestamp())
+
+    tzone = LOCATION.getTimeZone()
+    return [
+        Benchmark("lunartime.getLunarTime.cold", coldLunar(lambda asOf: lunar_task._getLunarTime(asOf, True)), 30),
+        Benchmark("lunartime.getLunarTime.warm", warmLunar, 400),
+        Benchmark("lunartime.getLunarTimeYesterday.cold", coldLunar(lunar_task._getLunarTimeYesterday), 30),
+        Benchmark("lunartime.getLunarTimeTomorrow.cold", coldLunar(lunar_task._getLunarTimeTomorrow), 30),
+        Benchmark("solartime.astralSun", astralSun, 1460),
+        Benchmark("solartime.tableLookup", tableLookup, 3650),
+        Benchmark("airquality.getPrimaryObservation.10k", lambda: lambda: air_task._getPrimaryObservation(observations), 50),
+        Benchmark("airquality.run.cached", lambda: air_task._run, 5000),
+        Benchmark("statestore.save", lambda: lambda: store.save("lunartime", LOCATION.key, lunar_time, lunar_task._dumpConverter), 5000),
+        Benchmark("statestore.saveAndFlush", stateSaveAndFlush, 50),
+        Benchmark("statestore.loadFromDisk", stateLoad, 2000),
+        Benchmark("util.tupleToDateTime", lambda: lambda: tupleToDateTime((2023, 6, 1, 21, 30, 15), tzone), 20000),
+        Benchmark("message.solartime", tweetSolar, 5000),
+        Benchmark("message.lunartime", lambda: lambda: lunar_task._tweetLunarTime(lunar_time), 5000),
+        Benchmark("message.airquality", lambda: lambda: air_task._tweetAirQuality(prior_observation, current_observation), 5000),
+        Benchmark("eventplan.plan.60locations", planDay, 1),
+    ]
+
+
+def _firstOfOtherCategory(observations):
+    return next(obs for obs in observations if obs.category != observations[0].category)
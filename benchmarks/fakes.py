@@ -0,0 +1,107 @@
+import random
+
+from airnowpy import Category, Observation
+from clock import SystemClock
+from datetime import datetime, timedelta
+from pytz import timezone
+from typing import List
+
+
+class FakeScheduler(object):
+    """
+    Accepts the jobs of the tasks without ever running them, so a benchmark
+    can drive a task's steps itself.
+    """
+
+    def __init__(self, clock=None):
+        self.jobs = list()
+        self._clock = SystemClock() if clock is None else clock
+
+
+    def getClock(self):
+        return self._clock
+
+
+    def schedule(self, name: str, step, delaySeconds: float = 0, labels: dict = None):
+        self.jobs.append((name, step, delaySeconds))
+
+
+class FakeResponse(object):
+
+    def __init__(self, headers: dict):
+        self.headers = headers
+
+
+class FakeTwitterClient(object):
+    """
+    Stands in for the tweepy Client, recording tweets instead of sending them.
+    """
+
+    def __init__(self):
+        self.tweets = list()
+        self.session = self
+
+
+    def create_tweet(self, text: str) -> FakeResponse:
+        self.tweets.append(text)
+        return FakeResponse({"x-rate-limit-remaining": "199", "x-rate-limit-reset": "0"})
+
+
+    def close(self) -> None:
+        pass
+
+
+class FakeAirNowAPI(object):
+    """
+    Stands in for the airnowpy API, answering every request with the same
+    observations.
+    """
+
+    def __init__(self, observations: List[Observation]):
+        self.observations = observations
+        self.requests = 0
+
+
+    def getCurrentObservationByLatLon(self, latitude: float, longitude: float) -> List[Observation]:
+        self.requests += 1
+        return self.observations
+
+
+def createObservations(count: int, seed: int = 0) -> List[Observation]:
+    """
+    Build a fixed list of observations; the same count and seed always give the same list.
+
+    Parameters:
+        count (int): The number of observations
+        seed (int): Seeds the random AQI values and parameters
+
+    Returns:
+        Observation[]: The observations
+    """
+
+    rng = random.Random(seed)
+    timestamp = timezone("Etc/GMT+6").localize(datetime(2023, 6, 1, 12))
+    parameters = ("O3", "PM2.5", "PM10")
+    observations = list()
+    for i in range(count):
+        aqi_value = rng.randint(0, 300)
+        observations.append(Observation(timestamp - timedelta(hours=i % 24),
+                                        "Chicago",
+                                        "IL",
+                                        41.88,
+                                        -87.63,
+                                        parameters[rng.randrange(len(parameters))],
+                                        aqi_value,
+                                        _categoryOf(aqi_value)))
+    return observations
+
+
+def _categoryOf(aqiValue: int) -> Category:
+    for upper, category in ((50, Category.GOOD),
+                            (100, Category.MODERATE),
+                            (150, Category.UNHEALTHY_FOR_SENSITIVE_GROUPS),
+                            (200, Category.UNHEALTHY),
+                            (300, Category.VERY_UNHEALTHY)):
+        if (aqiValue <= upper):
+            return category
+    return Category.HAZARDOUS
@@ -0,0 +1,153 @@
+"""
+Times the hot paths of the tasks against fixed inputs, fully offline, and
+compares the results with a stored baseline.
+
+    python benchmarks/run.py                   # run and compare with the baseline
+    python benchmarks/run.py --save-baseline   # run and store the results as the new baseline
+    python benchmarks/run.py --filter lunar    # only the benchmarks whose name contains "lunar"
+"""
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARKS_DIR.parent.joinpath("src")))
+sys.path.insert(0, str(BENCHMARKS_DIR))
+
+import util
+
+from config import Config, setConfig
+from fakes import FakeTwitterClient
+from twitter import TwitterUtil
+
+
+BASELINE_FILE = BENCHMARKS_DIR.joinpath("baseline.json")
+DEFAULT_REPEAT = 7
+DEFAULT_TOLERANCE = 0.5
+
+
+def configureOffline(appRootDir: Path) -> FakeTwitterClient:
+    """
+    Point the application at a scratch directory and replace the Twitter
+    client with a fake, so nothing leaves the machine.
+
+    Parameters:
+        appRootDir (Path): The scratch application root directory
+
+    Returns:
+        FakeTwitterClient: The client that receives every tweet
+    """
+
+    util.globalAppRootDir = appRootDir
+    setConfig(Config(twitterCredentials=("benchmark",) * 5))
+
+    client = FakeTwitterClient()
+    TwitterUtil.createTwitterAPI = staticmethod(lambda credentials=None: client)
+    # Timings should not include writing log records
+    logging.getLogger().setLevel(logging.CRITICAL)
+    return client
+
+
+def runBenchmark(benchmark, repeat: int) -> dict:
+    timings = list()
+    for _ in range(repeat):
+        step = benchmark.setup()
+        # Like timeit, keep garbage collection pauses out of the measurement
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for _ in range(benchmark.number):
+                step()
+            timings.append((time.perf_counter() - start) / benchmark.number)
+        finally:
+            gc.enable()
+    return {
+        "best": min(timings),
+        "median": statistics.median(timings),
+        "number": benchmark.number,
+        "repeat": repeat
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Find the benchmarks that became slower than the baseline allows.
+
+    Parameters:
+        results (dict): The best time per call of each benchmark
+        baseline (dict): The stored best time per call of each benchmark
+        tolerance (float): The allowed slow down, 0.5 allows 50% slower
+
+    Returns:
+        list: The names of the benchmarks that regressed
+    """
+
+    regressions = list()
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if (expected is not None and result["best"] > expected["best"] * (1 + tolerance)):
+            regressions.append(name)
+    return regressions
+
+
+def formatMicros(seconds: float) -> str:
+    return "{:12.2f} us".format(seconds * 1000000)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run the benchmark suite")
+    parser.add_argument('--filter', default="", help='only run benchmarks whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='timed repeats of each benchmark')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed slow down before failing')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_FILE, help='path to the baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    baseline = dict()
+    if (args.baseline.exists()):
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)["results"]
+
+    with tempfile.TemporaryDirectory() as app_root:
+        configureOffline(Path(app_root))
+        from cases import createBenchmarks
+
+        results = dict()
+        print("{:40} {:>15} {:>15} {:>10}".format("benchmark", "best", "median", "baseline"))
+        for benchmark in createBenchmarks():
+            if (args.filter not in benchmark.name):
+                continue
+            result = runBenchmark(benchmark, args.repeat)
+            results[benchmark.name] = result
+
+            expected = baseline.get(benchmark.name)
+            ratio = "" if expected is None else "{:9.2f}x".format(result["best"] / expected["best"])
+            print("{:40} {} {} {:>10}".format(benchmark.name, formatMicros(result["best"]), formatMicros(result["median"]), ratio))
+
+    if (args.save_baseline):
+        if (args.filter):
+            results = {**baseline, **results}
+        with open(args.baseline, 'w') as fw:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, fw, indent=2, sort_keys=True)
+            fw.write("\n")
+        print("Saved the baseline to " + str(args.baseline))
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for name in regressions:
+        print("REGRESSION: " + name + " is slower than the baseline allows")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Runs the air quality task for thousands of synthetic locations against local
+stand-in servers for the AirNow and Twitter APIs, and reports the request
+rate, latencies and tweet deliveries. Nothing leaves the machine.
+
+    python loadtest/run.py                                   # 2000 locations for 60 seconds
+    python loadtest/run.py --locations 5000 --duration 120
+    python loadtest/run.py --airnow-error-rate 0.2           # see the circuit breaker at work
+    python loadtest/run.py --twitter-rate-limit 100          # see the outbox follow the rate limit
+"""
+
+import argparse
+import logging
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+from typing import Callable, Hashable, List
+
+LOADTEST_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(LOADTEST_DIR.parent.joinpath("src")))
+sys.path.insert(0, str(LOADTEST_DIR))
+
+import util
+
+from airnow import AirNowFetcher
+from config import Config, setConfig
+from location import Location
+from scheduler import Scheduler
+from servers import FakeAirNowServer, FakeTwitterServer
+from statestore import MemoryStateBackend, StateStore
+from tasks.airquality import AirQualityTask
+from twitter import TwitterUtil
+
+
+# Roughly the contiguous United States, whose time zones AirNow reports in
+LATITUDES = (25.0, 49.0)
+LONGITUDES = (-124.0, -67.0)
+TIMEZONES = ("America/New_York", "America/Chicago", "America/Denver", "America/Los_Angeles")
+
+
+class FixedPollingPolicy(object):
+    """
+    Polls every reporting area at a fixed interval, so that a short run makes
+    as many requests as a long one would.
+    """
+
+    def __init__(self, intervalSeconds: float):
+        self._interval_seconds = intervalSeconds
+
+
+    def recordArrival(self, key: Hashable, arrivedAt: float) -> None:
+        pass
+
+
+    def recordUnchanged(self, key: Hashable) -> None:
+        pass
+
+
+    def getNextPollDelay(self, key: Hashable, now: float, lastArrival: float, aqiValue: int) -> float:
+        return self._interval_seconds
+
+
+class LatencyRecorder(object):
+    """
+    Times the calls of functions, counting the ones that raised.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: List[float] = list()
+        self.failures = 0
+
+
+    def wrap(self, function: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                raise
+            finally:
+                with self._lock:
+                    self.latencies.append(time.perf_counter() - start)
+        return timed
+
+
+    def summarize(self, name: str, durationSeconds: float) -> str:
+        with self._lock:
+            latencies = sorted(self.latencies)
+            failures = self.failures
+        if (not latencies):
+            return "{:<8} no calls".format(name)
+        return "{:<8} {:7d} calls {:8.1f}/s  p50 {:8.1f} ms  p99 {:8.1f} ms  {} failed".format(
+            name,
+            len(latencies),
+            len(latencies) / durationSeconds,
+            _percentile(latencies, 50) * 1000,
+            _percentile(latencies, 99) * 1000,
+            failures)
+
+
+def _percentile(sortedValues: List[float], percent: float) -> float:
+    if (len(sortedValues) == 1):
+        return sortedValues[0]
+    return statistics.quantiles(sortedValues, n=100, method="inclusive")[min(98, max(0, int(percent) - 1))]
+
+
+def createLocations(count: int, seed: int) -> List[Location]:
+    """
+    Scatter locations over the contiguous United States.
+
+    Parameters:
+        count (int): The number of locations
+        seed (int): Seeds the coordinates; the same count and seed always give the same locations
+
+    Returns:
+        Location[]: The locations
+    """
+
+    generator = random.Random(seed)
+    return [Location("load-{}".format(i),
+                     "Load {}".format(i),
+                     "ZZ",
+                     generator.choice(TIMEZONES),
+                     round(generator.uniform(*LATITUDES), 4),
+                     round(generator.uniform(*LONGITUDES), 4))
+            for i in range(count)]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test the air quality task against local stand-in APIs")
+    parser.add_argument("--locations", type=int, default=2000, help="Number of synthetic locations (Default = 2000)")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run for (Default = 60)")
+    parser.add_argument("--workers", type=int, default=8, help="Scheduler worker threads (Default = 8)")
+    parser.add_argument("--poll-seconds", type=float, default=5, help="Seconds between polls of a reporting area (Default = 5)")
+    parser.add_argument("--hour-seconds", type=float, default=10, help="Seconds in which the fake observations advance an hour (Default = 10)")
+    parser.add_argument("--area-degrees", type=float, default=1.0, help="Width of a fake reporting area in degrees (Default = 1.0)")
+    parser.add_argument("--airnow-latency-ms", type=float, default=50, help="Mean AirNow latency (Default = 50)")
+    parser.add_argument("--airnow-error-rate", type=float, default=0.01, help="Share of AirNow requests that fail (Default = 0.01)")
+    parser.add_argument("--airnow-rate-limit", type=int, default=None, help="AirNow requests allowed per window (Default = unlimited)")
+    parser.add_argument("--airnow-hedge-percentile", type=float, default=None, help="Hedge AirNow requests slower than this percentile (Default = never)")
+    parser.add_argument("--twitter-latency-ms", type=float, default=100, help="Mean Twitter latency (Default = 100)")
+    parser.add_argument("--twitter-error-rate", type=float, default=0.01, help="Share of tweets that fail (Default = 0.01)")
+    parser.add_argument("--twitter-rate-limit", type=int, default=3000, help="Tweets allowed per window (Default = 3000)")
+    parser.add_argument("--outbox-concurrency", type=int, default=4, help="Tweets delivered at once (Default = 4)")
+    parser.add_argument("--rate-limit-window", type=float, default=60, help="Seconds in a rate-limit window (Default = 60)")
+    parser.add_argument("--seed", type=int, default=0, help="Seeds the locations and the fake servers (Default = 0)")
+    parser.add_argument("--verbose", action="store_true", help="Log warnings and errors to stderr")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING if args.verbose else logging.CRITICAL)
+
+    airnow_server = FakeAirNowServer(hourSeconds=args.hour_seconds,
+                                     areaDegrees=args.area_degrees,
+                                     latencySeconds=args.airnow_latency_ms / 1000,
+                                     errorRate=args.airnow_error_rate,
+                                     rateLimit=args.airnow_rate_limit,
+                                     rateLimitWindowSeconds=args.rate_limit_window,
+                                     seed=args.seed)
+    twitter_server = FakeTwitterServer(latencySeconds=args.twitter_latency_ms / 1000,
+                                       errorRate=args.twitter_error_rate,
+                                       rateLimit=args.twitter_rate_limit,
+                                       rateLimitWindowSeconds=args.rate_limit_window,
+                                       seed=args.seed)
+    airnow_server.start()
+    twitter_server.start()
+
+    locations = createLocations(args.locations, args.seed)
+    with tempfile.TemporaryDirectory() as app_root_dir:
+        util.globalAppRootDir = Path(app_root_dir)
+        setConfig(Config(locations=tuple(locations),
+                         enabledTasks=("airquality",),
+                         twitterCredentials=("loadtest",) * 5,
+                         airNowApiKey="loadtest",
+                         twitterApiUrl=twitter_server.getUrl()))
+
+        fetcher = AirNowFetcher("loadtest",
+                                args.poll_seconds,
+                                pollingPolicy=FixedPollingPolicy(args.poll_seconds),
+                                hedgePercentile=args.airnow_hedge_percentile,
+                                apiUrl=airnow_server.getUrl())
+        airnow_recorder = LatencyRecorder()
+        fetcher._api.getCurrentObservationByLatLon = airnow_recorder.wrap(fetcher._api.getCurrentObservationByLatLon)
+        twitter_recorder = LatencyRecorder()
+        TwitterUtil.publish = staticmethod(twitter_recorder.wrap(TwitterUtil.publish))
+
+        scheduler = Scheduler(args.workers)
+        state_store = StateStore(backend=MemoryStateBackend())
+        state_store.start(scheduler)
+        outbox = TwitterUtil.startOutbox(args.outbox_concurrency)
+        for location in locations:
+            AirQualityTask(scheduler, location, state_store, fetcher)
+
+        print("Running {} locations for {:.0f} seconds".format(len(locations), args.duration), flush=True)
+        start = time.perf_counter()
+        scheduler.start()
+        time.sleep(args.duration)
+        scheduler.stop()
+        TwitterUtil.stopOutbox()
+        elapsed = time.perf_counter() - start
+
+        print("Reporting areas:  {}".format(fetcher.getAreaCount()))
+        print(airnow_recorder.summarize("AirNow", elapsed))
+        print(twitter_recorder.summarize("Twitter", elapsed))
+        print("AirNow responses: " + _formatStatusCounts(airnow_server.getStatusCounts()))
+        print("Twitter responses: " + _formatStatusCounts(twitter_server.getStatusCounts()))
+        print("Tweets delivered: {}, still queued: {}".format(twitter_server.getTweetCount(), outbox.pending()))
+
+    airnow_server.stop()
+    twitter_server.stop()
+    return 0
+
+
+def _formatStatusCounts(statusCounts: dict) -> str:
+    if (not statusCounts):
+        return "none"
+    return ", ".join("{} x {}".format(count, status) for status, count in sorted(statusCounts.items()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
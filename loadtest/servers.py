@@ -0,0 +1,256 @@
+"""
+Local stand-in servers for the AirNow and Twitter APIs, which answer like the
+real endpoints the bot calls, with a configurable latency, error rate and
+rate limit.
+"""
+
+import json
+import math
+import random
+import threading
+import time
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeService(object):
+    """
+    Serves a fake API over HTTP from a background thread. Every request is
+    delayed by a random latency, fails with a server error at the given rate,
+    and counts against a rate limit whose state is reported in the
+    x-rate-limit-limit, x-rate-limit-remaining and x-rate-limit-reset headers,
+    as the Twitter API reports it. Requests over the limit are answered with
+    429 Too Many Requests until the window resets.
+    """
+
+    def __init__(self,
+                 latencySeconds: float = 0,
+                 errorRate: float = 0,
+                 rateLimit: int = None,
+                 rateLimitWindowSeconds: float = 900,
+                 seed: int = None):
+        """
+        Constructor for the Fake Service.
+
+        Parameters:
+            latencySeconds (float): (optional) The mean latency; latencies are exponentially distributed around it
+            errorRate (float): (optional) The share of requests answered with 503 Service Unavailable
+            rateLimit (int): (optional) The requests allowed per window (Default = unlimited)
+            rateLimitWindowSeconds (float): (optional) The length of a rate-limit window
+            seed (int): (optional) Seeds the latencies and errors
+        """
+        self._latency_seconds = latencySeconds
+        self._error_rate = errorRate
+        self._rate_limit = rateLimit
+        self._window_seconds = rateLimitWindowSeconds
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._window_requests = 0
+        self._status_counts: Dict[int, int] = {}
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # Keep connections open between requests, as the real APIs do
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                service._handle(self)
+
+            def do_POST(self):
+                service._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(name=type(self).__name__, target=self._server.serve_forever, args=())
+        self._thread.daemon = True
+
+
+    def start(self) -> None:
+        self._thread.start()
+
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def getUrl(self) -> str:
+        address, port = self._server.server_address[:2]
+        return "http://{}:{}".format(address, port)
+
+
+    def getStatusCounts(self) -> Dict[int, int]:
+        """ The number of responses sent, by status code """
+        with self._lock:
+            return dict(self._status_counts)
+
+
+    def respond(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Tuple[int, object]:
+        """
+        Answer a request that is neither delayed away, failed nor rate limited.
+
+        Parameters:
+            method (str): GET or POST
+            path (str): The path of the URL
+            query (Dict): The query parameters
+            body (bytes): The request body
+
+        Returns:
+            Tuple: The status code and the object sent back as JSON
+        """
+
+        raise NotImplementedError()
+
+
+    def _handle(self, handler: BaseHTTPRequestHandler) -> None:
+        url = urlsplit(handler.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+
+        with self._lock:
+            latency_seconds = self._random.expovariate(1 / self._latency_seconds) if self._latency_seconds > 0 else 0
+            failed = self._random.random() < self._error_rate
+            now = time.time()
+            if (now - self._window_start >= self._window_seconds):
+                self._window_start = now
+                self._window_requests = 0
+            self._window_requests += 1
+            remaining = None
+            if (self._rate_limit is not None):
+                remaining = self._rate_limit - self._window_requests
+            reset = math.ceil(self._window_start + self._window_seconds)
+
+        time.sleep(latency_seconds)
+        if (remaining is not None and remaining < 0):
+            status, document = 429, {"title": "Too Many Requests"}
+        elif (failed):
+            status, document = 503, {"title": "Service Unavailable"}
+        else:
+            status, document = self.respond(handler.command, url.path, query, body)
+
+        content = json.dumps(document).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        if (remaining is not None):
+            handler.send_header("x-rate-limit-limit", str(self._rate_limit))
+            handler.send_header("x-rate-limit-remaining", str(max(0, remaining)))
+            handler.send_header("x-rate-limit-reset", str(reset))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+        with self._lock:
+            self._status_counts[status] = self._status_counts.get(status, 0) + 1
+
+
+class FakeAirNowServer(FakeService):
+    """
+    Answers the AirNow current observations by latitude and longitude. The
+    coordinates are grouped into square reporting areas, and the observations
+    of every area advance by one hour each time the given seconds pass, with
+    an AQI that wanders from hour to hour so categories change now and then.
+    """
+
+    _ENDPOINT = "/aq/observation/latLong/current"
+    _PARAMETERS = ("O3", "PM2.5")
+    _FIRST_HOUR = datetime(2021, 6, 1)
+    _CATEGORY_BREAKPOINTS = (50, 100, 150, 200, 300)
+
+    def __init__(self, hourSeconds: float = 60, areaDegrees: float = 1.0, **kwargs):
+        """
+        Constructor for the Fake AirNow Server.
+
+        Parameters:
+            hourSeconds (float): (optional) The seconds in which the observations advance by an hour
+            areaDegrees (float): (optional) The width and height of a reporting area
+            **kwargs: The latency, error rate, rate limit and seed of the Fake Service
+        """
+        super().__init__(**kwargs)
+        self._hour_seconds = hourSeconds
+        self._area_degrees = areaDegrees
+        self._start = time.time()
+
+
+    def respond(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Tuple[int, object]:
+        if (method != "GET" or path.rstrip("/") != self._ENDPOINT):
+            return 404, {"title": "Not Found"}
+        try:
+            latitude = float(query["latitude"])
+            longitude = float(query["longitude"])
+        except (KeyError, ValueError):
+            return 400, {"title": "Bad Request"}
+        if (not query.get("API_KEY")):
+            return 401, {"title": "Unauthorized"}
+
+        row = math.floor(latitude / self._area_degrees)
+        column = math.floor(longitude / self._area_degrees)
+        hour = int((time.time() - self._start) / self._hour_seconds)
+        timestamp = self._FIRST_HOUR + timedelta(hours=hour)
+        return 200, [self._createObservation(row, column, hour, timestamp, parameter) for parameter in self._PARAMETERS]
+
+
+    def _createObservation(self, row: int, column: int, hour: int, timestamp: datetime, parameter: str) -> Dict:
+        # Every server, and every request of an hour, gives the same AQI for an area
+        aqi = random.Random("{},{},{},{}".format(row, column, hour, parameter)).randint(0, 180)
+        category = 1 + sum(1 for breakpoint in self._CATEGORY_BREAKPOINTS if aqi > breakpoint)
+        return {
+            "DateObserved": timestamp.strftime("%Y-%m-%d"),
+            "HourObserved": timestamp.hour,
+            "LocalTimeZone": "CST",
+            "ReportingArea": "Area {}:{}".format(row, column),
+            "StateCode": "ZZ",
+            "Latitude": (row + 0.5) * self._area_degrees,
+            "Longitude": (column + 0.5) * self._area_degrees,
+            "ParameterName": parameter,
+            "AQI": aqi,
+            "Category": {"Number": category, "Name": ""}
+        }
+
+
+class FakeTwitterServer(FakeService):
+    """
+    Answers the Twitter API v2 create tweet endpoint, keeping every tweet it
+    accepted.
+    """
+
+    _ENDPOINT = "/2/tweets"
+
+    def __init__(self, **kwargs):
+        """
+        Constructor for the Fake Twitter Server.
+
+        Parameters:
+            **kwargs: The latency, error rate, rate limit and seed of the Fake Service
+        """
+        super().__init__(**kwargs)
+        self._tweets_lock = threading.Lock()
+        self._tweets = list()
+
+
+    def getTweetCount(self) -> int:
+        with self._tweets_lock:
+            return len(self._tweets)
+
+
+    def respond(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Tuple[int, object]:
+        if (method != "POST" or path.rstrip("/") != self._ENDPOINT):
+            return 404, {"title": "Not Found"}
+        try:
+            text = json.loads(body)["text"]
+        except (KeyError, TypeError, ValueError):
+            return 400, {"title": "Invalid Request"}
+
+        with self._tweets_lock:
+            self._tweets.append(text)
+            tweet_id = str(len(self._tweets))
+        return 201, {"data": {"id": tweet_id, "text": text}}
@@ -19,6 +19,7 @@ setuptools.setup(
     install_requires=[
         "airnowpy",
         "astral",
+        "numpy",
         "pylunar",
         "python-dotenv",
         "pytz",
@@ -0,0 +1,351 @@
+import logging
+import requests
+import threading
+import time
+
+from airnowpy import API, Observation
+from cache import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from location import Location
+from metrics import REGISTRY
+from observationlog import ObservationLog
+from polling import AdaptivePollingPolicy
+from resilience import CircuitBreaker, CircuitOpenError, LatencyWindow, callHedged
+from typing import Dict, List, Tuple
+
+
+class AirNowClient(API):
+    """
+    The airnowpy API with a deadline on every request. The connection is kept
+    open between requests, and a response that is not a success is raised as
+    an error instead of being parsed.
+    """
+
+    def __init__(self, apiKey: str, timeoutSeconds: float, apiUrl: str = None):
+        """
+        Constructor for the AirNow Client.
+
+        Parameters:
+            apiKey (str): The key to access the AirNow API
+            timeoutSeconds (float): The longest wait to connect, and then between any two bytes of the response
+            apiUrl (str): (optional) The base URL of the API (Default = the AirNow API)
+        """
+        super().__init__(apiKey)
+        self._api_url = "http://" + API._HOST if apiUrl is None else apiUrl
+        self._timeout_seconds = timeoutSeconds
+        self._session = requests.Session()
+
+
+    def getCurrentObservationByLatLon(self, latitude: float, longitude: float) -> List[Observation]:
+        if (latitude < -90 or 90 < latitude):
+            raise ValueError("Latitude must be between -90 and 90: " + str(latitude))
+        if (longitude < -180 or 180 < longitude):
+            raise ValueError("Longitude must be between -180 and 180: " + str(longitude))
+
+        payload = {
+            "latitude": latitude,
+            "longitude": longitude,
+            "format": API._RETURN_FORMAT,
+            "API_KEY": self.apiKey
+        }
+        response = self._session.get(self._api_url + API._ENDPOINT_OBSERVATION_BY_LATLON,
+                                     params=payload,
+                                     timeout=self._timeout_seconds)
+        response.raise_for_status()
+        return self._convertResponseToObservation(response)
+
+
+class AirNowFetcher(object):
+    """
+    Shares AirNow requests between locations. Each location is resolved to the
+    reporting area named in its first response, after which a single request
+    per reporting area serves every location in that area.
+
+    Responses are cached until a newer hourly observation can exist. Until the
+    hour of an area is first seen to change, an entry lives until one hour past
+    its newest observation timestamp; after that, it lives until one hour after
+    the newest observation first appeared. An entry never lives for less than
+    one cycle. When an adaptive polling policy is given, it decides instead.
+
+    Requests go through a circuit breaker, so an outage of the API is not
+    met with a request from every area on every cycle. When hedging is on,
+    a request that is slower than the given percentile of recent requests
+    is sent a second time, and the first response wins.
+    """
+
+    LOGGER = logging.getLogger()
+    _REQUEST_SECONDS = REGISTRY.histogram("wxbot_airnow_request_seconds", "Latency of AirNow API requests")
+    _REQUEST_ERRORS = REGISTRY.counter("wxbot_airnow_request_errors_total", "AirNow API requests that failed")
+    _HEDGED_REQUESTS = REGISTRY.counter("wxbot_airnow_hedged_requests_total", "AirNow API requests sent a second time for being slow")
+    _CIRCUIT_OPEN = REGISTRY.gauge("wxbot_airnow_circuit_open", "1 while the circuit breaker of AirNow API requests is open or probing, else 0")
+    _CACHE_HITS = REGISTRY.counter("wxbot_airnow_cache_hits_total", "AirNow responses served from the cache")
+    _CACHE_MISSES = REGISTRY.counter("wxbot_airnow_cache_misses_total", "AirNow cache lookups that found no fresh response")
+    _CACHE_EVICTIONS = REGISTRY.counter("wxbot_airnow_cache_evictions_total", "AirNow responses evicted to make room in the cache")
+    _TIMEOUT_SECONDS = 10
+    _HEDGE_THREADS = 8
+    _CACHE_MAX_ENTRIES = 4096
+    _HOUR_SECONDS = 3600
+    # Refresh a little before the next hour is expected, to absorb publishing jitter
+    _EARLY_REFRESH_SECONDS = 300
+    _COORDINATE_PRECISION = 2
+
+    def __init__(self,
+                 apiKey: str,
+                 cycleSeconds: float,
+                 cacheMaxEntries: int = _CACHE_MAX_ENTRIES,
+                 pollingPolicy: AdaptivePollingPolicy = None,
+                 observationLog: ObservationLog = None,
+                 timeoutSeconds: float = _TIMEOUT_SECONDS,
+                 hedgePercentile: float = None,
+                 circuitBreaker: CircuitBreaker = None,
+                 apiUrl: str = None):
+        """
+        Constructor for the AirNow Fetcher.
+
+        Parameters:
+            apiKey (str): The key to access the AirNow API
+            cycleSeconds (float): The shortest time a response is served from the cache
+            cacheMaxEntries (int): The most responses kept in the cache
+            pollingPolicy (AdaptivePollingPolicy): (optional) Decides when responses expire
+            observationLog (ObservationLog): (optional) Records every fetched observation
+            timeoutSeconds (float): (optional) The deadline of each request
+            hedgePercentile (float): (optional) Send a slow request again once it takes longer
+                than this percentile of recent requests (Default = never)
+            circuitBreaker (CircuitBreaker): (optional) Stops requests during an outage
+            apiUrl (str): (optional) The base URL of the API (Default = the AirNow API)
+        """
+        self._api_key = apiKey
+        self._api = AirNowClient(apiKey, timeoutSeconds, apiUrl)
+        self._circuit_breaker = circuitBreaker or CircuitBreaker("AirNow")
+        self._hedge_percentile = hedgePercentile
+        self._latencies = LatencyWindow()
+        self._hedge_executor = None
+        if (hedgePercentile is not None):
+            self._hedge_executor = ThreadPoolExecutor(max_workers=self._HEDGE_THREADS, thread_name_prefix="airnow")
+        self._cycle_seconds = cycleSeconds
+        self._cache = TTLCache(cacheMaxEntries)
+        # The evictions of the cache already added to the counter
+        self._cache_evictions = 0
+        self._polling_policy = pollingPolicy
+        self._observation_log = observationLog
+        self._lock = threading.Lock()
+        self._areas: Dict[Location, str] = {}
+        self._area_coordinates: Dict[str, Tuple[float, float]] = {}
+        self._area_locks: Dict[str, threading.Lock] = {}
+
+
+    def getApiKey(self) -> str:
+        return self._api_key
+
+
+    def getCurrentObservations(self, location: Location) -> List[Observation]:
+        """
+        Retrieve the current observations for a location, reusing the cached
+        response for the location's reporting area while it is fresh.
+
+        Parameters:
+            location (Location): The location to retrieve observations for
+
+        Returns:
+            Observation[]: The current observations for the location's reporting area
+        """
+
+        with self._lock:
+            area = self._areas.get(location)
+            area_lock = self._area_locks.get(area)
+
+        if (area is None):
+            key = self._getCoordinateKey(location)
+            observations = self._getCached(key)
+            if (observations is None):
+                try:
+                    observations = self._fetch(location.latitude, location.longitude)
+                except Exception as e:
+                    self._storeFailure(key, e)
+                    raise
+                self._store(key, observations)
+            self._subscribe(location, observations)
+            return observations
+
+        with area_lock:
+            observations = self._getCached(area)
+            if (observations is not None):
+                self.LOGGER.debug("Reusing observations for reporting area " + area)
+                return observations
+
+            latitude, longitude = self._area_coordinates[area]
+            try:
+                observations = self._fetch(latitude, longitude)
+            except Exception as e:
+                # Other locations in the area wait for the next cycle rather than retrying now
+                self._storeFailure(area, e)
+                raise
+            self._store(area, observations)
+            return observations
+
+
+    def getSecondsUntilNextFetch(self, location: Location) -> float:
+        """
+        Seconds until the cached response for the location expires, so that
+        all locations of an area wake for the same request.
+
+        Parameters:
+            location (Location): The location that is about to sleep
+
+        Returns:
+            float: Seconds until the next fetch for the location, or the cycle length if not yet known
+        """
+
+        with self._lock:
+            key = self._areas.get(location)
+        if (key is None):
+            key = self._getCoordinateKey(location)
+
+        expires_at = self._cache.getExpiry(key)
+        if (expires_at is None):
+            return self._cycle_seconds
+        return max(0, expires_at - time.time())
+
+
+    def getAreaCount(self) -> int:
+        with self._lock:
+            return len(self._area_coordinates)
+
+
+    def _fetch(self, latitude: float, longitude: float) -> List[Observation]:
+        self.LOGGER.debug("Requesting current observations for {},{}".format(latitude, longitude))
+        request = lambda: self._request(latitude, longitude)
+        hedge_after_seconds = None
+        if (self._hedge_executor is not None):
+            hedge_after_seconds = self._latencies.percentile(self._hedge_percentile)
+
+        try:
+            self._circuit_breaker.acquire()
+            try:
+                if (hedge_after_seconds is None):
+                    observations = request()
+                else:
+                    observations = callHedged(self._hedge_executor, request, hedge_after_seconds, self._HEDGED_REQUESTS.inc)
+            except Exception:
+                self._circuit_breaker.recordFailure()
+                raise
+            self._circuit_breaker.recordSuccess()
+        finally:
+            self._CIRCUIT_OPEN.set(0 if self._circuit_breaker.getState() == CircuitBreaker.CLOSED else 1)
+
+        if (self._observation_log is not None):
+            try:
+                self._observation_log.append(observations, time.time())
+            except Exception:
+                self.LOGGER.exception("Problem occurred while logging observations")
+        return observations
+
+
+    def _request(self, latitude: float, longitude: float) -> List[Observation]:
+        start = time.perf_counter()
+        try:
+            observations = self._api.getCurrentObservationByLatLon(latitude, longitude)
+        except Exception:
+            self._REQUEST_ERRORS.inc()
+            raise
+        finally:
+            self._REQUEST_SECONDS.observe(time.perf_counter() - start)
+        self._latencies.record(time.perf_counter() - start)
+        return observations
+
+
+    def _storeFailure(self, key: str, error: Exception) -> None:
+        retry_seconds = self._cycle_seconds
+        if (isinstance(error, CircuitOpenError)):
+            # Spread out when the waiting locations retry, instead of all at the next cycle
+            retry_seconds = error.retryAfterSeconds
+        previous = self._cache.peek(key)
+        previous = (None, None, None) if previous is None else previous
+        self._cache.put(key, (list(), previous[1], previous[2]), time.time() + retry_seconds)
+        self._countEvictions()
+
+
+    def _getCached(self, key: str) -> List[Observation]:
+        entry = self._cache.get(key)
+        if (entry is None):
+            self._CACHE_MISSES.inc()
+            return None
+        self._CACHE_HITS.inc()
+        return entry[0]
+
+
+    def _countEvictions(self) -> None:
+        # Only the cache knows whether a put evicted, so the counter follows its statistics
+        with self._lock:
+            evictions = self._cache.getStats()["evictions"]
+            new_evictions = evictions - self._cache_evictions
+            self._cache_evictions = evictions
+        if (new_evictions > 0):
+            self._CACHE_EVICTIONS.inc(amount=new_evictions)
+
+
+    def _store(self, key: str, observations: List[Observation]) -> None:
+        now = time.time()
+        newest = self._getNewestTimestamp(observations)
+        first_seen = None
+
+        previous = self._cache.peek(key)
+        if (newest is not None and previous is not None and previous[1] is not None):
+            if (newest > previous[1]):
+                # The hour changed since the last request, so it was published just now
+                first_seen = now
+                if (self._polling_policy is not None):
+                    self._polling_policy.recordArrival(key, now)
+            elif (newest == previous[1]):
+                first_seen = previous[2]
+                if (self._polling_policy is not None):
+                    self._polling_policy.recordUnchanged(key)
+
+        if (self._polling_policy is not None and newest is not None):
+            aqi_value = max(observation.aqiValue for observation in observations)
+            delay_seconds = self._polling_policy.getNextPollDelay(key, now, first_seen, aqi_value)
+            if (delay_seconds is not None):
+                self._cache.put(key, (observations, newest, first_seen), now + delay_seconds)
+                self._countEvictions()
+                return
+
+        if (newest is None):
+            expires_at = now
+        elif (first_seen is None):
+            expires_at = newest.timestamp() + self._HOUR_SECONDS
+        else:
+            expires_at = first_seen + self._HOUR_SECONDS - self._EARLY_REFRESH_SECONDS
+
+        expires_at = max(expires_at, now + self._cycle_seconds)
+        self._cache.put(key, (observations, newest, first_seen), expires_at)
+        self._countEvictions()
+
+
+    def _subscribe(self, location: Location, observations: List[Observation]) -> None:
+        if (not observations):
+            return
+
+        area = observations[0].reportingArea + ", " + observations[0].stateCode
+        with self._lock:
+            if (area not in self._area_coordinates):
+                self.LOGGER.info("Location {} starts reporting area {}".format(location.name, area))
+                self._area_coordinates[area] = (location.latitude, location.longitude)
+                self._area_locks[area] = threading.Lock()
+            else:
+                self.LOGGER.info("Location {} joins reporting area {}".format(location.name, area))
+            self._areas[location] = area
+
+        if (self._cache.peek(area) is None):
+            self._store(area, observations)
+
+
+    def _getCoordinateKey(self, location: Location) -> str:
+        return "{:.{p}f},{:.{p}f}".format(location.latitude, location.longitude, p=self._COORDINATE_PRECISION)
+
+
+    @staticmethod
+    def _getNewestTimestamp(observations: List[Observation]) -> datetime:
+        if (not observations):
+            return None
+        return max(observation.timestamp for observation in observations)
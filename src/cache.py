@@ -0,0 +1,98 @@
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+
+class TTLCache(object):
+    """
+    A bounded, thread safe cache whose entries each carry their own expiry
+    time. The least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, maxSize: int):
+        """
+        Constructor for the TTL Cache.
+
+        Parameters:
+            maxSize (int): The most entries the cache holds before evicting
+        """
+        self._max_size = maxSize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Retrieve an unexpired value, counting the lookup as a hit or a miss.
+
+        Parameters:
+            key (Hashable): The key of the entry
+
+        Returns:
+            Any: The cached value, or None when absent or expired
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None or entry[1] <= time.time()):
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+
+    def peek(self, key: Hashable) -> Any:
+        """
+        Retrieve a value even if it has expired, without counting the lookup.
+
+        Parameters:
+            key (Hashable): The key of the entry
+
+        Returns:
+            Any: The cached value, or None when absent
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[0]
+
+
+    def getExpiry(self, key: Hashable) -> float:
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[1]
+
+
+    def put(self, key: Hashable, value: Any, expiresAt: float) -> None:
+        """
+        Store a value until the given time.
+
+        Parameters:
+            key (Hashable): The key of the entry
+            value (Any): The value to store
+            expiresAt (float): Epoch seconds after which the entry is no longer served
+        """
+
+        with self._lock:
+            self._entries[key] = (value, expiresAt)
+            self._entries.move_to_end(key)
+            while (len(self._entries) > self._max_size):
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+
+    def getStats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "size": len(self._entries)
+            }
@@ -0,0 +1,46 @@
+import time
+
+from datetime import datetime, tzinfo
+
+
+class SystemClock(object):
+    """
+    The wall clock of the host.
+    """
+
+    def now(self, tz: tzinfo = None) -> datetime:
+        return datetime.now(tz=tz)
+
+
+    def time(self) -> float:
+        return time.time()
+
+
+class VirtualClock(object):
+    """
+    A clock that only moves when it is told to, so that days of task
+    behavior can be replayed as fast as they can be computed.
+    """
+
+    def __init__(self, epochSeconds: float):
+        """
+        Constructor for the Virtual Clock.
+
+        Parameters:
+            epochSeconds (float): The time the clock starts at
+        """
+        self._time = epochSeconds
+
+
+    def now(self, tz: tzinfo = None) -> datetime:
+        return datetime.fromtimestamp(self._time, tz=tz)
+
+
+    def time(self) -> float:
+        return self._time
+
+
+    def set(self, epochSeconds: float) -> None:
+        if (epochSeconds < self._time):
+            raise ValueError("A virtual clock cannot move backwards")
+        self._time = epochSeconds
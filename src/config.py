@@ -0,0 +1,253 @@
+import logging
+import socket
+import threading
+
+from dataclasses import dataclass, fields
+from ephemeris import getAvailableCores
+from envvarname import EnvVarName
+from location import Location, loadLocations
+from typing import List, Optional, Tuple
+from util import getEnvVar, isEmpty, isTruthy
+
+
+TASK_NAMES = ("solartime", "lunartime", "airquality")
+
+
+@dataclass(frozen=True)
+class Config():
+    """
+    The settings of the application, read once from the environment and the
+    .env file and validated. A Config never changes; reloading builds a new
+    one that replaces the current one as a whole, so that a task never sees
+    half of an old configuration and half of a new one.
+
+    Fields:
+        locations (Location[]): The locations served
+        enabledTasks (str[]): The names of the tasks that run
+        eventPlanning (bool): Plan the tweets of the solar and lunar tasks a day ahead
+        hashtag (str): Appended to all tweets as a hashtag, without the #
+        twitterCredentials (str[]): The consumer key, consumer secret, access token,
+            access token secret and bearer token for the Twitter API, None when unset
+        airNowApiKey (str): The key for the AirNow API
+        airNowAdaptivePolling (bool): Poll AirNow around the learned publish times
+        airNowObservationLog (bool): Keep a binary log of every fetched observation
+        airNowTimeoutSeconds (float): The deadline of each AirNow request
+        airNowHedgePercentile (float): Send an AirNow request again once it is slower than
+            this percentile of recent requests, None to never
+        airNowApiUrl (str): The base URL of the AirNow API, None for the real one
+        twitterApiUrl (str): The base URL of the Twitter API, None for the real one
+        schedulerWorkers (int): The number of threads that run task steps, None for the default
+        ephemerisProcesses (int): The number of processes that compute ephemerides, 0 to compute them in process
+        stateBackend (str): Where task state is kept, "file" or "sqlite"
+        shardCount (int): The number of shards the locations are spread over, None to serve them all
+        replicaId (str): Identifies this replica among the ones that share the data directory
+        shardLeaseSeconds (float): How long the lease of a replica on a shard lasts
+        outboxConcurrency (int): The number of tweets delivered at once, None for the default
+        metricsPort (int): The port metrics are served on, None to not serve them
+        metricsAddress (str): The address metrics are served on
+        profileSeconds (float): How long a profile triggered by a signal lasts
+        logLevel (str): The level of logging
+        logFormat (str): The format of the log file, "text" or "json"
+        logMaxBytes (int): Rotate the log file at this size, never when 0
+        logBackupCount (int): The number of rotated log files kept
+        timezone (str): The timezone of the log timestamps, None for UTC
+    """
+
+    locations: Tuple[Location, ...] = ()
+    enabledTasks: Tuple[str, ...] = TASK_NAMES
+    eventPlanning: bool = False
+    hashtag: str = None
+    twitterCredentials: Tuple[Optional[str], ...] = (None, None, None, None, None)
+    airNowApiKey: str = None
+    airNowAdaptivePolling: bool = False
+    airNowObservationLog: bool = False
+    airNowTimeoutSeconds: float = 10
+    airNowHedgePercentile: float = None
+    airNowApiUrl: str = None
+    twitterApiUrl: str = None
+    schedulerWorkers: int = None
+    ephemerisProcesses: int = 0
+    stateBackend: str = "file"
+    shardCount: int = None
+    replicaId: str = None
+    shardLeaseSeconds: float = 30
+    outboxConcurrency: int = None
+    metricsPort: int = None
+    metricsAddress: str = "127.0.0.1"
+    profileSeconds: float = 600
+    logLevel: str = "INFO"
+    logFormat: str = "text"
+    logMaxBytes: int = 0
+    logBackupCount: int = 5
+    timezone: str = None
+
+    # Settings that a reload applies to the running application, the others need a restart
+    _RELOADABLE = ("locations", "hashtag", "twitterCredentials", "logLevel")
+
+    def formatHashtag(self) -> str:
+        """ The text that ends every tweet, empty when no hashtag is set """
+        if (isEmpty(self.hashtag)):
+            return ""
+        return " #" + self.hashtag
+
+
+    def getRestartRequiredChanges(self, other: "Config") -> List[str]:
+        """
+        Name the settings that differ from another configuration but only take
+        effect after a restart.
+
+        Parameters:
+            other (Config): The configuration to compare with
+
+        Returns:
+            str[]: The names of the settings
+        """
+
+        return [field.name for field in fields(self)
+                if field.name not in self._RELOADABLE and getattr(self, field.name) != getattr(other, field.name)]
+
+
+def loadConfig() -> Config:
+    """
+    Build the configuration from the environment variables, which the .env
+    file of the application root directory must already have been loaded into.
+
+    Returns:
+        Config: The validated configuration
+    """
+
+    locations = tuple(loadLocations())
+    if (not locations):
+        raise RuntimeError("At least one location must be configured")
+
+    enabled_tasks = TASK_NAMES
+    enabled_tasks_value = getEnvVar(EnvVarName.ENABLED_TASKS)
+    if (not isEmpty(enabled_tasks_value)):
+        enabled_tasks = tuple(name.strip().lower() for name in enabled_tasks_value.split(",") if not isEmpty(name.strip()))
+        for name in enabled_tasks:
+            if (name not in TASK_NAMES):
+                raise RuntimeError("Unknown task: " + name)
+
+    air_now_api_key = getEnvVar(EnvVarName.AIRNOW_API_KEY)
+    if ("airquality" in enabled_tasks and isEmpty(air_now_api_key)):
+        raise RuntimeError("Missing required environment variable: " + EnvVarName.AIRNOW_API_KEY.name)
+
+    state_backend = _getChoice(EnvVarName.STATE_BACKEND, ("file", "sqlite"), Config.stateBackend)
+    log_format = _getChoice(EnvVarName.LOG_FORMAT, ("text", "json"), Config.logFormat)
+
+    log_level = getEnvVar(EnvVarName.LOG_LEVEL)
+    if (isEmpty(log_level)):
+        log_level = Config.logLevel
+    log_level = log_level.upper()
+    if (not isinstance(logging.getLevelName(log_level), int)):
+        raise RuntimeError("Unknown log level: " + log_level)
+
+    ephemeris_processes = getEnvVar(EnvVarName.EPHEMERIS_PROCESSES)
+    if (not isEmpty(ephemeris_processes) and ephemeris_processes.strip().lower() == "auto"):
+        # A single core gains nothing from worker processes, only the cost of reaching them
+        ephemeris_processes = getAvailableCores() if getAvailableCores() > 1 else 0
+    else:
+        ephemeris_processes = _getNumber(EnvVarName.EPHEMERIS_PROCESSES, int, Config.ephemerisProcesses, 0)
+
+    air_now_hedge_percentile = _getNumber(EnvVarName.AIRNOW_HEDGE_PERCENTILE, float, None, 1)
+    if (air_now_hedge_percentile is not None and air_now_hedge_percentile >= 100):
+        raise RuntimeError("Environment variable " + EnvVarName.AIRNOW_HEDGE_PERCENTILE.name + " must be below 100")
+
+    replica_id = getEnvVar(EnvVarName.REPLICA_ID)
+    if (isEmpty(replica_id)):
+        replica_id = socket.gethostname()
+
+    metrics_address = getEnvVar(EnvVarName.METRICS_ADDRESS)
+    if (isEmpty(metrics_address)):
+        metrics_address = Config.metricsAddress
+
+    return Config(locations=locations,
+                  enabledTasks=enabled_tasks,
+                  eventPlanning=isTruthy(getEnvVar(EnvVarName.EVENT_PLANNING)),
+                  hashtag=getEnvVar(EnvVarName.TWITTER_HASHTAG),
+                  twitterCredentials=tuple(getEnvVar(name) for name in (EnvVarName.TWITTER_CONSUMER_KEY,
+                                                                        EnvVarName.TWITTER_CONSUMER_SECRET,
+                                                                        EnvVarName.TWITTER_ACCESS_TOKEN,
+                                                                        EnvVarName.TWITTER_ACCESS_TOKEN_SECRET,
+                                                                        EnvVarName.TWITTER_BEARER_TOKEN)),
+                  airNowApiKey=air_now_api_key,
+                  airNowAdaptivePolling=isTruthy(getEnvVar(EnvVarName.AIRNOW_ADAPTIVE_POLLING)),
+                  airNowObservationLog=isTruthy(getEnvVar(EnvVarName.AIRNOW_OBSERVATION_LOG)),
+                  airNowTimeoutSeconds=_getNumber(EnvVarName.AIRNOW_TIMEOUT_SECONDS, float, Config.airNowTimeoutSeconds, 1),
+                  airNowHedgePercentile=air_now_hedge_percentile,
+                  airNowApiUrl=_getUrl(EnvVarName.AIRNOW_API_URL),
+                  twitterApiUrl=_getUrl(EnvVarName.TWITTER_API_URL),
+                  schedulerWorkers=_getNumber(EnvVarName.SCHEDULER_WORKERS, int, None, 1),
+                  ephemerisProcesses=ephemeris_processes,
+                  stateBackend=state_backend,
+                  shardCount=_getNumber(EnvVarName.SHARD_COUNT, int, None, 1),
+                  replicaId=replica_id,
+                  shardLeaseSeconds=_getNumber(EnvVarName.SHARD_LEASE_SECONDS, float, Config.shardLeaseSeconds, 3),
+                  outboxConcurrency=_getNumber(EnvVarName.OUTBOX_CONCURRENCY, int, None, 1),
+                  metricsPort=_getNumber(EnvVarName.METRICS_PORT, int, None, 0),
+                  metricsAddress=metrics_address,
+                  profileSeconds=_getNumber(EnvVarName.PROFILE_SECONDS, float, Config.profileSeconds, 1),
+                  logLevel=log_level,
+                  logFormat=log_format,
+                  logMaxBytes=_getNumber(EnvVarName.LOG_MAX_BYTES, int, Config.logMaxBytes, 0),
+                  logBackupCount=_getNumber(EnvVarName.LOG_BACKUP_COUNT, int, Config.logBackupCount, 0),
+                  timezone=getEnvVar(EnvVarName.TIMEZONE))
+
+
+def _getChoice(name: EnvVarName, choices: Tuple[str, ...], default: str) -> str:
+    value = getEnvVar(name)
+    if (isEmpty(value)):
+        return default
+    value = value.lower()
+    if (value not in choices):
+        raise RuntimeError("Environment variable " + name.name + " must be one of " + ", ".join(choices) + ": " + value)
+    return value
+
+
+def _getUrl(name: EnvVarName) -> str:
+    value = getEnvVar(name)
+    if (isEmpty(value)):
+        return None
+    if (not value.startswith(("http://", "https://"))):
+        raise RuntimeError("Environment variable " + name.name + " must be an http:// or https:// URL: " + value)
+    return value.rstrip("/")
+
+
+def _getNumber(name: EnvVarName, numberType, default, minimum):
+    value = getEnvVar(name)
+    if (isEmpty(value)):
+        return default
+    try:
+        number = numberType(value)
+    except ValueError:
+        raise RuntimeError("Environment variable " + name.name + " is not a number: " + value) from None
+    if (number < minimum):
+        raise RuntimeError("Environment variable " + name.name + " must be at least " + str(minimum))
+    return number
+
+
+_CURRENT = Config()
+_CURRENT_LOCK = threading.Lock()
+
+
+def getConfig() -> Config:
+    """ The current configuration, which a reload may replace at any time """
+    return _CURRENT
+
+
+def setConfig(config: Config) -> Config:
+    """
+    Replace the current configuration.
+
+    Parameters:
+        config (Config): The new configuration
+
+    Returns:
+        Config: The configuration that was replaced
+    """
+
+    global _CURRENT
+    with _CURRENT_LOCK:
+        previous = _CURRENT
+        _CURRENT = config
+        return previous
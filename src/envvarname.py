@@ -18,12 +18,79 @@ class EnvVarName(Enum):
     LATITUDE = auto()
     LONGITUDE = auto()
 
+    # The format of the log file, "text" or "json" for one JSON object per line
+    LOG_FORMAT = auto()
+
+    # Rotate the log file once it reaches this many bytes (never when unset)
+    LOG_MAX_BYTES = auto()
+
+    # The number of rotated log files that are kept
+    LOG_BACKUP_COUNT = auto()
+
+    # Path (relative to the application root) of a file listing many locations
+    LOCATIONS_FILE = auto()
+
+    # Comma separated names of the tasks to run (all of them when unset)
+    ENABLED_TASKS = auto()
+
+    # Plan the solar and lunar tweets a day ahead instead of computing them when due
+    EVENT_PLANNING = auto()
+
+    # The number of worker threads that run the scheduled tasks
+    SCHEDULER_WORKERS = auto()
+
+    # Serve metrics over HTTP on this port (not served when unset)
+    METRICS_PORT = auto()
+
+    # The address the metrics are served on
+    METRICS_ADDRESS = auto()
+
+    # How long a profile triggered by SIGUSR1 lasts, in seconds
+    PROFILE_SECONDS = auto()
+
+    # The number of processes that compute ephemerides, "auto" for one per core (computed in process when unset)
+    EPHEMERIS_PROCESSES = auto()
+
+    # Where task state is kept, "file" or "sqlite"
+    STATE_BACKEND = auto()
+
     # The key needed to access the AirNow API
     AIRNOW_API_KEY = auto()
 
+    # Poll AirNow around the learned publish times instead of at a fixed interval
+    AIRNOW_ADAPTIVE_POLLING = auto()
+
+    # Keep a binary log of every fetched observation
+    AIRNOW_OBSERVATION_LOG = auto()
+
+    # The deadline of each AirNow request, in seconds
+    AIRNOW_TIMEOUT_SECONDS = auto()
+
+    # Send an AirNow request again once it is slower than this percentile of recent requests
+    AIRNOW_HEDGE_PERCENTILE = auto()
+
+    # Send AirNow requests to this base URL instead, e.g. a local stand-in server
+    AIRNOW_API_URL = auto()
+
     TWITTER_CONSUMER_KEY = auto()
     TWITTER_CONSUMER_SECRET = auto()
     TWITTER_ACCESS_TOKEN = auto()
     TWITTER_ACCESS_TOKEN_SECRET = auto()
     TWITTER_BEARER_TOKEN = auto()
+
+    # Send Twitter requests to this base URL instead, e.g. a local stand-in server
+    TWITTER_API_URL = auto()
+
     TWITTER_HASHTAG = auto()
+
+    # Spread the locations over this many shards, which replicas sharing the data directory claim
+    SHARD_COUNT = auto()
+
+    # Identifies this replica among the ones sharing the data directory (Default = the host name)
+    REPLICA_ID = auto()
+
+    # How long the lease of a replica on a shard lasts without being renewed
+    SHARD_LEASE_SECONDS = auto()
+
+    # The number of tweets the outbox may deliver at once
+    OUTBOX_CONCURRENCY = auto()
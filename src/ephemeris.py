@@ -0,0 +1,180 @@
+import logging
+import math
+import multiprocessing
+import os
+import signal
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, time
+from location import Location
+from pytz import timezone, utc
+from typing import Dict, List, Tuple
+from util import decToDegMinSec
+
+
+def computeMoonTimes(latitude: float, longitude: float, timezoneName: str, day: date) -> List[Tuple[str, object]]:
+    """
+    Compute the moonrise, transit and moonset of a local date, as pylunar's
+    rise_set_times() reports them. Runs in the worker processes, so it only
+    takes and returns plain values.
+
+    Parameters:
+        latitude (float): Latitude in decimal degrees
+        longitude (float): Longitude in decimal degrees
+        timezoneName (str): The timezone name from the "tz database"
+        day (date): The local date
+
+    Returns:
+        List: Pairs of the event name and either a (YYYY, m, d, H, M, S) tuple or a reason it does not occur
+    """
+
+    from pylunar import MoonInfo
+
+    midnight = utc.normalize(timezone(timezoneName).localize(datetime.combine(day, time())))
+    moon_info = MoonInfo(decToDegMinSec(latitude), decToDegMinSec(longitude))
+    moon_info.update((midnight.year, midnight.month, midnight.day, midnight.hour, midnight.minute, midnight.second))
+    return moon_info.rise_set_times(timezoneName)
+
+
+def computeSunTimes(latitude: float, longitude: float, timezoneName: str, day: date) -> Dict[str, float]:
+    """
+    Compute the solar times of a local date with astral's sun(). Runs in the
+    worker processes, so it only takes and returns plain values.
+
+    Parameters:
+        latitude (float): Latitude in decimal degrees
+        longitude (float): Longitude in decimal degrees
+        timezoneName (str): The timezone name from the "tz database"
+        day (date): The local date
+
+    Returns:
+        Dict: The epoch seconds of each event, e.g. "sunrise", "noon" and "sunset"
+    """
+
+    from astral import LocationInfo
+    from astral.sun import sun
+
+    tzone = timezone(timezoneName)
+    location_info = LocationInfo("", "", tzone, latitude, longitude)
+    return {event: value.timestamp() for event, value in sun(location_info.observer, date=day, tzinfo=tzone).items()}
+
+
+class EphemerisPool(object):
+    """
+    Computes ephemerides in a pool of worker processes, so that the pure
+    Python work of pylunar and astral runs on every core instead of holding
+    the GIL of the process that also polls AirNow and publishes tweets.
+    Requests are sent in batches of (location, date) and the results come
+    back as plain values in the same order.
+
+    The workers are forked from the application when the pool is created,
+    which should happen before the tasks start running. For the same reason
+    the pool is not created again when it breaks, e.g. after the kernel
+    killed a worker for using too much memory: forking once the threads of
+    the application are running could copy a lock held by one of them. The
+    ephemerides are then computed in this process instead.
+    """
+
+    LOGGER = logging.getLogger()
+    _CHUNKS_PER_PROCESS = 4
+
+    def __init__(self, processes: int = None):
+        """
+        Constructor for the Ephemeris Pool.
+
+        Parameters:
+            processes (int): (optional) The number of worker processes (Default = the available cores)
+        """
+        if (processes is None):
+            processes = getAvailableCores()
+        # Forking avoids starting the application again in every worker, as spawning would
+        context = multiprocessing.get_context("fork")
+        self._processes = processes
+        self._broken = False
+        self._pool = ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_initWorker)
+        # Fork the workers now, while only this thread is busy
+        self._pool.submit(int).result()
+        self.LOGGER.info("Computing ephemerides in {} worker process(es)".format(processes))
+
+
+    def moonTimes(self, requests: List[Tuple[Location, date]]) -> List[List[Tuple[str, object]]]:
+        """
+        Compute the moonrise, transit and moonset for each request.
+
+        Parameters:
+            requests (List): Pairs of a location and a local date
+
+        Returns:
+            List: The result of computeMoonTimes() for each request, in order, or the exception it raised
+        """
+
+        return self._map(computeMoonTimes, requests)
+
+
+    def sunTimes(self, requests: List[Tuple[Location, date]]) -> List[Dict[str, float]]:
+        """
+        Compute the solar times for each request.
+
+        Parameters:
+            requests (List): Pairs of a location and a local date
+
+        Returns:
+            List: The result of computeSunTimes() for each request, in order, or the exception it raised
+        """
+
+        return self._map(computeSunTimes, requests)
+
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False)
+
+
+    def _map(self, function, requests: List[Tuple[Location, date]]) -> list:
+        arguments = [(location.latitude, location.longitude, location.timezone, day) for location, day in requests]
+        if (not self._broken):
+            try:
+                return self._mapInWorkers(function, arguments)
+            except BrokenProcessPool:
+                self._broken = True
+                self.LOGGER.exception("The ephemeris worker processes stopped, computing ephemerides in this process from now on")
+        return _computeChunk(function, arguments)
+
+
+    def _mapInWorkers(self, function, arguments: List[tuple]) -> list:
+        # A few chunks per process keep the workers evenly busy without a round trip per request
+        chunk_size = max(1, math.ceil(len(arguments) / (self._processes * self._CHUNKS_PER_PROCESS)))
+        futures = [self._pool.submit(_computeChunk, function, arguments[i:i + chunk_size])
+                   for i in range(0, len(arguments), chunk_size)]
+        results = list()
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+
+def _computeChunk(function, arguments: List[tuple]) -> list:
+    # One request failing, e.g. when the moon never rises near the poles, must not fail the others
+    results = list()
+    for argument in arguments:
+        try:
+            results.append(function(*argument))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _initWorker() -> None:
+    # The workers inherit the handlers of the application, which must only run in the application
+    for name in ("SIGINT", "SIGHUP", "SIGUSR1", "SIGUSR2"):
+        if (hasattr(signal, name)):
+            signal.signal(getattr(signal, name), signal.SIG_IGN)
+
+
+def getAvailableCores() -> int:
+    if (hasattr(os, "sched_getaffinity")):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def isProcessPoolSupported() -> bool:
+    return "fork" in multiprocessing.get_all_start_methods()
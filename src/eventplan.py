@@ -0,0 +1,340 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from clock import VirtualClock
+from collections import deque
+from config import getConfig
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime, timedelta
+from ephemeris import EphemerisPool
+from location import Location
+from metrics import REGISTRY
+from pathlib import Path
+from scheduler import ScheduledJob, Scheduler, VirtualScheduler
+from solartable import SolarTimeTable
+from statestore import StateStore
+from tasks.lunartime import LunarTimeTask
+from tasks.solartime import SolarTimeTask
+from twitter import TwitterUtil
+from typing import Callable, Dict, List, Optional, Tuple
+from util import initDataDir
+
+
+@dataclass(frozen=True)
+class PlannedTweet():
+    """
+    A tweet that a solar or lunar task will send, computed ahead of time.
+
+    Fields:
+        sendAt (float): The epoch seconds at which the task would have sent it
+        taskName (str): The name of the task that sends it
+        locationKey (str): The key of the location it is about
+        message (str): The text of the tweet
+        idempotencyKey (str): The key of the tweet in the ledger
+        state (Dict): The state the task saves once the tweet is sent, None when it saves none
+    """
+
+    sendAt: float
+    taskName: str
+    locationKey: str
+    message: str
+    idempotencyKey: str
+    state: Optional[Dict]
+
+
+class _PlanningStateStore(object):
+    """
+    Reads the states the tasks saved when they last ran for real, and keeps
+    the states saved while planning to itself.
+    """
+
+    def __init__(self, stateStore: StateStore, onSave: Callable[[str, str, Dict], None]):
+        self._state_store = stateStore
+        self._on_save = onSave
+        self._states: Dict[Tuple[str, str], Dict] = {}
+
+
+    def load(self, taskName: str, locationKey: str) -> Dict:
+        key = (taskName, locationKey)
+        if (key in self._states):
+            return self._states[key]
+        return self._state_store.load(taskName, locationKey)
+
+
+    def save(self, taskName: str, locationKey: str, state: Dict, converter: Callable = None) -> None:
+        # Keep the same representation that the state store would
+        state = json.loads(json.dumps(state, default=converter))
+        self._states[(taskName, locationKey)] = state
+        self._on_save(taskName, locationKey, state)
+
+
+class EventPlanner(object):
+    """
+    Plans the tweets of the solar and lunar tasks ahead of time, so that no
+    ephemeris is computed when a tweet is due. Once a day, on a thread of its
+    own, the ephemerides of all served locations over the next days are
+    computed in batches: the moon times in one request to the ephemeris
+    pool, the solar times of the locations the solar table lacks in one
+    table. The tasks are then run on a virtual clock over the next two days,
+    starting from the states they saved, and every tweet they send is kept
+    with its send time. The plan is sorted by send time and written to
+    data/plan/plan.json, from which a restart resumes when it is recent.
+
+    A release job sleeps until the next tweet of the plan is due, tweets it,
+    and saves the state the task would have saved. A tweet is not sent once
+    it is more than an hour late, e.g. after a long outage, like the tasks
+    themselves would not send it.
+    """
+
+    LOGGER = logging.getLogger()
+    TASK_NAMES = ("solartime", "lunartime")
+    _THREAD_NAME = "eventplan"
+    _RELEASE_JOB_NAME = "eventrelease"
+    _DIR_NAME = "plan"
+    _PLAN_FILE_NAME = "plan.json"
+    _TEMP_SUFFIX = ".tmp"
+    # Twice the planning interval, so a late or failed planning never leaves a gap
+    _HORIZON_SECONDS = 2 * 24 * 3600
+    _PLAN_INTERVAL_SECONDS = 24 * 3600
+    # The local dates the lunar tasks look up while planning, relative to the first one: the day
+    # before it, the days of the horizon and the two after the last one, for the next transit
+    _LUNAR_DAY_OFFSETS = range(-1, _HORIZON_SECONDS // (24 * 3600) + 3)
+    _RETRY_SECONDS = 300
+    # The tasks tweet at most an hour before the event, so an hour late is after the event
+    _LATE_SECONDS = 3600
+    _PLAN_SECONDS = REGISTRY.histogram("wxbot_event_plan_seconds", "Time spent planning solar and lunar tweets")
+    _PLANNED_TWEETS = REGISTRY.gauge("wxbot_planned_tweets", "Planned solar and lunar tweets not yet sent")
+
+    def __init__(self,
+                 scheduler: Scheduler,
+                 stateStore: StateStore,
+                 getLocations: Callable[[], List[Location]],
+                 taskNames: List[str] = TASK_NAMES,
+                 solarTable: SolarTimeTable = None,
+                 ephemeris: EphemerisPool = None,
+                 subDirName: str = None):
+        """
+        Constructor for the Event Planner.
+
+        Parameters:
+            scheduler (Scheduler): Runs the release of the tweets
+            stateStore (StateStore): Where the tasks keep their state
+            getLocations (callable): Returns the locations to plan for
+            taskNames (str[]): (optional) The tasks to plan, out of solartime and lunartime
+            solarTable (SolarTimeTable): (optional) Precomputed solar times for the solar task
+            ephemeris (EphemerisPool): (optional) Computes the ephemerides in worker processes
+            subDirName (str): (optional) Keeps the plan in this directory under data/plan
+        """
+        self._scheduler = scheduler
+        self._clock = scheduler.getClock()
+        self._state_store = stateStore
+        self._get_locations = getLocations
+        self._task_names = tuple(taskNames)
+        self._solar_table = solarTable
+        self._ephemeris = ephemeris
+        self._plan_path = Path.joinpath(initDataDir(self._DIR_NAME, subDirName), self._PLAN_FILE_NAME)
+        self._lock = threading.Lock()
+        self._replan = threading.Event()
+        self._tweets = deque()
+        self._planned_at = None
+        self._release_job: ScheduledJob = None
+
+
+    def isPlanned(self, taskName: str) -> bool:
+        """ Whether the tweets of the task are planned, rather than sent by the task itself """
+        return taskName in self._task_names
+
+
+    def start(self) -> None:
+        """
+        Resume from the saved plan when it is recent and was made for the
+        same locations and settings, else plan right away.
+        """
+
+        now = self._clock.time()
+        plan = self._load()
+        delay_seconds = 0
+        if (plan is not None
+         and plan["fingerprint"] == self._getFingerprint(self._get_locations())
+         and plan["plannedAt"] <= now < plan["plannedAt"] + self._PLAN_INTERVAL_SECONDS):
+            tweets = [tweet for tweet in plan["tweets"] if tweet.sendAt >= now - self._LATE_SECONDS]
+            self.LOGGER.info("Resuming the plan of {} with {} tweet(s) to send".format(self._plan_path, len(tweets)))
+            self._setPlan(plan["plannedAt"], tweets)
+            delay_seconds = plan["plannedAt"] + self._PLAN_INTERVAL_SECONDS - now
+        thread = threading.Thread(name=self._THREAD_NAME, target=self._planLoop, args=(delay_seconds,))
+        thread.daemon = True
+        thread.start()
+
+
+    def replan(self) -> None:
+        """ Plan again right away, e.g. after the served locations or the hashtag changed """
+        self._replan.set()
+
+
+    def _planLoop(self, delaySeconds: float) -> None:
+        """ Routine that plans on its own thread, so a planning does not hold up a worker of the scheduler """
+        while True:
+            self._replan.wait(delaySeconds)
+            # A replan asked for while planning plans once more
+            self._replan.clear()
+            delaySeconds = self._planStep()
+
+
+    def _planStep(self) -> float:
+        planned_at = self._clock.time()
+        locations = self._get_locations()
+        try:
+            with self._PLAN_SECONDS.time():
+                tweets = self._plan(locations, planned_at)
+            self._save(planned_at, self._getFingerprint(locations), tweets)
+        except Exception:
+            self.LOGGER.exception("Problem occurred while planning tweets, the current plan is kept")
+            return self._RETRY_SECONDS
+
+        self.LOGGER.info("Planned {} tweet(s) for {} location(s) over the next {:.0f} hours".format(
+            len(tweets), len(locations), self._HORIZON_SECONDS / 3600))
+        self._setPlan(planned_at, tweets)
+        return self._PLAN_INTERVAL_SECONDS
+
+
+    def _plan(self, locations: List[Location], plannedAt: float) -> List[PlannedTweet]:
+        clock = VirtualClock(plannedAt)
+        scheduler = VirtualScheduler(clock)
+        tweets: List[PlannedTweet] = list()
+        # The tweet each task and location sent last, which the state saved next belongs to
+        last_tweets: Dict[Tuple[str, str], int] = {}
+
+        def onSave(taskName: str, locationKey: str, state: Dict) -> None:
+            index = last_tweets.pop((taskName, locationKey), None)
+            if (index is not None):
+                tweets[index] = replace(tweets[index], state=state)
+
+        state_store = _PlanningStateStore(self._state_store, onSave)
+        solar_table = self._computeEphemerides(locations, plannedAt)
+        for location in locations:
+            for task_name in self._task_names:
+                def publish(message: str, idempotencyKey: str, location=location, task_name=task_name) -> None:
+                    last_tweets[(task_name, location.key)] = len(tweets)
+                    tweets.append(PlannedTweet(clock.time(), task_name, location.key, message, idempotencyKey, None))
+
+                if (task_name == "solartime"):
+                    table = self._solar_table if self._hasSolarTimes(location) else solar_table
+                    SolarTimeTask(scheduler, location, state_store, table, self._ephemeris, publish)
+                else:
+                    LunarTimeTask(scheduler, location, state_store, self._ephemeris, publish)
+
+        scheduler.runUntil(plannedAt + self._HORIZON_SECONDS)
+        return tweets
+
+
+    def _computeEphemerides(self, locations: List[Location], plannedAt: float) -> Optional[SolarTimeTable]:
+        """
+        Compute the ephemerides the tasks look up while planning in batches,
+        rather than one location and day at a time as the tasks would.
+
+        Returns:
+            SolarTimeTable: The solar times of the locations the solar table lacks, None when there are none
+        """
+
+        solar_table = None
+        if ("solartime" in self._task_names):
+            missing = [location for location in locations if not self._hasSolarTimes(location)]
+            if (missing):
+                solar_table = SolarTimeTable(missing)
+
+        if ("lunartime" in self._task_names):
+            requests = list()
+            for location in locations:
+                first_day = datetime.fromtimestamp(plannedAt, location.getTimeZone()).date()
+                requests.extend((location, first_day + timedelta(days=offset)) for offset in self._LUNAR_DAY_OFFSETS)
+            LunarTimeTask.prefetchMoonTimes(requests, plannedAt, self._ephemeris)
+        return solar_table
+
+
+    def _hasSolarTimes(self, location: Location) -> bool:
+        return self._solar_table is not None and self._solar_table.contains(location)
+
+
+    def _setPlan(self, plannedAt: float, tweets: List[PlannedTweet]) -> None:
+        with self._lock:
+            if (self._planned_at is not None and plannedAt < self._planned_at):
+                # A planning that started earlier finished later
+                return
+            self._planned_at = plannedAt
+            self._tweets = deque(sorted(tweets, key=lambda tweet: tweet.sendAt))
+            self._PLANNED_TWEETS.set(len(self._tweets))
+            # The first tweet of the new plan may be due before the release job would wake up
+            if (self._release_job is not None):
+                self._scheduler.cancel(self._release_job)
+            self._release_job = self._scheduler.schedule(self._RELEASE_JOB_NAME, self._releaseStep)
+
+
+    def _releaseStep(self) -> float:
+        now = self._clock.time()
+        due = list()
+        with self._lock:
+            while (self._tweets and self._tweets[0].sendAt <= now):
+                due.append(self._tweets.popleft())
+            next_send_at = self._tweets[0].sendAt if self._tweets else None
+            self._PLANNED_TWEETS.set(len(self._tweets))
+
+        if (due):
+            # A location may have moved to another replica since the plan was made
+            served = set(location.key for location in self._get_locations())
+            for tweet in due:
+                if (tweet.locationKey not in served):
+                    continue
+                if (now - tweet.sendAt > self._LATE_SECONDS):
+                    self.LOGGER.warning("Not sending the tweet planned as {}, it is {:.0f} seconds late".format(
+                        tweet.idempotencyKey, now - tweet.sendAt))
+                    continue
+                self.LOGGER.info("Sending the tweet planned as " + tweet.idempotencyKey)
+                TwitterUtil.tweet(tweet.message, tweet.idempotencyKey)
+                if (tweet.state is not None):
+                    self._state_store.save(tweet.taskName, tweet.locationKey, tweet.state)
+
+        if (next_send_at is None):
+            # The next planning schedules the release again
+            return self._PLAN_INTERVAL_SECONDS
+        return next_send_at - now
+
+
+    def _getFingerprint(self, locations: List[Location]) -> str:
+        # Identifies what a plan depends on besides the time and the states
+        description = json.dumps([sorted(self._task_names),
+                                  getConfig().formatHashtag(),
+                                  sorted(json.dumps(asdict(location), sort_keys=True) for location in locations)])
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+    def _load(self) -> Optional[Dict]:
+        if (not self._plan_path.exists()):
+            return None
+        try:
+            with open(self._plan_path, "r") as fp:
+                document = json.load(fp)
+            return {
+                "plannedAt": float(document["plannedAt"]),
+                "fingerprint": document["fingerprint"],
+                "tweets": [PlannedTweet(**tweet) for tweet in document["tweets"]]
+            }
+        except (KeyError, TypeError, ValueError):
+            self.LOGGER.warning("Ignoring the unreadable plan " + str(self._plan_path))
+            return None
+
+
+    def _save(self, plannedAt: float, fingerprint: str, tweets: List[PlannedTweet]) -> None:
+        plan = {
+            "plannedAt": plannedAt,
+            "fingerprint": fingerprint,
+            "tweets": [asdict(tweet) for tweet in tweets]
+        }
+        temp_path = Path(str(self._plan_path) + self._TEMP_SUFFIX)
+        with open(temp_path, "w") as fw:
+            json.dump(plan, fw)
+            fw.flush()
+            os.fsync(fw.fileno())
+        os.replace(temp_path, self._plan_path)
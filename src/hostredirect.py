@@ -0,0 +1,29 @@
+from requests import PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+
+
+class HostRedirectAdapter(HTTPAdapter):
+    """
+    Sends the requests of a session that start with one base URL to another
+    base URL instead, e.g. to point a client library whose host cannot be
+    configured at a local stand-in server. Mount it on the session for the
+    base URL being replaced.
+    """
+
+    def __init__(self, fromUrl: str, toUrl: str):
+        """
+        Constructor for the Host Redirect Adapter.
+
+        Parameters:
+            fromUrl (str): The base URL being replaced, e.g. https://api.twitter.com
+            toUrl (str): The base URL requests are sent to instead
+        """
+        super().__init__()
+        self._from_url = fromUrl.rstrip("/")
+        self._to_url = toUrl.rstrip("/")
+
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        if (request.url.startswith(self._from_url)):
+            request.url = self._to_url + request.url[len(self._from_url):]
+        return super().send(request, **kwargs)
@@ -0,0 +1,119 @@
+import json
+import re
+
+from dataclasses import dataclass
+from envvarname import EnvVarName
+from pathlib import Path
+from pytz import timezone
+from typing import List
+from util import getAppRootDir, getEnvVar, isEmpty
+
+
+@dataclass(frozen=True)
+class Location():
+    """
+    A place that the bot reports on.
+
+    Fields:
+        key (string): Unique identifier of the location, names its data directory
+            (empty for the single location configured by environment variables)
+        name (string): A label for the location, used in messages
+        region (string): A label for the location's region
+        timezone (string): The timezone name from the "tz database"
+        latitude (float): Latitude in decimal degrees
+        longitude (float): Longitude in decimal degrees
+    """
+
+    key: str
+    name: str
+    region: str
+    timezone: str
+    latitude: float
+    longitude: float
+
+    def getTimeZone(self):
+        return timezone(self.timezone)
+
+
+# Keys name directories and files, so they must not be able to reach outside the data directory
+_KEY_PATTERN = re.compile(r'^[a-z0-9-]+$')
+
+
+def loadLocations() -> List[Location]:
+    """
+    Load the set of locations the application serves. When the LOCATIONS_FILE
+    environment variable is set the locations are read from that file,
+    otherwise the single location described by the LOCATION, REGION, TIMEZONE,
+    LATITUDE and LONGITUDE environment variables is used.
+
+    Returns:
+        Location[]: The locations, in the order they were defined
+    """
+
+    locations_file = getEnvVar(EnvVarName.LOCATIONS_FILE)
+    if isEmpty(locations_file):
+        return [_loadLocationFromEnvVars()]
+
+    return loadLocationsFile(Path.joinpath(getAppRootDir(), locations_file))
+
+
+def loadLocationsFile(filePath: Path) -> List[Location]:
+    """
+    Load locations from a JSON file containing a list of objects with the keys
+    "name", "region", "timezone", "latitude", "longitude" and optionally "key".
+
+    Parameters:
+        filePath (Path): The path of the locations file
+
+    Returns:
+        Location[]: The locations, in the order they appear in the file
+    """
+
+    with open(filePath, 'r') as fp:
+        entries = json.load(fp)
+
+    locations = []
+    keys = set()
+    for index, entry in enumerate(entries):
+        for field in ("name", "timezone", "latitude", "longitude"):
+            if (field not in entry or isEmpty(str(entry[field]))):
+                raise RuntimeError("Location #" + str(index + 1) + " in " + str(filePath) + " is missing: " + field)
+
+        key = entry.get("key")
+        if (key is None or (isinstance(key, str) and isEmpty(key))):
+            key = _slugify(entry["name"])
+            if isEmpty(key):
+                raise RuntimeError("Location #" + str(index + 1) + " in " + str(filePath)
+                                   + " needs a key, none can be derived from its name: " + entry["name"])
+        if (not isinstance(key, str) or not _KEY_PATTERN.match(key)):
+            raise RuntimeError("Location key '" + str(key) + "' in " + str(filePath)
+                               + " may only contain lowercase letters, digits and dashes")
+        if (key in keys):
+            raise RuntimeError("Location key '" + key + "' is used more than once in " + str(filePath))
+        keys.add(key)
+
+        locations.append(Location(key,
+                                  entry["name"],
+                                  entry.get("region"),
+                                  entry["timezone"],
+                                  float(entry["latitude"]),
+                                  float(entry["longitude"])))
+
+    return locations
+
+
+def _loadLocationFromEnvVars() -> Location:
+    for name in (EnvVarName.LOCATION, EnvVarName.TIMEZONE, EnvVarName.LATITUDE, EnvVarName.LONGITUDE):
+        if isEmpty(getEnvVar(name)):
+            raise RuntimeError("Missing required environment variable: " + name.name)
+
+    return Location("",
+                    getEnvVar(EnvVarName.LOCATION),
+                    getEnvVar(EnvVarName.REGION),
+                    getEnvVar(EnvVarName.TIMEZONE),
+                    float(getEnvVar(EnvVarName.LATITUDE)),
+                    float(getEnvVar(EnvVarName.LONGITUDE)))
+
+
+def _slugify(name: str) -> str:
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
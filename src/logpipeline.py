@@ -0,0 +1,126 @@
+import copy
+import json
+import logging
+import queue
+import time
+
+from datetime import datetime, tzinfo
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+
+
+class TimeZoneConverter(object):
+    """
+    Converts the timestamps of log records to a time zone that is resolved
+    once, instead of for every record.
+    """
+
+    def __init__(self, tz: tzinfo):
+        self._tz = tz
+
+
+    def __call__(self, timestamp: float = None) -> time.struct_time:
+        if (timestamp is None):
+            timestamp = time.time()
+        return datetime.fromtimestamp(timestamp, self._tz).timetuple()
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats each log record as a JSON object on a single line.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "thread": record.threadName,
+            "level": record.levelname,
+            "message": record.getMessage()
+        }
+        if (record.exc_info):
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Puts log records on a queue, merging their arguments into the message
+    first, since the arguments may change once the record has been queued.
+    Unlike the standard QueueHandler, exceptions are left to the writer
+    thread to format, so the formatters there still see them.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogPipeline(object):
+    """
+    Keeps the threads that log from waiting on the log file. The root logger
+    only puts records on a queue, and a single writer thread formats them and
+    writes them to the file, rotating it by size when asked to.
+    """
+
+    _TEXT_FORMAT = "%(asctime)s | %(threadName)-12.12s | %(levelname)-8.8s | %(message)s"
+    _ENCODING = "utf-8"
+
+    def __init__(self,
+                 logFile: Path,
+                 level,
+                 tz: tzinfo,
+                 jsonLines: bool = False,
+                 maxBytes: int = 0,
+                 backupCount: int = 0):
+        """
+        Constructor for the Log Pipeline.
+
+        Parameters:
+            logFile (Path): The file the records are written to
+            level (int|str): The level of the root logger
+            tz (tzinfo): The time zone the record times are written in
+            jsonLines (bool): (optional) Write one JSON object per record instead of text
+            maxBytes (int): (optional) Rotate the file once it reaches this size, never when 0
+            backupCount (int): (optional) The number of rotated files that are kept
+        """
+        if (jsonLines):
+            formatter = JsonLinesFormatter()
+        else:
+            formatter = logging.Formatter(self._TEXT_FORMAT)
+        formatter.converter = TimeZoneConverter(tz)
+
+        file_handler = RotatingFileHandler(logFile, maxBytes=maxBytes, backupCount=backupCount, encoding=self._ENCODING)
+        file_handler.setFormatter(formatter)
+
+        self._queue = queue.SimpleQueue()
+        self._listener = QueueListener(self._queue, file_handler, respect_handler_level=True)
+        self._handler = RecordQueueHandler(self._queue)
+        self._level = level
+
+
+    def start(self) -> logging.Logger:
+        """
+        Route the records of the root logger through the pipeline.
+
+        Returns:
+            Logger: The root logger
+        """
+
+        logger = logging.getLogger()
+        logger.setLevel(self._level)
+        logger.addHandler(self._handler)
+        self._listener.start()
+        return logger
+
+
+    def stop(self) -> None:
+        """
+        Write the records still queued and stop the writer thread.
+        """
+
+        logging.getLogger().removeHandler(self._handler)
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
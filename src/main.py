@@ -1,4 +1,5 @@
 import argparse
+import atexit
 import logging
 import os
 import threading
@@ -6,76 +7,456 @@ import time
 import signal
 import sys
 
-from datetime import datetime
+from datetime import date
 from pathlib import Path
 from pytz import timezone, utc
+from typing import Dict, List
 
 MIN_PYTHON = (3, 8)
 if sys.version_info < MIN_PYTHON:
     sys.exit("Python %s.%s or later is required.\n" % MIN_PYTHON)
 
-from const import APP_ROOT_DEFAULT
-from envvarname import EnvVarName
-from tasks.airquality import AirQualityTask
-from tasks.lunartime import LunarTimeTask
-from tasks.solartime import SolarTimeTask
-from util import getEnvVar, getLogDir, isEmpty, loadEnvVars
+# Their default action ends the process, so they are ignored until their handlers are installed
+for signal_name in ("SIGHUP", "SIGUSR1", "SIGUSR2"):
+    if (hasattr(signal, signal_name)):
+        signal.signal(getattr(signal, signal_name), signal.SIG_IGN)
 
+from startup import StartupTimer
+STARTUP = StartupTimer()
 
-def createLogger():
+with STARTUP.phase("core"):
+    # The tasks, and the packages they depend on, are only imported when enabled
+    from config import Config, getConfig, loadConfig, setConfig
+    from const import APP_ROOT_DEFAULT
+    from location import Location
+    from logpipeline import LogPipeline
+    from metrics import MetricsServer
+    from profiling import AllocationTracer, TaskProfiler
+    from scheduler import ScheduledJob, Scheduler
+    from statestore import SQLiteStateBackend, StateStore
+    from twitter import TwitterUtil
+    from util import getLogDir, isEmpty, loadEnvVars
+
+
+def createLogger(config: Config):
     log_directory = getLogDir()
-    log_filename = Path.joinpath(log_directory, "wxtwitterbot.log")
+    log_filename = Path.joinpath(log_directory, "wxtwitterbot.log" if config.logFormat == "text" else "wxtwitterbot.jsonl")
     os.makedirs(os.path.dirname(log_filename), exist_ok=True)
 
-    log_format = "%(asctime)s | %(threadName)-12.12s | %(levelname)-8.8s | %(message)s"
+    tz = utc
+    if (not isEmpty(config.timezone)):
+        tz = timezone(config.timezone)
+
+    pipeline = LogPipeline(log_filename,
+                           config.logLevel,
+                           tz,
+                           jsonLines=(config.logFormat == "json"),
+                           maxBytes=config.logMaxBytes,
+                           backupCount=config.logBackupCount)
+    # Records still queued are written when the application exits
+    atexit.register(pipeline.stop)
+    return pipeline.start()
+
+
+def createScheduler() -> Scheduler:
+    workers = getConfig().schedulerWorkers
+    if (workers is None):
+        return Scheduler(profiler=PROFILER)
+    return Scheduler(workers, PROFILER)
+
+
+def addDiagnosticRoutes(server: MetricsServer) -> None:
+    def profile(query):
+        task_names = query.get("tasks", ",".join(PROFILED_TASKS)).split(",")
+        seconds = float(query.get("seconds", getConfig().profileSeconds))
+        PROFILER.start(task_names, seconds)
+        return "Profiling {} for {:.0f} seconds, the result will be logged and written to data/profiles\n".format(
+            ", ".join(task_names), seconds)
+
+    def allocations(query):
+        if (query.get("action", "snapshot") == "stop"):
+            return ALLOCATIONS.stop() + "\n"
+        return ALLOCATIONS.snapshot() + "\n"
+
+    server.addRoute("/debug/profile", profile)
+    server.addRoute("/debug/allocations", allocations)
+
+
+def createStateStore() -> StateStore:
+    if (getConfig().stateBackend == "sqlite"):
+        return StateStore(backend=SQLiteStateBackend())
+    return StateStore()
+
+
+def startMetricsServer() -> MetricsServer:
+    config = getConfig()
+    if (config.metricsPort is None):
+        return None
+
+    server = MetricsServer(config.metricsAddress, config.metricsPort)
+    server.start()
+    return server
+
+
+def createEphemerisPool():
+    processes = getConfig().ephemerisProcesses
+    if (processes == 0):
+        return None
+
+    from ephemeris import EphemerisPool, isProcessPoolSupported
+    if (not isProcessPoolSupported()):
+        LOGGER.warning("Worker processes cannot be forked on this platform, ephemerides are computed in process")
+        return None
+    return EphemerisPool(processes)
+
+
+def getSolarTable():
+    global SOLAR_TABLE
+    from solartable import SolarTimeTable
+
+    if (SOLAR_TABLE is None):
+        # Covers the locations served at startup, locations added by a reload are computed as needed
+        SOLAR_TABLE = SolarTimeTable(getConfig().locations)
+    return SOLAR_TABLE
 
-    log_level = getEnvVar(EnvVarName.LOG_LEVEL)
-    if (log_level is None):
-        log_level = logging.INFO  # Default logging level
+
+def createSolarTimeTask(location: Location) -> None:
+    from tasks.solartime import SolarTimeTask
+
+    SolarTimeTask(SCHEDULER, location, STATE_STORE, getSolarTable(), EPHEMERIS, createPublisher(location))
+
+
+def createLunarTimeTask(location: Location) -> None:
+    from tasks.lunartime import LunarTimeTask
+
+    LunarTimeTask(SCHEDULER, location, STATE_STORE, EPHEMERIS, createPublisher(location))
+
+
+def createAirQualityTask(location: Location) -> None:
+    global AIRNOW
+    from tasks.airquality import AirQualityTask
+
+    if (AIRNOW is None):
+        AIRNOW = createAirNowFetcher(AirQualityTask.EXECUTION_INTERVAL_SECONDS)
+    AirQualityTask(SCHEDULER, location, STATE_STORE, AIRNOW, createPublisher(location))
+
+
+def createAirNowFetcher(cycleSeconds: float):
+    from airnow import AirNowFetcher
+    from observationlog import ObservationLog
+    from polling import AdaptivePollingPolicy
+
+    config = getConfig()
+    polling_policy = None
+    if (config.airNowAdaptivePolling):
+        polling_policy = AdaptivePollingPolicy()
+    observation_log = None
+    if (config.airNowObservationLog):
+        # Ids are assigned by each process, so replicas sharing the data directory each keep their own log
+        observation_log = ObservationLog(subDirName=None if config.shardCount is None else config.replicaId)
+    return AirNowFetcher(config.airNowApiKey,
+                         cycleSeconds,
+                         pollingPolicy=polling_policy,
+                         observationLog=observation_log,
+                         timeoutSeconds=config.airNowTimeoutSeconds,
+                         hedgePercentile=config.airNowHedgePercentile,
+                         apiUrl=config.airNowApiUrl)
+
+
+def createShardCoordinator():
+    config = getConfig()
+    if (config.shardCount is None):
+        return None
+
+    from sharding import FileLeaseStore, ShardCoordinator, SQLiteLeaseStore
+    if (config.stateBackend == "sqlite"):
+        lease_store = SQLiteLeaseStore()
     else:
-        log_level = log_level.upper()
+        lease_store = FileLeaseStore()
+    LOGGER.info("Sharing {} shard(s) with the other replicas as {}".format(config.shardCount, config.replicaId))
+    return ShardCoordinator(lease_store, config.replicaId, config.shardCount, config.shardLeaseSeconds)
 
-    logging.Formatter.converter = loggingFormatterTZ
-    logging.basicConfig(
-        filename=log_filename,
-        format=log_format,
-        level=log_level)
-    return logging.getLogger()
 
+def createEventPlanner():
+    config = getConfig()
+    if (not config.eventPlanning):
+        return None
+
+    from eventplan import EventPlanner
+    task_names = [task_name for task_name in config.enabledTasks if task_name in EventPlanner.TASK_NAMES]
+    if (not task_names):
+        return None
+    solar_table = getSolarTable() if "solartime" in task_names else None
+    # Replicas share the data directory, so each one keeps its own plan
+    sub_dir_name = None if config.shardCount is None else config.replicaId
+    return EventPlanner(SCHEDULER,
+                        STATE_STORE,
+                        lambda: [location for location in getConfig().locations if isServed(location)],
+                        task_names,
+                        solar_table,
+                        EPHEMERIS,
+                        sub_dir_name)
+
+
+def isPlanned(taskName: str) -> bool:
+    return PLANNER is not None and PLANNER.isPlanned(taskName)
+
+
+def createTweetLedger():
+    from tweetledger import FileTweetLedger, SQLiteTweetLedger
+
+    if (getConfig().stateBackend == "sqlite"):
+        return SQLiteTweetLedger()
+    return FileTweetLedger()
 
-def loggingFormatterTZ(*args):
-    tzString = getEnvVar(EnvVarName.TIMEZONE)
-    tz = utc
-    if (not isEmpty(tzString)):
-        tz = timezone(tzString)
-    return datetime.now(tz).timetuple()
+
+def isServed(location: Location) -> bool:
+    return SHARDS is None or SHARDS.isServed(location)
+
+
+def createPublisher(location: Location):
+    if (SHARDS is None):
+        return None
+
+    def publish(message: str, idempotencyKey: str) -> None:
+        # A step may run after the lease on its shard lapsed, e.g. after a long pause, while another replica serves it
+        if (not isServed(location)):
+            LOGGER.warning("Not tweeting about {}, this replica no longer holds the lease on its shard".format(location.name))
+            return
+        TwitterUtil.tweet(message, idempotencyKey)
+    return publish
+
+
+def startTask(taskName: str, location: Location) -> List[ScheduledJob]:
+    known_jobs = set(SCHEDULER.jobs())
+    TASK_FACTORIES[taskName](location)
+    return [job for job in SCHEDULER.jobs() if job not in known_jobs]
+
+
+def startLocation(location: Location, taskNames: List[str]) -> None:
+    LOCATION_JOBS[location] = list()
+    for task_name in taskNames:
+        # The planner sends the tweets of planned tasks for every served location
+        if (not isPlanned(task_name)):
+            LOCATION_JOBS[location].extend(startTask(task_name, location))
+    LOGGER.info("Started serving " + location.name)
+
+
+def stopLocation(location: Location) -> None:
+    for job in LOCATION_JOBS.pop(location, []):
+        SCHEDULER.cancel(job)
+    # Another replica may serve the location next, so it must find the latest state
+    STATE_STORE.evict(location.key)
+    LOGGER.info("Stopped serving " + location.name)
+
+
+def serveShards(shards) -> None:
+    """
+    Start the locations of the shards this replica gained and stop the ones
+    of the shards it lost.
+    """
+
+    with LOCATION_LOCK:
+        for location in getConfig().locations:
+            if (location in LOCATION_JOBS and not isServed(location)):
+                stopLocation(location)
+            elif (location not in LOCATION_JOBS and isServed(location)):
+                startLocation(location, CONFIG.enabledTasks)
+        LOGGER.info("Serving {} location(s)".format(len(LOCATION_JOBS)))
+    if (PLANNER is not None):
+        PLANNER.replan()
+
+
+def reloadConfig() -> None:
+    """
+    Read the configuration again and apply it without a restart: locations
+    that were removed or changed have their jobs cancelled, and locations that
+    were added or changed get new ones. Every other task keeps running, with
+    its caches.
+    """
+
+    try:
+        loadEnvVars(args.app_root)
+        config = loadConfig()
+    except Exception:
+        LOGGER.exception("Problem occurred while reloading the configuration, the current one is kept")
+        return
+
+    previous = setConfig(config)
+    logging.getLogger().setLevel(config.logLevel)
+    restart_required = config.getRestartRequiredChanges(previous)
+    if (restart_required):
+        LOGGER.warning("Changes to these settings take effect after a restart: " + ", ".join(restart_required))
+
+    removed = [location for location in previous.locations if location not in config.locations]
+    added = [location for location in config.locations if location not in previous.locations]
+    with LOCATION_LOCK:
+        for location in removed:
+            if (location in LOCATION_JOBS):
+                stopLocation(location)
+        for location in added:
+            # With shards, only the replica holding the shard of the location serves it
+            if (isServed(location)):
+                startLocation(location, previous.enabledTasks)
+        LOGGER.info("Configuration reloaded, serving {} location(s)".format(len(LOCATION_JOBS)))
+    if (PLANNER is not None):
+        # The locations or the hashtag may have changed
+        PLANNER.replan()
+
+
+def startOutbox() -> None:
+    config = getConfig()
+    # Replicas share the data directory, so each one keeps its own journal
+    sub_dir_name = None if config.shardCount is None else config.replicaId
+    if (config.outboxConcurrency is None):
+        TwitterUtil.startOutbox(subDirName=sub_dir_name)
+    else:
+        TwitterUtil.startOutbox(config.outboxConcurrency, sub_dir_name)
+
+
+def runSimulation(start: date, end: date, outputPath: Path) -> int:
+    from simulation import Simulation
+
+    report = Simulation(list(getConfig().locations), start, end, outputPath).run()
+
+    print("Simulated {days:.0f} day(s) of {locations} location(s) in {wall_seconds:.2f} seconds".format(**report))
+    print("Steps: {steps} ({steps_per_second:.0f} per second)".format(**report))
+    print("Tweets: {} (written to {})".format(report["tweets"], outputPath))
+    for kind in ("missed", "duplicates", "unexpected", "stalled"):
+        print("{}: {}".format(kind.capitalize(), len(report[kind])))
+        for finding in report[kind]:
+            print("  " + str(finding))
+            LOGGER.warning("Simulation found {}: {}".format(kind, finding))
+
+    has_problems = report["missed"] or report["duplicates"] or report["unexpected"] or report["stalled"]
+    return 1 if has_problems else 0
 
 
 def sigintHandler(sig, frame):
     LOGGER.info("Shutting down, goodbye!")
+    # Steps that are running complete before their state is written
+    SCHEDULER.stop()
+    STATE_STORE.close()
+    if (SHARDS is not None):
+        # The states are written, so the other replicas may take the shards over right away
+        SHARDS.release()
+    TwitterUtil.stopOutbox()
+    if (LEDGER is not None):
+        LEDGER.close()
+    if (EPHEMERIS is not None):
+        EPHEMERIS.close()
     sys.exit(0)
 
 
+def profileHandler(sig, frame):
+    try:
+        PROFILER.start(PROFILED_TASKS, getConfig().profileSeconds)
+    except RuntimeError as e:
+        LOGGER.warning(str(e))
+
+
+def allocationsHandler(sig, frame):
+    ALLOCATIONS.snapshot()
+
+
+def reloadHandler(sig, frame):
+    LOGGER.info("Reloading the configuration")
+    reloadConfig()
+
+
 def threadExceptionHook(args):
     LOGGER.error(str(args.exc_value))
 
 
 ### MAIN ###
+TASK_FACTORIES = {
+    "solartime": createSolarTimeTask,
+    "lunartime": createLunarTimeTask,
+    "airquality": createAirQualityTask
+}
+PROFILED_TASKS = tuple(TASK_FACTORIES)
+SOLAR_TABLE = None
+AIRNOW = None
+SHARDS = None
+LEDGER = None
+PLANNER = None
+LOCATION_LOCK = threading.RLock()
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--app-root', type=Path, default=APP_ROOT_DEFAULT, help='path to application root directory')
+parser.add_argument('--simulate', nargs=2, type=date.fromisoformat, metavar=('START', 'END'),
+                    help='simulate the solar and lunar tasks from START to END (YYYY-MM-DD) instead of running')
+parser.add_argument('--simulate-output', type=Path, default=None, help='file that receives the simulated tweets')
 args = parser.parse_args()
-loadEnvVars(args.app_root)
-LOGGER = createLogger()  # Requires that environment variables are loaded
+with STARTUP.phase("config"):
+    loadEnvVars(args.app_root)
+    setConfig(loadConfig())  # Requires that environment variables are loaded
+    LOGGER = createLogger(getConfig())
 threading.excepthook = threadExceptionHook
-signal.signal(signal.SIGINT, sigintHandler)
+
+if (args.simulate is not None):
+    output_path = args.simulate_output
+    if (output_path is None):
+        output_path = Path.joinpath(getLogDir(), "simulation.jsonl")
+    sys.exit(runSimulation(args.simulate[0], args.simulate[1], output_path))
+
+with STARTUP.phase("ephemeris"):
+    # Forks its workers, so it comes before the scheduler, metrics and outbox threads start
+    EPHEMERIS = createEphemerisPool()
+
+PROFILER = TaskProfiler()
+ALLOCATIONS = AllocationTracer()
+
+with STARTUP.phase("metrics"):
+    METRICS_SERVER = startMetricsServer()
+    if (METRICS_SERVER is not None):
+        addDiagnosticRoutes(METRICS_SERVER)
+with STARTUP.phase("state"):
+    SCHEDULER = createScheduler()
+    STATE_STORE = createStateStore()
+    STATE_STORE.start(SCHEDULER)
+with STARTUP.phase("outbox"):
+    LEDGER = createTweetLedger()
+    TwitterUtil.useLedger(LEDGER)
+    startOutbox()
+with STARTUP.phase("shards"):
+    SHARDS = createShardCoordinator()
+    if (SHARDS is not None):
+        SHARDS.refresh()
+with STARTUP.phase("plan"):
+    PLANNER = createEventPlanner()
+    if (PLANNER is not None):
+        PLANNER.start()
 
 LOGGER.info("Application initialization complete!")
 
-SolarTimeTask()
-LunarTimeTask()
-AirQualityTask()
+CONFIG = getConfig()
+
+# The jobs of each served location, so that a reload or a lost shard can stop them
+LOCATION_JOBS: Dict[Location, List[ScheduledJob]] = {location: list() for location in CONFIG.locations if isServed(location)}
+LOGGER.info("Serving {} of {} location(s)".format(len(LOCATION_JOBS), len(CONFIG.locations)))
+for task_name in CONFIG.enabledTasks:
+    if (isPlanned(task_name)):
+        continue
+    with STARTUP.phase(task_name):
+        for location in LOCATION_JOBS:
+            LOCATION_JOBS[location].extend(startTask(task_name, location))
+if (SHARDS is not None):
+    SHARDS.start(serveShards)
+
+# The handlers use the scheduler, the state store and the jobs of the locations, so they wait until all exist
+signal.signal(signal.SIGINT, sigintHandler)
+# What docker stop and Kubernetes send to the main process
+signal.signal(signal.SIGTERM, sigintHandler)
+if (hasattr(signal, "SIGUSR1")):
+    signal.signal(signal.SIGUSR1, profileHandler)
+    signal.signal(signal.SIGUSR2, allocationsHandler)
+if (hasattr(signal, "SIGHUP")):
+    signal.signal(signal.SIGHUP, reloadHandler)
+SCHEDULER.start()
 
-LOGGER.info("All tasks have been delegated to background threads.")
+LOGGER.info("All tasks have been delegated to the scheduler: " + ", ".join(CONFIG.enabledTasks))
+LOGGER.info(STARTUP.report())
 
 while True:
     # Keep this thread alive so it can be used to terminate the application
@@ -0,0 +1,278 @@
+import logging
+import math
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+def _labelKey(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _formatLabels(key: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if (not pairs):
+        return ""
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _formatValue(value: float) -> str:
+    if (math.isinf(value)):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Counter(object):
+    """
+    A value that only goes up, kept per set of labels.
+    """
+
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, float] = {}
+
+
+    def inc(self, labels: Dict[str, str] = None, amount: float = 1) -> None:
+        key = _labelKey(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            return [self.name + _formatLabels(key) + " " + _formatValue(value) for key, value in self._values.items()]
+
+
+class Gauge(object):
+    """
+    A value that can be set to anything, kept per set of labels.
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, float] = {}
+
+
+    def set(self, value: float, labels: Dict[str, str] = None) -> None:
+        with self._lock:
+            self._values[_labelKey(labels)] = value
+
+
+    def remove(self, labels: Dict[str, str] = None) -> None:
+        with self._lock:
+            self._values.pop(_labelKey(labels), None)
+
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            return [self.name + _formatLabels(key) + " " + _formatValue(value) for key, value in self._values.items()]
+
+
+class Histogram(object):
+    """
+    Counts observations, such as durations, into cumulative buckets per set of labels.
+    """
+
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        # Per set of labels: the count of each bucket, the sum and the count
+        self._values: Dict[Tuple, list] = {}
+
+
+    def observe(self, value: float, labels: Dict[str, str] = None) -> None:
+        key = _labelKey(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if (entry is None):
+                entry = [[0] * len(self._buckets), 0.0, 0]
+                self._values[key] = entry
+            for i, upper in enumerate(self._buckets):
+                if (value <= upper):
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+
+    @contextmanager
+    def time(self, labels: Dict[str, str] = None) -> Iterator[None]:
+        """
+        Observe how long the body of a with statement takes, even when it raises.
+
+        Parameters:
+            labels (Dict): (optional) The labels of the observation
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+
+    def collect(self) -> List[str]:
+        lines = list()
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for upper, bucket_count in zip(self._buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(self.name + "_bucket" + _formatLabels(key, (("le", _formatValue(upper)),)) + " " + str(cumulative))
+                lines.append(self.name + "_sum" + _formatLabels(key) + " " + _formatValue(total))
+                lines.append(self.name + "_count" + _formatLabels(key) + " " + str(count))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    Holds every metric of the process and renders them in the Prometheus
+    text exposition format. Asking for a metric that already exists returns
+    the existing one, so modules can declare the metrics they update.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._getOrCreate(Counter, name, documentation)
+
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._getOrCreate(Gauge, name, documentation)
+
+
+    def histogram(self, name: str, documentation: str) -> Histogram:
+        return self._getOrCreate(Histogram, name, documentation)
+
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = list()
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.TYPE))
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+    def _getOrCreate(self, metricClass, name: str, documentation: str):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if (metric is None):
+                metric = metricClass(name, documentation)
+                self._metrics[name] = metric
+            elif (not isinstance(metric, metricClass)):
+                raise ValueError("Metric " + name + " is already registered as a " + metric.TYPE)
+            return metric
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics of a registry over HTTP, at /metrics, from a background
+    thread. Further plain text pages, such as diagnostics, can be added as routes.
+    """
+
+    LOGGER = logging.getLogger()
+    _THREAD_NAME = "metrics"
+    _CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, address: str, port: int, registry: MetricsRegistry = REGISTRY):
+        """
+        Constructor for the Metrics Server.
+
+        Parameters:
+            address (str): The address to listen on
+            port (int): The port to listen on
+            registry (MetricsRegistry): (optional) The metrics to serve
+        """
+        self._routes: Dict[str, Callable[[Dict[str, str]], str]] = {"/metrics": lambda query: registry.render()}
+        routes = self._routes
+        logger = self.LOGGER
+        content_type = self._CONTENT_TYPE
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                route = routes.get(url.path)
+                if (route is None):
+                    self.send_error(404)
+                    return
+
+                query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                try:
+                    body = route(query).encode("utf-8")
+                    status = 200
+                except (RuntimeError, ValueError) as e:
+                    body = (str(e) + "\n").encode("utf-8")
+                    status = 400
+                except Exception:
+                    logger.exception("Problem occurred while serving " + url.path)
+                    self.send_error(500)
+                    return
+
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are too frequent to be worth logging
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(name=self._THREAD_NAME, target=self._server.serve_forever, args=())
+        self._thread.daemon = True
+
+
+    def addRoute(self, path: str, handler: Callable[[Dict[str, str]], str]) -> None:
+        """
+        Serve a plain text page.
+
+        Parameters:
+            path (str): The path of the page, e.g. /debug/profile
+            handler (callable): Receives the query parameters and returns the page;
+                a RuntimeError or ValueError it raises is answered as a bad request
+        """
+
+        self._routes[path] = handler
+
+
+    def start(self) -> None:
+        self._thread.start()
+        address, port = self._server.server_address[:2]
+        self.LOGGER.info("Serving metrics at http://{}:{}/metrics".format(address, port))
+
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,231 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from airnowpy import Category, Observation
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from pytz import utc
+from typing import Dict, List, Tuple
+from util import initDataDir
+
+
+@dataclass(frozen=True)
+class LoggedObservation():
+    """
+    An observation read back from the observation log.
+
+    Fields:
+        fetchedAt (datetime): When the observation was fetched, in UTC
+        timestamp (datetime): The hour of the observation, in UTC
+        reportingArea (str): City or area name of observed data
+        stateCode (str): Two-character state abbreviation
+        parameterName (str): Name of the Air Quality parameter
+        aqiValue (int): Observed Air Quality Index value
+        category (Category): The corresponding Category for the AQI value
+    """
+
+    fetchedAt: datetime
+    timestamp: datetime
+    reportingArea: str
+    stateCode: str
+    parameterName: str
+    aqiValue: int
+    category: Category
+
+
+class ObservationLog(object):
+    """
+    An append-only log of every fetched observation, stored as fixed-width
+    binary records. Each record holds the fetch time, the observation time,
+    an area id, a parameter id, the AQI and the category. Area and parameter
+    names are kept once, in a small JSON file next to the log.
+
+    Records are appended in fetch order and the fetch time never decreases.
+    A time-range query can therefore memory-map the log and binary search it,
+    reading only the records in the range.
+    """
+
+    LOGGER = logging.getLogger()
+    # fetched at (epoch s), observed at (epoch s), area id, parameter id, AQI, category
+    RECORD = struct.Struct("<qqIBhB")
+    _DIR_NAME = "observations"
+    _LOG_FILE_NAME = "observations.log"
+    _NAMES_FILE_NAME = "observations.names.json"
+
+    def __init__(self, dataDir: Path = None, subDirName: str = None):
+        """
+        Constructor for the Observation Log.
+
+        Parameters:
+            dataDir (Path): (optional) The directory of the log, data/observations by default
+            subDirName (str): (optional) Keeps the log in this directory under data/observations
+        """
+        if (dataDir is None):
+            dataDir = initDataDir(self._DIR_NAME, subDirName)
+        self._log_path = Path.joinpath(dataDir, self._LOG_FILE_NAME)
+        self._names_path = Path.joinpath(dataDir, self._NAMES_FILE_NAME)
+        self._lock = threading.Lock()
+
+        self._areas: List[Tuple[str, str]] = list()
+        self._parameters: List[str] = list()
+        self._loadNames()
+        self._area_ids: Dict[Tuple[str, str], int] = {area: i for i, area in enumerate(self._areas)}
+        self._parameter_ids: Dict[str, int] = {name: i for i, name in enumerate(self._parameters)}
+
+        self._last_fetched_at = self._recover()
+
+
+    def append(self, observations: List[Observation], fetchedAt: float) -> None:
+        """
+        Append the observations of one fetch.
+
+        Parameters:
+            observations (Observation[]): The observations that were fetched
+            fetchedAt (float): Epoch seconds of the fetch
+        """
+
+        if (not observations):
+            return
+
+        with self._lock:
+            # Keep the log sorted even if the wall clock steps back
+            fetched_at = max(int(fetchedAt), self._last_fetched_at)
+            records = bytearray()
+            for observation in observations:
+                records += self.RECORD.pack(fetched_at,
+                                            int(observation.timestamp.timestamp()),
+                                            self._getAreaId(observation.reportingArea, observation.stateCode),
+                                            self._getParameterId(observation.parameterName),
+                                            observation.aqiValue,
+                                            observation.category.getValue())
+            with open(self._log_path, 'ab') as fw:
+                fw.write(records)
+            self._last_fetched_at = fetched_at
+
+
+    def query(self, start: float, end: float) -> List[LoggedObservation]:
+        """
+        Retrieve the observations fetched within a time range.
+
+        Parameters:
+            start (float): Epoch seconds of the start of the range, inclusive
+            end (float): Epoch seconds of the end of the range, exclusive
+
+        Returns:
+            LoggedObservation[]: The observations in fetch order
+        """
+
+        with self._lock:
+            areas = list(self._areas)
+            parameters = list(self._parameters)
+
+        results = list()
+        for fetched_at, observed_at, area_id, parameter_id, aqi_value, category in self._scan(start, end):
+            reporting_area, state_code = areas[area_id]
+            results.append(LoggedObservation(datetime.fromtimestamp(fetched_at, utc),
+                                             datetime.fromtimestamp(observed_at, utc),
+                                             reporting_area,
+                                             state_code,
+                                             parameters[parameter_id],
+                                             aqi_value,
+                                             Category.lookupByValue(category)))
+        return results
+
+
+    def _scan(self, start: float, end: float) -> List[Tuple]:
+        if (not self._log_path.exists()):
+            return list()
+
+        with open(self._log_path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            count = size // self.RECORD.size
+            if (count == 0):
+                return list()
+
+            with mmap.mmap(fp.fileno(), count * self.RECORD.size, access=mmap.ACCESS_READ) as view:
+                index = self._findFirst(view, count, start)
+                records = list()
+                while (index < count):
+                    record = self.RECORD.unpack_from(view, index * self.RECORD.size)
+                    if (record[0] >= end):
+                        break
+                    records.append(record)
+                    index += 1
+                return records
+
+
+    def _findFirst(self, view: mmap.mmap, count: int, start: float) -> int:
+        """ Index of the first record fetched at or after start """
+        low, high = 0, count
+        while (low < high):
+            middle = (low + high) // 2
+            fetched_at = struct.unpack_from("<q", view, middle * self.RECORD.size)[0]
+            if (fetched_at < start):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    def _recover(self) -> int:
+        """ Drop a partially written record left by a crash, returning the newest fetch time """
+        if (not self._log_path.exists()):
+            return 0
+
+        size = self._log_path.stat().st_size
+        torn_bytes = size % self.RECORD.size
+        if (torn_bytes):
+            self.LOGGER.warning("Dropping a partial record at the end of " + str(self._log_path))
+            os.truncate(self._log_path, size - torn_bytes)
+            size -= torn_bytes
+
+        if (size == 0):
+            return 0
+        with open(self._log_path, 'rb') as fp:
+            fp.seek(size - self.RECORD.size)
+            return self.RECORD.unpack(fp.read(self.RECORD.size))[0]
+
+
+    def _getAreaId(self, reportingArea: str, stateCode: str) -> int:
+        area = (reportingArea, stateCode)
+        area_id = self._area_ids.get(area)
+        if (area_id is None):
+            area_id = len(self._areas)
+            self._areas.append(area)
+            self._area_ids[area] = area_id
+            self._saveNames()
+        return area_id
+
+
+    def _getParameterId(self, parameterName: str) -> int:
+        parameter_id = self._parameter_ids.get(parameterName)
+        if (parameter_id is None):
+            parameter_id = len(self._parameters)
+            self._parameters.append(parameterName)
+            self._parameter_ids[parameterName] = parameter_id
+            self._saveNames()
+        return parameter_id
+
+
+    def _loadNames(self) -> None:
+        if (not self._names_path.exists()):
+            return
+        with open(self._names_path, 'r') as fp:
+            names = json.load(fp)
+        self._areas = [tuple(area) for area in names["areas"]]
+        self._parameters = list(names["parameters"])
+
+
+    def _saveNames(self) -> None:
+        # Names are written before any record that refers to them, and replaced atomically
+        temp_path = Path(str(self._names_path) + ".tmp")
+        with open(temp_path, 'w') as fw:
+            json.dump({"areas": self._areas, "parameters": self._parameters}, fw, indent=2)
+            fw.flush()
+            os.fsync(fw.fileno())
+        os.replace(temp_path, self._names_path)
@@ -0,0 +1,419 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+from pathlib import Path
+from typing import Callable, Dict, List, Mapping
+
+
+class RetryableError(Exception):
+    """
+    Raised by a publisher when delivery failed but should be attempted again.
+
+    Parameters:
+        message (str): Description of the failure
+        retryAt (float): (optional) Epoch seconds before which no retry should happen
+    """
+
+    def __init__(self, message: str, retryAt: float = None):
+        super().__init__(message)
+        self.retryAt = retryAt
+
+
+class PermanentError(Exception):
+    """
+    Raised by a publisher when delivery can never succeed, e.g. a rejected message.
+    """
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter that can be corrected by the rate-limit
+    information the remote API reports.
+    """
+
+    def __init__(self, capacity: float, ratePerSecond: float):
+        self._capacity = capacity
+        self._configured_rate = ratePerSecond
+        self._rate = ratePerSecond
+        # Epoch seconds until which the rate follows the window reported by the API
+        self._rate_until = 0.0
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+
+    def acquire(self) -> None:
+        """
+        Block until a token is available and take it.
+        """
+
+        while True:
+            with self._lock:
+                self._refill()
+                wait_seconds = self._blocked_until - time.time()
+                if (wait_seconds <= 0):
+                    if (self._tokens >= 1):
+                        self._tokens -= 1
+                        return
+                    wait_seconds = (1 - self._tokens) / self._rate
+                    if (self._rate_until > time.time()):
+                        # Wake up when the window resets, the configured rate may give a token sooner
+                        wait_seconds = min(wait_seconds, self._rate_until - time.time())
+            time.sleep(wait_seconds)
+
+
+    def update(self, remaining: int, resetAt: float) -> None:
+        """
+        Align the bucket with the rate-limit window reported by the API.
+
+        Parameters:
+            remaining (int): Requests left in the current window
+            resetAt (float): Epoch seconds when the window resets
+        """
+
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, remaining)
+            seconds_until_reset = resetAt - time.time()
+            if (remaining <= 0):
+                self._blocked_until = max(self._blocked_until, resetAt)
+            elif (seconds_until_reset > 0):
+                # Spread what is left of the window evenly until it resets
+                self._rate = max(remaining / seconds_until_reset, 1 / seconds_until_reset)
+                self._rate_until = resetAt
+
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if (self._rate != self._configured_rate and time.time() >= self._rate_until):
+            # The reported window has reset, so its budget no longer applies
+            self._rate = self._configured_rate
+
+
+class Outbox(object):
+    """
+    A durable queue of outbound messages. Messages are written to an on-disk
+    journal when enqueued, then delivered by a fixed number of publisher
+    threads that respect a token bucket and retry failures with jittered
+    exponential backoff. Messages still in the journal are delivered again
+    after a restart.
+
+    A message may carry the idempotency key of a tweet. Once it is delivered,
+    the key is recorded in the ledger before the message is acknowledged in
+    the journal, so a message whose key is in the ledger is not delivered
+    again. A message that still fails after a number of attempts is dropped.
+    The journal is rewritten without the delivered messages once they make up
+    most of it.
+    """
+
+    LOGGER = logging.getLogger()
+    _THREAD_NAME = "outbox"
+    _JOURNAL_FILE = "outbox.journal"
+    _HEADER_REMAINING = "x-rate-limit-remaining"
+    _HEADER_RESET = "x-rate-limit-reset"
+    _BACKOFF_BASE_SECONDS = 2
+    _BACKOFF_MAX_SECONDS = 900
+    # About three hours of retries once the backoff reaches its maximum
+    _MAX_ATTEMPTS = 16
+    # Too few records are not worth rewriting the journal for
+    _COMPACT_MIN_RECORDS = 1000
+    _STOP_TIMEOUT_SECONDS = 10
+
+    def __init__(self,
+                 dataDir: Path,
+                 publisher: Callable[[str], Mapping[str, str]],
+                 concurrency: int,
+                 bucket: TokenBucket,
+                 ledger=None):
+        """
+        Constructor for the Outbox.
+
+        Parameters:
+            dataDir (Path): Directory that holds the journal
+            publisher (callable): Delivers a message and returns the response headers,
+                raising RetryableError or PermanentError on failure
+            concurrency (int): The number of messages that may be in flight at once
+            bucket (TokenBucket): Limits the rate of delivery attempts
+            ledger (FileTweetLedger | SQLiteTweetLedger): (optional) Records the keys of the delivered messages
+        """
+        self._journal_path = Path.joinpath(dataDir, self._JOURNAL_FILE)
+        self._publisher = publisher
+        self._concurrency = concurrency
+        self._bucket = bucket
+        self._ledger = ledger
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._journal_lock = threading.Lock()
+        self._running = False
+        self._journal = None
+        self._journal_records = 0
+        self._threads: List[threading.Thread] = []
+        # The messages not yet acknowledged, queued or in flight, by identifier and by key
+        self._entries: Dict[str, Dict] = {}
+        self._keys: Dict[str, str] = {}
+
+
+    def start(self) -> None:
+        pending = self._recoverJournal()
+        self._journal = open(self._journal_path, 'a')
+        self._journal_records = len(pending)
+        for entry in pending:
+            self._track(entry)
+            self._push(entry, 0)
+        if (pending):
+            self.LOGGER.info("Recovered {} queued message(s) from the outbox journal".format(len(pending)))
+
+        self._running = True
+        for index in range(self._concurrency):
+            thread = threading.Thread(name=self._THREAD_NAME, target=self._work, args=())
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+
+    def stop(self) -> None:
+        """
+        Stop delivering, waiting a bounded time for the messages in flight to
+        be acknowledged. Queued messages stay in the journal for the next start.
+        """
+
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+        deadline = time.monotonic() + self._STOP_TIMEOUT_SECONDS
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        if (any(thread.is_alive() for thread in self._threads)):
+            self.LOGGER.warning("Stopped waiting for the messages in flight, they are delivered again on the next start")
+        self._threads = []
+
+
+    def enqueue(self, message: str, idempotencyKey: str = None) -> str:
+        """
+        Durably queue a message for delivery.
+
+        Parameters:
+            message (str): The text to deliver
+            idempotencyKey (str): (optional) Identifies the message, which is not queued
+                again while a message with the same key is not yet delivered
+
+        Returns:
+            str: The identifier assigned to the message
+        """
+
+        entry = {"id": uuid.uuid4().hex, "key": idempotencyKey, "text": message, "created": time.time(), "attempts": 0}
+        with self._condition:
+            if (idempotencyKey is not None and idempotencyKey in self._keys):
+                return self._keys[idempotencyKey]
+            self._track(entry)
+        self._appendJournal(self._getPutRecord(entry))
+        self._push(entry, 0)
+        return entry["id"]
+
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._heap)
+
+
+    def _push(self, entry: Dict, delaySeconds: float) -> None:
+        with self._condition:
+            heapq.heappush(self._heap, (time.time() + delaySeconds, next(self._sequence), entry))
+            self._condition.notify()
+
+
+    def _pop(self) -> Dict:
+        with self._condition:
+            while True:
+                if (not self._running):
+                    return None
+                if (self._heap):
+                    wait_seconds = self._heap[0][0] - time.time()
+                    if (wait_seconds <= 0):
+                        return heapq.heappop(self._heap)[2]
+                    self._condition.wait(wait_seconds)
+                else:
+                    self._condition.wait()
+
+
+    def _track(self, entry: Dict) -> None:
+        self._entries[entry["id"]] = entry
+        if (entry["key"] is not None):
+            self._keys[entry["key"]] = entry["id"]
+
+
+    def _finish(self, entry: Dict, op: str) -> None:
+        """ Acknowledge or drop a message, for good """
+        with self._condition:
+            self._entries.pop(entry["id"], None)
+            if (entry["key"] is not None):
+                self._keys.pop(entry["key"], None)
+        self._appendJournal({"op": op, "id": entry["id"]})
+        self._compactIfWorthIt()
+
+
+    def _work(self) -> None:
+        """ Routine that runs until the outbox is stopped """
+        while True:
+            entry = self._pop()
+            if (entry is None):
+                return
+
+            if (self._isDelivered(entry)):
+                self.LOGGER.warning("Skipping message {}, it was already delivered as {}".format(entry["id"], entry["key"]))
+                self._finish(entry, "ack")
+                continue
+
+            self._bucket.acquire()
+            if (not self._running):
+                # Left in the journal for the next start
+                return
+            try:
+                headers = self._publisher(entry["text"])
+            except PermanentError:
+                self.LOGGER.exception("Message {} was rejected and has been dropped: {}".format(entry["id"], entry["text"]))
+                self._finish(entry, "drop")
+                continue
+            except Exception as e:
+                # Anything else, RetryableError included, is worth another attempt
+                entry["attempts"] += 1
+                if (entry["attempts"] >= self._MAX_ATTEMPTS):
+                    self.LOGGER.error("Message {} failed {} times and has been dropped: {}: {}".format(
+                        entry["id"], entry["attempts"], entry["text"], e))
+                    self._finish(entry, "drop")
+                    continue
+                delay_seconds = self._getBackoffSeconds(entry["attempts"])
+                retry_at = getattr(e, "retryAt", None)
+                if (retry_at is not None):
+                    self._bucket.update(0, retry_at)
+                    delay_seconds = max(delay_seconds, retry_at - time.time())
+                self.LOGGER.warning("Message {} will be retried in {:.0f} seconds: {}".format(entry["id"], delay_seconds, e))
+                self._push(entry, delay_seconds)
+                continue
+
+            # Recorded before the acknowledgement, so a crash in between does not deliver it twice
+            self._recordDelivery(entry)
+            self._finish(entry, "ack")
+            self._updateBucket(headers)
+
+
+    def _isDelivered(self, entry: Dict) -> bool:
+        if (entry["key"] is None or self._ledger is None):
+            return False
+        try:
+            return self._ledger.contains(entry["key"])
+        except Exception:
+            # A duplicate tweet is better than a missing one
+            self.LOGGER.exception("Problem occurred while checking the tweet ledger for " + entry["key"])
+            return False
+
+
+    def _recordDelivery(self, entry: Dict) -> None:
+        if (entry["key"] is None or self._ledger is None):
+            return
+        try:
+            if (not self._ledger.claim(entry["key"])):
+                self.LOGGER.warning("Message {} was also delivered elsewhere as {}".format(entry["id"], entry["key"]))
+        except Exception:
+            self.LOGGER.exception("Problem occurred while recording the delivery of " + entry["key"])
+
+
+    def _getBackoffSeconds(self, attempts: int) -> float:
+        # Full jitter keeps many failed messages from retrying in lockstep
+        ceiling = min(self._BACKOFF_MAX_SECONDS, self._BACKOFF_BASE_SECONDS * (2 ** attempts))
+        return random.uniform(0, ceiling)
+
+
+    def _updateBucket(self, headers: Mapping[str, str]) -> None:
+        if (headers is None):
+            return
+        try:
+            remaining = headers.get(self._HEADER_REMAINING)
+            reset = headers.get(self._HEADER_RESET)
+            if (remaining is not None and reset is not None):
+                self._bucket.update(int(remaining), float(reset))
+        except ValueError:
+            self.LOGGER.debug("Ignoring malformed rate-limit headers")
+
+
+    def _getPutRecord(self, entry: Dict) -> Dict:
+        return {"op": "put", "id": entry["id"], "key": entry["key"], "text": entry["text"], "created": entry["created"]}
+
+
+    def _appendJournal(self, record: Dict) -> None:
+        with self._journal_lock:
+            self._journal.write(json.dumps(record) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal_records += 1
+
+
+    def _compactIfWorthIt(self) -> None:
+        with self._journal_lock:
+            with self._condition:
+                pending = list(self._entries.values())
+            if (self._journal_records < self._COMPACT_MIN_RECORDS or len(pending) * 2 > self._journal_records):
+                return
+            # Holding the lock keeps every put of a pending message in the rewritten journal
+            self._journal.close()
+            self._writeJournal(pending)
+            self._journal = open(self._journal_path, 'a')
+            self.LOGGER.info("Compacted the outbox journal from {} to {} record(s)".format(self._journal_records, len(pending)))
+            self._journal_records = len(pending)
+
+
+    def _writeJournal(self, entries: List[Dict]) -> None:
+        temp_path = self._journal_path.with_suffix(".tmp")
+        with open(temp_path, 'w') as fw:
+            for entry in entries:
+                fw.write(json.dumps(self._getPutRecord(entry)) + "\n")
+            fw.flush()
+            os.fsync(fw.fileno())
+        os.replace(temp_path, self._journal_path)
+
+
+    def _recoverJournal(self) -> List[Dict]:
+        """
+        Read the journal, then rewrite it so only undelivered messages remain,
+        leaving out those the ledger shows were delivered.
+        """
+
+        pending = {}
+        if (os.path.exists(self._journal_path)):
+            with open(self._journal_path, 'r') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn final line from an interrupted write
+                        self.LOGGER.warning("Skipping unreadable outbox journal record")
+                        continue
+                    if (record["op"] == "put"):
+                        pending[record["id"]] = {"id": record["id"],
+                                                 "key": record.get("key"),
+                                                 "text": record["text"],
+                                                 "created": record["created"],
+                                                 "attempts": 0}
+                    else:
+                        pending.pop(record["id"], None)
+
+        # Delivered, but stopped before the acknowledgement was written
+        delivered = [entry for entry in pending.values() if self._isDelivered(entry)]
+        for entry in delivered:
+            self.LOGGER.info("Not recovering message {}, it was already delivered as {}".format(entry["id"], entry["key"]))
+            pending.pop(entry["id"])
+
+        self._writeJournal(list(pending.values()))
+        return list(pending.values())
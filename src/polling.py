@@ -0,0 +1,128 @@
+import threading
+
+from collections import deque
+from typing import Dict, Hashable, Tuple
+
+
+class _PublishHistory(object):
+
+    def __init__(self, size: int):
+        self.arrivals = deque(maxlen=size)
+        self.unchanged = 0
+
+
+class AdaptivePollingPolicy(object):
+    """
+    Decides when to poll for hourly observations. The policy learns, per key,
+    the second of the hour at which new observations first show up, sleeps
+    until that publish window, polls densely inside it, and backs off
+    exponentially when a window passes without anything new. Backing off is
+    skipped while the AQI is close to a category boundary, because that is
+    when a change is most likely to be worth reporting.
+    """
+
+    _HOUR_SECONDS = 3600
+    _HISTORY_SIZE = 24
+    # Arrivals needed before the learned window is trusted
+    _MIN_ARRIVALS = 2
+    _DENSE_INTERVAL_SECONDS = 120
+    _MAX_INTERVAL_SECONDS = 1800
+    _WINDOW_MARGIN_SECONDS = 240
+    _CATEGORY_BREAKPOINTS = (50, 100, 150, 200, 300)
+    _BOUNDARY_MARGIN_AQI = 10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histories: Dict[Hashable, _PublishHistory] = {}
+
+
+    def recordArrival(self, key: Hashable, arrivedAt: float) -> None:
+        """
+        Record that a new observation was first seen.
+
+        Parameters:
+            key (Hashable): Identifies the series of observations, e.g. a reporting area
+            arrivedAt (float): Epoch seconds when the new observation was first seen
+        """
+
+        with self._lock:
+            history = self._getHistory(key)
+            history.arrivals.append(arrivedAt % self._HOUR_SECONDS)
+            history.unchanged = 0
+
+
+    def recordUnchanged(self, key: Hashable) -> None:
+        with self._lock:
+            self._getHistory(key).unchanged += 1
+
+
+    def getNextPollDelay(self, key: Hashable, now: float, lastArrival: float, aqiValue: int) -> float:
+        """
+        Seconds to wait before polling again.
+
+        Parameters:
+            key (Hashable): Identifies the series of observations
+            now (float): The current epoch seconds
+            lastArrival (float): Epoch seconds when the newest observation was first seen, if known
+            aqiValue (int): The newest primary AQI value, if known
+
+        Returns:
+            float: Seconds until the next poll, or None while the publish window is still unknown
+        """
+
+        with self._lock:
+            history = self._histories.get(key)
+            if (history is None or len(history.arrivals) < self._MIN_ARRIVALS):
+                return None
+            window_open, window_close = self._getWindow(history)
+            unchanged = history.unchanged
+
+        # Find the window that is open now, or the next one to open
+        hour_start = now - now % self._HOUR_SECONDS
+        window_start = hour_start - self._HOUR_SECONDS + window_open
+        while (window_start + (window_close - window_open) <= now):
+            window_start += self._HOUR_SECONDS
+
+        if (lastArrival is not None and lastArrival >= window_start):
+            # This window has already delivered its observation
+            return window_start + self._HOUR_SECONDS - now
+
+        if (now >= window_start):
+            return self._DENSE_INTERVAL_SECONDS
+
+        previous_window_start = window_start - self._HOUR_SECONDS
+        if (lastArrival is not None and lastArrival >= previous_window_start):
+            return window_start - now
+
+        # The previous window closed without a new observation, so publishing is running late
+        if (self._isNearBoundary(aqiValue)):
+            delay_seconds = self._DENSE_INTERVAL_SECONDS
+        else:
+            delay_seconds = min(self._MAX_INTERVAL_SECONDS, self._DENSE_INTERVAL_SECONDS * (2 ** unchanged))
+        return min(delay_seconds, window_start - now)
+
+
+    def _getHistory(self, key: Hashable) -> _PublishHistory:
+        history = self._histories.get(key)
+        if (history is None):
+            history = _PublishHistory(self._HISTORY_SIZE)
+            self._histories[key] = history
+        return history
+
+
+    def _getWindow(self, history: _PublishHistory) -> Tuple[float, float]:
+        # Arrivals are seconds of the hour, so measure them from one of them to handle wrap-around
+        half_hour = self._HOUR_SECONDS / 2
+        reference = history.arrivals[-1]
+        offsets = [((arrival - reference + half_hour) % self._HOUR_SECONDS) - half_hour for arrival in history.arrivals]
+        return (reference + min(offsets) - self._WINDOW_MARGIN_SECONDS,
+                reference + max(offsets) + self._WINDOW_MARGIN_SECONDS)
+
+
+    def _isNearBoundary(self, aqiValue: int) -> bool:
+        if (aqiValue is None):
+            return False
+        for breakpoint in self._CATEGORY_BREAKPOINTS:
+            if (abs(aqiValue - breakpoint) <= self._BOUNDARY_MARGIN_AQI):
+                return True
+        return False
@@ -0,0 +1,190 @@
+import cProfile
+import io
+import linecache
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+
+from pathlib import Path
+from typing import Callable, Iterable, List
+from util import initDataDir
+
+
+class TaskProfiler(object):
+    """
+    Profiles the steps of chosen tasks with cProfile for a limited time. The
+    scheduler runs every step through the profiler; steps of tasks that are
+    not being profiled run as they are. Only one step is profiled at a time,
+    since a thread may not profile while another does; steps that start
+    meanwhile run as they are too. When the time is up, the combined
+    statistics are written as a pstats file, readable with the pstats module
+    or tools such as snakeviz, and the top functions are logged.
+    """
+
+    LOGGER = logging.getLogger()
+    _DIR_NAME = "profiles"
+    _REPORT_LINES = 25
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held while a step is being profiled
+        self._profiling = threading.Lock()
+        self._task_names = frozenset()
+        self._stats: pstats.Stats = None
+        self._timer: threading.Timer = None
+
+
+    def start(self, taskNames: Iterable[str], seconds: float) -> None:
+        """
+        Profile the steps of the named tasks that run within the next seconds.
+
+        Parameters:
+            taskNames (Iterable): The names of the tasks to profile
+            seconds (float): How long to profile for
+        """
+
+        with self._lock:
+            if (self._timer is not None):
+                raise RuntimeError("A profile is already being taken")
+            self._task_names = frozenset(taskNames)
+            self._stats = None
+            self._timer = threading.Timer(seconds, self._finish)
+            self._timer.daemon = True
+            self._timer.start()
+        self.LOGGER.info("Profiling {} for {:.0f} seconds".format(", ".join(sorted(self._task_names)), seconds))
+
+
+    def isActive(self) -> bool:
+        return self._timer is not None
+
+
+    def run(self, taskName: str, step: Callable[[], float]) -> float:
+        """
+        Run a step, profiling it when its task is being profiled.
+
+        Parameters:
+            taskName (str): The name of the task the step belongs to
+            step (callable): The step to run
+
+        Returns:
+            float: What the step returned
+        """
+
+        if (taskName not in self._task_names or not self._profiling.acquire(blocking=False)):
+            return step()
+
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is active, e.g. a debugger
+                self.LOGGER.debug("Running a step of {} without profiling it".format(taskName))
+                return step()
+            try:
+                return step()
+            finally:
+                profile.disable()
+                self._addProfile(profile)
+        finally:
+            self._profiling.release()
+
+
+    def _addProfile(self, profile: cProfile.Profile) -> None:
+        try:
+            with self._lock:
+                if (self._timer is not None):
+                    if (self._stats is None):
+                        self._stats = pstats.Stats(profile)
+                    else:
+                        self._stats.add(profile)
+        except Exception:
+            # e.g. TypeError for a profile that recorded nothing, which must not fail the step
+            self.LOGGER.exception("Problem occurred while collecting a profile")
+
+
+    def _finish(self) -> None:
+        with self._lock:
+            stats = self._stats
+            task_names = self._task_names
+            self._task_names = frozenset()
+            self._stats = None
+            self._timer = None
+
+        if (stats is None):
+            self.LOGGER.info("Profiling finished without any step of " + ", ".join(sorted(task_names)) + " running")
+            return
+
+        file_path = Path.joinpath(initDataDir(self._DIR_NAME), "{}-{}.pstats".format(
+            "-".join(sorted(task_names)), time.strftime("%Y%m%d-%H%M%S")))
+        stats.dump_stats(file_path)
+
+        report = io.StringIO()
+        stats.stream = report
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self._REPORT_LINES)
+        self.LOGGER.info("Profile written to {}\n{}".format(file_path, report.getvalue()))
+
+
+class AllocationTracer(object):
+    """
+    Finds what is growing in memory with tracemalloc. The first snapshot
+    starts tracing; every later snapshot reports the lines whose allocations
+    grew the most since the snapshot before it.
+    """
+
+    LOGGER = logging.getLogger()
+    _FRAMES = 10
+    _TOP_LINES = 20
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._previous: tracemalloc.Snapshot = None
+
+
+    def snapshot(self) -> str:
+        """
+        Take a snapshot and report the difference to the previous one.
+
+        Returns:
+            str: The report, which is also logged
+        """
+
+        with self._lock:
+            if (not tracemalloc.is_tracing()):
+                tracemalloc.start(self._FRAMES)
+                self._previous = tracemalloc.take_snapshot()
+                report = "Started tracing allocations, take another snapshot to see what grows"
+            else:
+                current = tracemalloc.take_snapshot()
+                report = self._formatDiff(current.compare_to(self._previous, "lineno"))
+                self._previous = current
+
+        self.LOGGER.info(report)
+        return report
+
+
+    def stop(self) -> str:
+        with self._lock:
+            if (tracemalloc.is_tracing()):
+                tracemalloc.stop()
+            self._previous = None
+        report = "Stopped tracing allocations"
+        self.LOGGER.info(report)
+        return report
+
+
+    def _formatDiff(self, differences: List[tracemalloc.StatisticDiff]) -> str:
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["Top {} allocators since the previous snapshot (traced {:.1f} KiB, peak {:.1f} KiB)".format(
+            self._TOP_LINES, current / 1024, peak / 1024)]
+        for difference in differences[:self._TOP_LINES]:
+            frame = difference.traceback[0]
+            lines.append("{:+10.1f} KiB {:+8d} blocks  {}:{}  {}".format(
+                difference.size_diff / 1024,
+                difference.count_diff,
+                frame.filename,
+                frame.lineno,
+                linecache.getline(frame.filename, frame.lineno).strip()))
+        return "\n".join(lines)
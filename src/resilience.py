@@ -0,0 +1,212 @@
+import logging
+import math
+import random
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from typing import Callable, Optional
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of calling a service while its circuit breaker is open.
+    """
+
+    def __init__(self, name: str, retryAfterSeconds: float):
+        super().__init__("Not calling {} while its circuit is open, retry in {:.0f} seconds".format(name, retryAfterSeconds))
+        self.retryAfterSeconds = retryAfterSeconds
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to a service that keeps failing. After a number of failures
+    in a row the circuit opens and every call is refused until a cool down
+    passes. Then a single probe call is let through: when it succeeds the
+    circuit closes, when it fails the circuit opens again for twice as long.
+
+    Callers that are refused are told when to retry, spread at random over
+    the ramp period that follows the cool down. Once the circuit closes, a
+    share of the calls that grows over the ramp period is let through, so
+    that the callers that waited do not all return at once.
+    """
+
+    LOGGER = logging.getLogger()
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self,
+                 name: str,
+                 failureThreshold: int = 5,
+                 openSeconds: float = 60,
+                 maxOpenSeconds: float = 900,
+                 rampSeconds: float = 300,
+                 clock: Callable[[], float] = time.time,
+                 randomGenerator: random.Random = None):
+        """
+        Constructor for the Circuit Breaker.
+
+        Parameters:
+            name (str): The name of the service, for the log
+            failureThreshold (int): (optional) The failures in a row that open the circuit
+            openSeconds (float): (optional) How long the circuit first stays open
+            maxOpenSeconds (float): (optional) The longest the circuit stays open after failed probes
+            rampSeconds (float): (optional) How long calls take to ramp back up once the circuit closes
+            clock (callable): (optional) Returns the current epoch seconds
+            randomGenerator (Random): (optional) The source of the jitter
+        """
+        self._name = name
+        self._failure_threshold = failureThreshold
+        self._open_seconds = openSeconds
+        self._max_open_seconds = maxOpenSeconds
+        self._ramp_seconds = rampSeconds
+        self._clock = clock
+        self._random = randomGenerator or random.Random()
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._next_open_seconds = openSeconds
+        self._open_until = 0.0
+        self._closed_at = None
+
+
+    def acquire(self) -> None:
+        """
+        Ask to call the service.
+
+        Raises:
+            CircuitOpenError: When the call must not be made, telling when to retry
+        """
+
+        with self._lock:
+            now = self._clock()
+            if (self._state == self.OPEN):
+                if (now < self._open_until):
+                    raise CircuitOpenError(self._name, self._open_until - now + self._jitter(self._ramp_seconds))
+                # This caller probes whether the service is back, the others keep waiting
+                self._state = self.HALF_OPEN
+                self.LOGGER.info("Probing whether {} is back".format(self._name))
+                return
+
+            if (self._state == self.HALF_OPEN):
+                raise CircuitOpenError(self._name, self._jitter(self._ramp_seconds))
+
+            if (self._closed_at is not None):
+                ramp_elapsed = now - self._closed_at
+                if (ramp_elapsed >= self._ramp_seconds):
+                    self._closed_at = None
+                elif (self._random.random() * self._ramp_seconds >= ramp_elapsed):
+                    raise CircuitOpenError(self._name, self._jitter(self._ramp_seconds - ramp_elapsed))
+
+
+    def recordSuccess(self) -> None:
+        """ Report that a call that was let through succeeded """
+        with self._lock:
+            self._failures = 0
+            self._next_open_seconds = self._open_seconds
+            if (self._state != self.CLOSED):
+                self._state = self.CLOSED
+                self._closed_at = self._clock()
+                self.LOGGER.info("Circuit of {} closed, ramping calls back up over {:.0f} seconds".format(self._name, self._ramp_seconds))
+
+
+    def recordFailure(self) -> None:
+        """ Report that a call that was let through failed """
+        with self._lock:
+            self._failures += 1
+            if (self._state == self.HALF_OPEN or self._failures >= self._failure_threshold):
+                open_seconds = self._next_open_seconds
+                self._next_open_seconds = min(open_seconds * 2, self._max_open_seconds)
+                self._state = self.OPEN
+                self._open_until = self._clock() + open_seconds
+                self._closed_at = None
+                self.LOGGER.warning("Circuit of {} opened for {:.0f} seconds after {} failure(s) in a row".format(
+                    self._name, open_seconds, self._failures))
+
+
+    def getState(self) -> str:
+        with self._lock:
+            if (self._state == self.OPEN and self._clock() >= self._open_until):
+                return self.HALF_OPEN
+            return self._state
+
+
+    def _jitter(self, seconds: float) -> float:
+        return self._random.uniform(0, max(0.0, seconds))
+
+
+class LatencyWindow(object):
+    """
+    Keeps the latencies of the most recent calls to tell a percentile of them.
+    """
+
+    def __init__(self, size: int = 100, minSamples: int = 20):
+        """
+        Constructor for the Latency Window.
+
+        Parameters:
+            size (int): (optional) The number of recent latencies kept
+            minSamples (int): (optional) The fewest latencies a percentile is told from
+        """
+        self._latencies = deque(maxlen=size)
+        self._min_samples = minSamples
+        self._lock = threading.Lock()
+
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Parameters:
+            percent (float): The percentile, from 0 to 100
+
+        Returns:
+            float: The latency below which the given percent of the recent calls completed, or None when too few are known
+        """
+
+        with self._lock:
+            if (len(self._latencies) < self._min_samples):
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, max(0, math.ceil(percent / 100 * len(latencies)) - 1))
+        return latencies[index]
+
+
+def callHedged(executor: Executor, function: Callable, hedgeAfterSeconds: float, onHedge: Callable[[], None] = None):
+    """
+    Call a function and, when it has not returned after a delay, call it a
+    second time in parallel. The first call to succeed gives the result; the
+    other one is left to finish in the background.
+
+    Parameters:
+        executor (Executor): Runs the calls
+        function (callable): Takes no arguments and must be safe to call twice
+        hedgeAfterSeconds (float): The delay before the second call
+        onHedge (callable): (optional) Called when the second call is made
+
+    Returns:
+        The result of the first call to succeed, or raises the error of the last one to fail
+    """
+
+    pending = {executor.submit(function)}
+    done, pending = wait(pending, timeout=hedgeAfterSeconds)
+    if (not done):
+        if (onHedge is not None):
+            onHedge()
+        pending.add(executor.submit(function))
+
+    error = None
+    while (done or pending):
+        for future in done:
+            if (future.exception() is None):
+                return future.result()
+            error = future.exception()
+        if (not pending):
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    raise error
@@ -0,0 +1,341 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from clock import SystemClock, VirtualClock
+from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY
+from profiling import TaskProfiler
+from typing import Callable, Dict, List, Set, Tuple
+
+
+def monotonicClock() -> float:
+    """
+    A monotonic clock that keeps counting while the host is suspended.
+
+    Returns:
+        float: seconds since an arbitrary, fixed point in the past
+    """
+
+    if (hasattr(time, "CLOCK_BOOTTIME")):
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+    return time.monotonic()
+
+
+class ScheduledJob(object):
+    """
+    A repeating unit of work owned by the Scheduler.
+
+    The step callable performs one iteration of the work and returns the number
+    of seconds to wait before the next iteration, or None to stop repeating. A
+    step that raises is run again after a backoff that doubles with every
+    failure in a row, up to an hour.
+    """
+
+    _RETRY_BASE_SECONDS = 60
+    _RETRY_MAX_SECONDS = 3600
+
+    def __init__(self, name: str, step: Callable[[], float], labels: Dict[str, str] = None):
+        self.name = name
+        self.step = step
+        # Identify the job in metrics, next to its name
+        self.labels = {"task": name, **(labels or {})}
+        self.deadline = None
+        self.cancelled = False
+        # Steps that raised since the last one that completed
+        self.failures = 0
+
+
+    def getRetrySeconds(self) -> float:
+        """ The seconds to wait before running a step again after it raised """
+        return min(self._RETRY_MAX_SECONDS, self._RETRY_BASE_SECONDS * 2 ** (self.failures - 1))
+
+
+class Scheduler(object):
+    """
+    Keeps a single heap-ordered timeline of job deadlines and runs the steps of
+    the jobs that are due on a small pool of worker threads.
+    """
+
+    LOGGER = logging.getLogger()
+    _STEP_SECONDS = REGISTRY.histogram("wxbot_task_step_seconds", "Duration of a single step of a task")
+    _STEP_FAILURES = REGISTRY.counter("wxbot_task_step_failures_total", "Steps of a task that raised, each retried after a backoff")
+    _NEXT_RUN = REGISTRY.gauge("wxbot_task_next_run_timestamp_seconds", "Epoch seconds of the next scheduled step of a task")
+    _THREAD_NAME = "scheduler"
+    _DEFAULT_WORKERS = 4
+    # Upper bound on a single wait so deadlines are re-checked after a suspend
+    _MAX_WAIT_SECONDS = 60
+
+    def __init__(self, workers: int = _DEFAULT_WORKERS, profiler: TaskProfiler = None):
+        """
+        Constructor for the Scheduler.
+
+        Parameters:
+            workers (int): The number of threads used to run job steps
+            profiler (TaskProfiler): (optional) Runs the steps, so that they can be profiled on demand
+        """
+        self._clock = SystemClock()
+        self._profiler = profiler
+        self._heap = []
+        # Every job that has not stopped, including the ones whose step is running
+        self._jobs: Set[ScheduledJob] = set()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="worker")
+        self._running = False
+        self._thread = threading.Thread(name=self._THREAD_NAME, target=self._dispatch, args=())
+        self._thread.daemon = True
+
+
+    def schedule(self,
+                 name: str,
+                 step: Callable[[], float],
+                 delaySeconds: float = 0,
+                 labels: Dict[str, str] = None) -> ScheduledJob:
+        """
+        Adds a repeating job to the timeline.
+
+        Parameters:
+            name (str): The name of the job, used as the thread name while its step runs
+            step (callable): Performs one iteration and returns the seconds until the next one
+            delaySeconds (float): The seconds to wait before the first iteration
+            labels (Dict): (optional) Further identify the job in metrics, e.g. its location
+
+        Returns:
+            ScheduledJob: A handle that can be used to cancel the job
+        """
+
+        job = ScheduledJob(name, step, labels)
+        with self._condition:
+            self._jobs.add(job)
+        self._push(job, delaySeconds)
+        return job
+
+
+    def getClock(self) -> SystemClock:
+        """ The clock that jobs should read the current time from """
+        return self._clock
+
+
+    def cancel(self, job: ScheduledJob) -> None:
+        """ Stop a job from running again; a step that is already running completes """
+        with self._condition:
+            job.cancelled = True
+            self._jobs.discard(job)
+            # Under the lock, so a step that completes meanwhile cannot set the gauge again
+            self._NEXT_RUN.remove(job.labels)
+            self._condition.notify()
+
+
+    def jobs(self) -> List[ScheduledJob]:
+        with self._condition:
+            return list(self._jobs)
+
+
+    def start(self) -> None:
+        self._running = True
+        self._thread.start()
+
+
+    def stop(self) -> None:
+        """ Run no further steps and wait for the steps that are running to complete """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if (self._thread.is_alive()):
+            self._thread.join()
+        # Steps that were handed to the pool but have not started are skipped
+        self._pool.shutdown(wait=True)
+
+
+    def _push(self, job: ScheduledJob, delaySeconds: float) -> None:
+        with self._condition:
+            if (job.cancelled):
+                return
+            self._NEXT_RUN.set(self._clock.time() + max(0, delaySeconds), job.labels)
+            job.deadline = monotonicClock() + max(0, delaySeconds)
+            heapq.heappush(self._heap, (job.deadline, next(self._sequence), job))
+            self._condition.notify()
+
+
+    def _dispatch(self) -> None:
+        """ Routine that runs until the scheduler is stopped """
+        while True:
+            with self._condition:
+                if (not self._running):
+                    return
+
+                due_jobs = []
+                now = monotonicClock()
+                while (self._heap and self._heap[0][0] <= now):
+                    job = heapq.heappop(self._heap)[2]
+                    if (not job.cancelled):
+                        due_jobs.append(job)
+
+                if (not due_jobs):
+                    wait_seconds = self._MAX_WAIT_SECONDS
+                    if (self._heap):
+                        wait_seconds = min(wait_seconds, self._heap[0][0] - now)
+                    self._condition.wait(wait_seconds)
+                    continue
+
+            for job in due_jobs:
+                self._pool.submit(self._execute, job)
+
+
+    def _execute(self, job: ScheduledJob) -> None:
+        if (not self._running):
+            return
+
+        thread = threading.current_thread()
+        worker_name = thread.name
+        thread.name = job.name
+        start = time.perf_counter()
+        try:
+            if (self._profiler is None):
+                delay_seconds = job.step()
+            else:
+                delay_seconds = self._profiler.run(job.name, job.step)
+        except Exception:
+            job.failures += 1
+            delay_seconds = job.getRetrySeconds()
+            self.LOGGER.exception("Problem occurred while running the '{}' job, it will run again in {:.0f} seconds".format(
+                job.name, delay_seconds))
+            self._STEP_FAILURES.inc(job.labels)
+        else:
+            job.failures = 0
+        finally:
+            thread.name = worker_name
+            self._STEP_SECONDS.observe(time.perf_counter() - start, job.labels)
+
+        if (delay_seconds is None or job.cancelled):
+            self._stopJob(job)
+            return
+
+        self._push(job, delay_seconds)
+
+
+    def _stopJob(self, job: ScheduledJob) -> None:
+        with self._condition:
+            self._jobs.discard(job)
+            self._NEXT_RUN.remove(job.labels)
+
+
+class VirtualScheduler(object):
+    """
+    Runs jobs one at a time against a virtual clock. Instead of waiting for
+    a deadline, the clock is moved to it, so the jobs see the same sequence
+    of times as they would on a Scheduler, only without the waiting.
+    """
+
+    LOGGER = logging.getLogger()
+    # A job that keeps asking to run again without the clock moving would never let time pass
+    _MAX_STEPS_PER_INSTANT = 100
+
+    def __init__(self, clock: VirtualClock):
+        """
+        Constructor for the Virtual Scheduler.
+
+        Parameters:
+            clock (VirtualClock): The clock to move from deadline to deadline
+        """
+        self._clock = clock
+        self._heap = []
+        self._sequence = itertools.count()
+        self._current_job: ScheduledJob = None
+        # The jobs dropped for running again and again without time passing, with the time they were dropped at
+        self._stalled_jobs: List[Tuple[ScheduledJob, float]] = list()
+
+
+    def schedule(self,
+                 name: str,
+                 step: Callable[[], float],
+                 delaySeconds: float = 0,
+                 labels: Dict[str, str] = None) -> ScheduledJob:
+        job = ScheduledJob(name, step, labels)
+        self._push(job, delaySeconds)
+        return job
+
+
+    def getClock(self) -> VirtualClock:
+        return self._clock
+
+
+    def getCurrentJob(self) -> ScheduledJob:
+        """ The job whose step is running, if any """
+        return self._current_job
+
+
+    def cancel(self, job: ScheduledJob) -> None:
+        job.cancelled = True
+
+
+    def jobs(self) -> List[ScheduledJob]:
+        return [entry[2] for entry in self._heap if not entry[2].cancelled]
+
+
+    def getStalledJobs(self) -> List[Tuple[ScheduledJob, float]]:
+        """ The jobs that were dropped for running without time passing, with the virtual time they were dropped at """
+        return list(self._stalled_jobs)
+
+
+    def runUntil(self, epochSeconds: float) -> int:
+        """
+        Run every step that falls due before the given time.
+
+        Parameters:
+            epochSeconds (float): The virtual time to stop at
+
+        Returns:
+            int: The number of steps that ran
+        """
+
+        steps = 0
+        # Many jobs may be due at the same instant, so the steps are counted by job
+        instant, steps_at_instant = None, dict()
+        while (self._heap and self._heap[0][0] < epochSeconds):
+            deadline, _, job = heapq.heappop(self._heap)
+            if (job.cancelled):
+                continue
+
+            self._clock.set(max(deadline, self._clock.time()))
+            if (self._clock.time() != instant):
+                instant, steps_at_instant = self._clock.time(), dict()
+            steps_at_instant[job] = steps_at_instant.get(job, 0) + 1
+            if (steps_at_instant[job] > self._MAX_STEPS_PER_INSTANT):
+                self.LOGGER.error("The '" + job.name + "' job keeps running without time passing, it will not run again")
+                self._stalled_jobs.append((job, self._clock.time()))
+                continue
+
+            steps += 1
+            self._execute(job)
+
+        self._clock.set(max(epochSeconds, self._clock.time()))
+        return steps
+
+
+    def _push(self, job: ScheduledJob, delaySeconds: float) -> None:
+        job.deadline = self._clock.time() + max(0, delaySeconds)
+        heapq.heappush(self._heap, (job.deadline, next(self._sequence), job))
+
+
+    def _execute(self, job: ScheduledJob) -> None:
+        self._current_job = job
+        try:
+            delay_seconds = job.step()
+        except Exception:
+            job.failures += 1
+            delay_seconds = job.getRetrySeconds()
+            self.LOGGER.exception("Problem occurred while running the '{}' job, it will run again in {:.0f} seconds".format(
+                job.name, delay_seconds))
+        else:
+            job.failures = 0
+        finally:
+            self._current_job = None
+
+        if (delay_seconds is None or job.cancelled):
+            return
+
+        self._push(job, delay_seconds)
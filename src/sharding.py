@@ -0,0 +1,370 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from location import Location
+from pathlib import Path
+from typing import Callable, Dict, Set, Tuple
+from util import initDataDir
+
+# The owner and the epoch seconds at which it expires, by lease name
+Leases = Dict[str, Tuple[str, float]]
+
+
+def getShard(location: Location, shardCount: int) -> int:
+    """
+    The shard a location belongs to, the same on every replica and every run.
+
+    Parameters:
+        location (Location): The location
+        shardCount (int): The number of shards
+
+    Returns:
+        int: The shard, from 0 to shardCount - 1
+    """
+
+    return zlib.crc32(location.key.encode("utf-8")) % shardCount
+
+
+class FileLeaseStore(object):
+    """
+    Keeps the leases in a JSON file of the shared data directory,
+    data/leases/leases.json. Replicas take turns through an exclusive lock
+    on a file next to it, so the directory must be on a file system with
+    working advisory locks, such as a local disk or volume.
+    """
+
+    _DIR_NAME = "leases"
+    _LEASES_FILE_NAME = "leases.json"
+    _LOCK_FILE_NAME = "leases.lock"
+    _TEMP_SUFFIX = ".tmp"
+
+    def __init__(self, dataDir: Path = None):
+        """
+        Constructor for the File Lease Store.
+
+        Parameters:
+            dataDir (Path): (optional) The directory of the leases, data/leases by default
+        """
+        try:
+            import fcntl
+        except ImportError:
+            raise RuntimeError("Leases in files need advisory file locks, use the sqlite state backend instead") from None
+        self._fcntl = fcntl
+        if (dataDir is None):
+            dataDir = initDataDir(self._DIR_NAME)
+        self._leases_path = Path.joinpath(dataDir, self._LEASES_FILE_NAME)
+        self._lock_path = Path.joinpath(dataDir, self._LOCK_FILE_NAME)
+        self._lock = threading.Lock()
+
+
+    def transact(self, function: Callable[[Leases], object]) -> object:
+        """
+        Read the leases, let a function change them and write them back, with
+        no other replica in between.
+
+        Parameters:
+            function (callable): Changes the leases it is given in place
+
+        Returns:
+            The result of the function
+        """
+
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            self._fcntl.flock(lock_file, self._fcntl.LOCK_EX)
+            try:
+                leases = self._read()
+                result = function(leases)
+                self._write(leases)
+                return result
+            finally:
+                self._fcntl.flock(lock_file, self._fcntl.LOCK_UN)
+
+
+    def close(self) -> None:
+        pass
+
+
+    def _read(self) -> Leases:
+        if (not self._leases_path.exists()):
+            return dict()
+        try:
+            with open(self._leases_path, "r") as fp:
+                return {name: (owner, expires_at) for name, (owner, expires_at) in json.load(fp).items()}
+        except ValueError:
+            # Every lease is renewed within its lifetime, so losing them only delays a takeover
+            return dict()
+
+
+    def _write(self, leases: Leases) -> None:
+        temp_path = Path(str(self._leases_path) + self._TEMP_SUFFIX)
+        with open(temp_path, "w") as fw:
+            json.dump(leases, fw)
+            fw.flush()
+            os.fsync(fw.fileno())
+        os.replace(temp_path, self._leases_path)
+
+
+class SQLiteLeaseStore(object):
+    """
+    Keeps the leases in a table of the SQLite state database, where a write
+    transaction keeps other replicas out while the leases change.
+    """
+
+    # The database that SQLiteStateBackend keeps the task state in
+    _DATABASE_FILE_NAME = "state.sqlite3"
+    _BUSY_TIMEOUT_SECONDS = 30
+
+    def __init__(self, databasePath: Path = None):
+        """
+        Constructor for the SQLite Lease Store.
+
+        Parameters:
+            databasePath (Path): (optional) The database file, data/state.sqlite3 by default
+        """
+        if (databasePath is None):
+            databasePath = Path.joinpath(initDataDir(""), self._DATABASE_FILE_NAME)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(databasePath),
+                                           timeout=self._BUSY_TIMEOUT_SECONDS,
+                                           check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS lease ("
+            " name TEXT PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires_at REAL NOT NULL"
+            ") WITHOUT ROWID")
+
+
+    def transact(self, function: Callable[[Leases], object]) -> object:
+        """
+        Read the leases, let a function change them and write them back, with
+        no other replica in between.
+
+        Parameters:
+            function (callable): Changes the leases it is given in place
+
+        Returns:
+            The result of the function
+        """
+
+        with self._lock:
+            # Take the write lock up front, so two replicas never both read the old leases
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                leases = {name: (owner, expires_at) for name, owner, expires_at
+                          in self._connection.execute("SELECT name, owner, expires_at FROM lease")}
+                before = dict(leases)
+                result = function(leases)
+                self._connection.executemany("DELETE FROM lease WHERE name = ?",
+                                             [(name,) for name in before if name not in leases])
+                self._connection.executemany(
+                    "INSERT INTO lease (name, owner, expires_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                    [(name, owner, expires_at) for name, (owner, expires_at) in leases.items()
+                     if before.get(name) != (owner, expires_at)])
+                self._connection.execute("COMMIT")
+                return result
+            except BaseException:
+                if (self._connection.in_transaction):
+                    self._connection.execute("ROLLBACK")
+                raise
+
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class ShardCoordinator(object):
+    """
+    Spreads the shards of the location set over the replicas that share a
+    data directory or state database. Every replica keeps a lease on itself
+    and on each shard it serves, renewing them well before they expire on a
+    thread of its own, so busy tasks never delay a renewal. A replica takes
+    its fair share of the shards, claiming the ones without an owner or
+    whose lease lapsed, e.g. because their replica died. The shares differ
+    by at most one shard, the replicas first by their identifier taking the
+    larger ones, so every replica serves a shard when there are enough of
+    them. A replica
+    that holds more than its share, e.g. when another one starts, gives up
+    the extra shards; they stay unclaimed until their lease would have
+    expired, so no two replicas ever serve a shard at the same time.
+
+    Leases compare the clocks of the replicas, which must therefore agree to
+    within a small fraction of the lease time.
+    """
+
+    LOGGER = logging.getLogger()
+    _THREAD_NAME = "shards"
+    _REPLICA_PREFIX = "replica:"
+    _SHARD_PREFIX = "shard:"
+    # Renew this many times per lease time, so a late renewal does not lose the lease
+    _RENEWALS_PER_LEASE = 3
+
+    def __init__(self,
+                 leaseStore,
+                 replicaId: str,
+                 shardCount: int,
+                 leaseSeconds: float,
+                 clock: Callable[[], float] = time.time):
+        """
+        Constructor for the Shard Coordinator.
+
+        Parameters:
+            leaseStore (FileLeaseStore | SQLiteLeaseStore): Where the replicas keep their leases
+            replicaId (str): Identifies this replica, unique among the replicas
+            shardCount (int): The number of shards the locations are spread over
+            leaseSeconds (float): How long a lease lasts without being renewed
+            clock (callable): (optional) Returns the current epoch seconds
+        """
+        self._lease_store = leaseStore
+        self._replica_id = replicaId
+        self._shard_count = shardCount
+        self._lease_seconds = leaseSeconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._owned: Set[int] = set()
+        # Until when the owned shards are certain to be ours, even if a renewal fails
+        self._owned_until = 0.0
+        self._on_change: Callable[[Set[int]], None] = None
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+
+    def refresh(self) -> Set[int]:
+        """
+        Renew the leases of this replica and claim or give up shards to hold
+        its fair share.
+
+        Returns:
+            Set: The shards this replica serves
+        """
+
+        started_at = self._clock()
+        try:
+            owned = self._lease_store.transact(lambda leases: self._balance(leases, started_at))
+            owned_until = started_at + self._lease_seconds
+        except Exception:
+            self.LOGGER.exception("Problem occurred while renewing the shard leases")
+            with self._lock:
+                owned = self._owned
+                owned_until = self._owned_until
+            if (self._clock() >= owned_until - self._lease_seconds / self._RENEWALS_PER_LEASE):
+                # Give the shards up before another replica may claim them
+                owned = set()
+
+        with self._lock:
+            changed = owned != self._owned
+            if (changed):
+                self.LOGGER.info("Serving {} of {} shard(s): {}".format(
+                    len(owned), self._shard_count, ", ".join(str(shard) for shard in sorted(owned)) or "none"))
+            self._owned = set(owned)
+            self._owned_until = owned_until
+            on_change = self._on_change
+
+        if (changed and on_change is not None):
+            on_change(set(owned))
+        return set(owned)
+
+
+    def start(self, onChange: Callable[[Set[int]], None]) -> None:
+        """
+        Refresh the leases periodically from now on.
+
+        Parameters:
+            onChange (callable): Receives the shards this replica serves whenever they change
+        """
+
+        with self._lock:
+            self._on_change = onChange
+        self._thread = threading.Thread(name=self._THREAD_NAME, target=self._renewLoop, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def release(self) -> None:
+        """
+        Give up every lease of this replica, so the others take its shards
+        over right away. Only call it once the locations are no longer served.
+        """
+
+        self._stopped.set()
+        if (self._thread is not None):
+            # A refresh in progress would otherwise renew the leases right after they are released
+            self._thread.join(self._lease_seconds)
+
+        def releaseAll(leases: Leases) -> None:
+            for name, (owner, expires_at) in list(leases.items()):
+                if (owner == self._replica_id):
+                    del leases[name]
+
+        try:
+            self._lease_store.transact(releaseAll)
+        except Exception:
+            self.LOGGER.exception("Problem occurred while releasing the shard leases")
+        with self._lock:
+            self._owned = set()
+        self._lease_store.close()
+
+
+    def isServed(self, location: Location) -> bool:
+        """ Whether the location belongs to a shard whose lease this replica holds """
+        with self._lock:
+            if (self._clock() >= self._owned_until):
+                return False
+            return getShard(location, self._shard_count) in self._owned
+
+
+    def _renewLoop(self) -> None:
+        """ Routine that refreshes the leases until they are released """
+        while (not self._stopped.wait(self._getRefreshSeconds())):
+            try:
+                self.refresh()
+            except Exception:
+                # A failure to serve the new shards must not stop the renewals
+                self.LOGGER.exception("Problem occurred while changing the served shards")
+
+
+    def _getRefreshSeconds(self) -> float:
+        return self._lease_seconds / self._RENEWALS_PER_LEASE
+
+
+    def _balance(self, leases: Leases, now: float) -> Set[int]:
+        expires_at = now + self._lease_seconds
+        leases[self._REPLICA_PREFIX + self._replica_id] = (self._replica_id, expires_at)
+
+        replicas = set()
+        for name, (owner, lease_expires_at) in list(leases.items()):
+            if (lease_expires_at <= now):
+                del leases[name]
+            elif (name.startswith(self._REPLICA_PREFIX)):
+                replicas.add(owner)
+        # The first replicas by identifier take one more shard each, until none are left over
+        index = sorted(replicas).index(self._replica_id)
+        fair_share = self._shard_count // len(replicas) + (1 if index < self._shard_count % len(replicas) else 0)
+
+        owned = list()
+        free = list()
+        for shard in range(self._shard_count):
+            lease = leases.get(self._SHARD_PREFIX + str(shard))
+            if (lease is None):
+                free.append(shard)
+            elif (lease[0] == self._replica_id):
+                owned.append(shard)
+
+        for shard in owned[fair_share:]:
+            # Nobody owns the shard, but nobody may claim it before its lease would have expired
+            name = self._SHARD_PREFIX + str(shard)
+            leases[name] = ("", leases[name][1])
+        owned = owned[:fair_share] + free[:max(0, fair_share - len(owned))]
+
+        for shard in owned:
+            leases[self._SHARD_PREFIX + str(shard)] = (self._replica_id, expires_at)
+        return set(owned)
@@ -0,0 +1,205 @@
+import json
+import logging
+import time
+
+from clock import VirtualClock
+from datetime import date, datetime, timedelta
+from location import Location
+from pathlib import Path
+from pylunar import MoonInfo
+from pytz import utc
+from scheduler import ScheduledJob, VirtualScheduler
+from solartable import SolarTimeTable
+from statestore import MemoryStateBackend, StateStore
+from tasks.lunartime import LunarTimeTask
+from tasks.solartime import SolarTimeTask
+from twitter import TwitterUtil
+from typing import Dict, List, Tuple
+from util import decToDegMinSec, tupleToDateTime
+
+
+class Simulation(object):
+    """
+    Runs the solar and lunar tasks of a set of locations over a range of
+    dates on a virtual clock, as fast as the steps can be computed. Every
+    message that would have been tweeted is written out with its virtual
+    timestamp, and then matched against the sunrises and moonrises of the
+    range to find the ones that were missed or tweeted more than once, along
+    with the tasks that were stopped for running without time passing.
+
+    State is kept in memory only, so a simulation never touches the state of
+    a running bot. Air quality is not simulated because it needs AirNow
+    responses for the simulated dates.
+    """
+
+    LOGGER = logging.getLogger()
+    # A message is due within the hour before the event it announces
+    _WINDOW_SECONDS = 3600
+    # Allows for the moon's rise time shifting by a second between calculations
+    _TOLERANCE_SECONDS = 60
+
+    def __init__(self, locations: List[Location], start: date, end: date, outputPath: Path):
+        """
+        Constructor for the Simulation.
+
+        Parameters:
+            locations (Location[]): The locations to simulate
+            start (date): The first date to simulate, from midnight UTC
+            end (date): The date to stop at, at midnight UTC (exclusive)
+            outputPath (Path): The file that receives the simulated tweets, one JSON object per line
+        """
+        if (end <= start):
+            raise ValueError("The simulation must end after it starts")
+
+        self._locations = locations
+        self._start = datetime.combine(start, datetime.min.time(), tzinfo=utc)
+        self._end = datetime.combine(end, datetime.min.time(), tzinfo=utc)
+        self._output_path = outputPath
+        self._clock = VirtualClock(self._start.timestamp())
+        self._scheduler = VirtualScheduler(self._clock)
+        self._solar_table = SolarTimeTable(locations)
+        self._jobs: Dict[ScheduledJob, Tuple[Location, str]] = {}
+        self._tweets: List[Dict] = list()
+
+
+    def run(self) -> Dict:
+        """
+        Run the simulation and check the tweets.
+
+        Returns:
+            Dict: The report of the simulation
+        """
+
+        state_store = StateStore(backend=MemoryStateBackend())
+        for location in self._locations:
+            self._track(location, "solartime", lambda: SolarTimeTask(self._scheduler, location, state_store, self._solar_table))
+            self._track(location, "lunartime", lambda: LunarTimeTask(self._scheduler, location, state_store))
+
+        self.LOGGER.info("Simulating {} location(s) from {} to {}".format(
+            len(self._locations), self._start.date().isoformat(), self._end.date().isoformat()))
+
+        self._output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._output_path, 'w') as self._output:
+            TwitterUtil.redirect(self._record)
+            try:
+                wall_start = time.perf_counter()
+                steps = self._scheduler.runUntil(self._end.timestamp())
+                wall_seconds = time.perf_counter() - wall_start
+            finally:
+                TwitterUtil.redirect(None)
+
+        missed, duplicates, unexpected = self._check()
+        stalled = list()
+        for job, stalled_at in self._scheduler.getStalledJobs():
+            location, task_name = self._jobs[job]
+            stalled.append({"location": location.key or location.name,
+                            "task": task_name,
+                            "time": datetime.fromtimestamp(stalled_at, location.getTimeZone()).isoformat()})
+        virtual_days = (self._end - self._start).total_seconds() / 86400
+        return {
+            "locations": len(self._locations),
+            "days": virtual_days,
+            "steps": steps,
+            "wall_seconds": wall_seconds,
+            "steps_per_second": steps / wall_seconds if wall_seconds > 0 else None,
+            "days_per_second": virtual_days / wall_seconds if wall_seconds > 0 else None,
+            "tweets": len(self._tweets),
+            "missed": missed,
+            "duplicates": duplicates,
+            "unexpected": unexpected,
+            "stalled": stalled
+        }
+
+
+    def _track(self, location: Location, taskName: str, createTask) -> None:
+        # Remember which location and task every new job belongs to
+        known_jobs = set(self._scheduler.jobs())
+        createTask()
+        for job in self._scheduler.jobs():
+            if (job not in known_jobs):
+                self._jobs[job] = (location, taskName)
+
+
+    def _record(self, message: str) -> None:
+        location, task_name = self._jobs[self._scheduler.getCurrentJob()]
+        tweet = {
+            "time": self._clock.now(location.getTimeZone()).isoformat(),
+            "location": location.key or location.name,
+            "task": task_name,
+            "message": message
+        }
+        self._tweets.append(tweet)
+        self._output.write(json.dumps(tweet) + "\n")
+
+
+    def _check(self) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+        missed, duplicates, unexpected = list(), list(), list()
+        for location in self._locations:
+            location_id = location.key or location.name
+            for task_name, events in (("solartime", self._getSunrises(location)),
+                                      ("lunartime", self._getMoonrises(location))):
+                tweet_times = [datetime.fromisoformat(tweet["time"]) for tweet in self._tweets
+                               if tweet["location"] == location_id and tweet["task"] == task_name]
+                matched = set()
+                for event in events:
+                    window_start = event - timedelta(seconds=self._WINDOW_SECONDS + self._TOLERANCE_SECONDS)
+                    window_end = event + timedelta(seconds=self._TOLERANCE_SECONDS)
+                    in_window = [t for t in tweet_times if window_start <= t <= window_end]
+                    matched.update(in_window)
+                    finding = {"location": location_id, "task": task_name, "event": event.isoformat()}
+                    if (not in_window):
+                        missed.append(finding)
+                    elif (len(in_window) > 1):
+                        duplicates.append({**finding, "tweets": [t.isoformat() for t in in_window]})
+                for tweet_time in tweet_times:
+                    if (tweet_time not in matched):
+                        unexpected.append({"location": location_id, "task": task_name, "time": tweet_time.isoformat()})
+        return missed, duplicates, unexpected
+
+
+    def _getSunrises(self, location: Location) -> List[datetime]:
+        if (not location.region):
+            # The solar task refuses to run without a region
+            return list()
+
+        sunrises = list()
+        tzone = location.getTimeZone()
+        day = self._start.astimezone(tzone).date()
+        while (day <= self._end.astimezone(tzone).date()):
+            try:
+                sunrises.append(self._solar_table.lookup(location, day)["sunrise"])
+            except ValueError:
+                pass
+            day += timedelta(days=1)
+        return [sunrise for sunrise in sunrises if self._isWithinRange(sunrise)]
+
+
+    def _getMoonrises(self, location: Location) -> List[datetime]:
+        tzone = location.getTimeZone()
+        moon_info = MoonInfo(decToDegMinSec(location.latitude), decToDegMinSec(location.longitude))
+        found = list()
+        day = self._start.astimezone(tzone).date()
+        while (day <= self._end.astimezone(tzone).date()):
+            noon = utc.normalize(tzone.localize(datetime.combine(day, datetime.min.time()) + timedelta(hours=12)))
+            moon_info.update((noon.year, noon.month, noon.day, noon.hour, noon.minute, noon.second))
+            day += timedelta(days=1)
+            try:
+                moon_times = moon_info.rise_set_times(location.timezone)
+            except Exception:
+                # Near the poles the moon can stay below or above the horizon all day
+                continue
+            for kind, value in moon_times:
+                if (kind == "rise" and type(value) is tuple):
+                    found.append(tupleToDateTime(value, tzone))
+
+        # The same rise may be found from two dates, a second or so apart
+        moonrises = list()
+        for moonrise in sorted(found):
+            if (not moonrises or (moonrise - moonrises[-1]).total_seconds() > self._TOLERANCE_SECONDS):
+                moonrises.append(moonrise)
+        return [moonrise for moonrise in moonrises if self._isWithinRange(moonrise)]
+
+
+    def _isWithinRange(self, event: datetime) -> bool:
+        # Only events whose whole window was simulated can be checked
+        return self._start + timedelta(seconds=self._WINDOW_SECONDS) <= event < self._end
@@ -0,0 +1,211 @@
+import logging
+import numpy
+import threading
+
+from datetime import date, datetime, timedelta
+from location import Location
+from metrics import REGISTRY
+from pytz import utc
+from typing import Dict, List
+
+
+class SolarTimeTable(object):
+    """
+    Sunrise, solar noon and sunset for a set of locations over every day of a
+    year. A year is computed for all locations at once, with the same NOAA
+    equations that astral 2.2 uses for sun(), evaluated as NumPy array math.
+    Each year is stored as an int64 array of UTC epoch microseconds shaped
+    (event, location, day), so a lookup is a pair of index operations.
+    """
+
+    LOGGER = logging.getLogger()
+    _EPHEMERIS_SECONDS = REGISTRY.histogram("wxbot_ephemeris_seconds", "Time spent computing sun and moon ephemerides")
+    EVENTS = ("sunrise", "noon", "sunset")
+    _EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+    _EPOCH_JULIAN_DAY = 2440587.5
+    # Zenith of the sun's upper limb at sunrise and sunset, using 32 arc minutes as the apparent diameter
+    _HORIZON_ZENITH = 90.0 + 32.0 / (60.0 * 2.0)
+    _MAX_LATITUDE = 89.8
+    # Marks a day on which the sun does not cross the horizon
+    _MISSING = numpy.iinfo(numpy.int64).min
+
+    def __init__(self, locations: List[Location]):
+        """
+        Constructor for the Solar Time Table.
+
+        Parameters:
+            locations (Location[]): The locations to compute solar times for
+        """
+        self._indexes: Dict[Location, int] = {location: index for index, location in enumerate(locations)}
+        self._latitudes = numpy.array([location.latitude for location in locations], dtype=numpy.float64)
+        self._longitudes = numpy.array([location.longitude for location in locations], dtype=numpy.float64)
+        self._years: Dict[int, numpy.ndarray] = {}
+        self._lock = threading.Lock()
+
+
+    def contains(self, location: Location) -> bool:
+        return location in self._indexes
+
+
+    def lookup(self, location: Location, day: date) -> Dict[str, datetime]:
+        """
+        Retrieve the solar times of a location for a date, computing the whole
+        year for every location when it has not been computed yet.
+
+        Parameters:
+            location (Location): One of the locations of the table
+            day (date): The date to retrieve, as astral's sun() interprets it
+
+        Returns:
+            Dict: timezone aware "sunrise", "noon" and "sunset" in the location's timezone
+
+        Raises:
+            ValueError: when the sun does not rise or set on that date at the location
+        """
+
+        times = self.getYear(day.year)[:, self._indexes[location], day.timetuple().tm_yday - 1]
+        if (self._MISSING in times):
+            raise ValueError("Sun does not cross the horizon on " + day.isoformat() + " at " + location.name)
+
+        tzone = location.getTimeZone()
+        return {event: (self._EPOCH + timedelta(microseconds=int(value))).astimezone(tzone)
+                for event, value in zip(self.EVENTS, times)}
+
+
+    def getYear(self, year: int) -> numpy.ndarray:
+        with self._lock:
+            table = self._years.get(year)
+            if (table is None):
+                self.LOGGER.info("Computing solar times of {} for {} location(s)".format(year, len(self._indexes)))
+                with self._EPHEMERIS_SECONDS.time({"kind": "solar_year"}):
+                    table = self._computeYear(year)
+                self._years[year] = table
+                # Only the current and the next year are ever looked up
+                for stale_year in [y for y in self._years if y < year - 1]:
+                    del self._years[stale_year]
+            return table
+
+
+    def _computeYear(self, year: int) -> numpy.ndarray:
+        first_day = (date(year, 1, 1) - self._EPOCH.date()).days
+        day_count = (date(year + 1, 1, 1) - date(year, 1, 1)).days
+        epoch_days = numpy.arange(first_day, first_day + day_count, dtype=numpy.int64)
+
+        julian_days = (self._EPOCH_JULIAN_DAY + epoch_days)[numpy.newaxis, :]
+        latitudes = numpy.clip(self._latitudes, -self._MAX_LATITUDE, self._MAX_LATITUDE)[:, numpy.newaxis]
+        longitudes = self._longitudes[:, numpy.newaxis]
+        midnights = (epoch_days * 86400 * 1000000)[numpy.newaxis, :]
+
+        with numpy.errstate(invalid='ignore'):
+            sunrise = self._timeOfTransit(julian_days, latitudes, longitudes, 1.0)
+            sunset = self._timeOfTransit(julian_days, latitudes, longitudes, -1.0)
+        noon = self._noon(julian_days, longitudes)
+
+        table = numpy.empty((len(self.EVENTS), len(self._indexes), day_count), dtype=numpy.int64)
+        table[0] = self._minutesToMicroseconds(sunrise) + midnights
+        table[1] = noon + midnights
+        table[2] = self._minutesToMicroseconds(sunset) + midnights
+        table[0][numpy.isnan(sunrise)] = self._MISSING
+        table[2][numpy.isnan(sunset)] = self._MISSING
+        return table
+
+
+    def _timeOfTransit(self,
+                       julianDays: numpy.ndarray,
+                       latitudes: numpy.ndarray,
+                       longitudes: numpy.ndarray,
+                       direction: float) -> numpy.ndarray:
+        """ Minutes after UTC midnight at which the sun crosses the horizon (direction 1 rising, -1 setting) """
+        refraction = self._refractionAtZenith(self._HORIZON_ZENITH)
+
+        t = (julianDays - 2451545.0) / 36525.0
+        hour_angle = self._hourAngle(latitudes, self._sunDeclination(t), self._HORIZON_ZENITH - refraction, direction)
+        time_utc = 720.0 + 4.0 * (-longitudes - numpy.degrees(hour_angle)) - self._eqOfTime(t)
+
+        t = ((t * 36525.0) + 2451545.0 + time_utc / 1440.0 - 2451545.0) / 36525.0
+        hour_angle = self._hourAngle(latitudes, self._sunDeclination(t), self._HORIZON_ZENITH + refraction, direction)
+        return 720 + 4.0 * (-longitudes - numpy.degrees(hour_angle)) - self._eqOfTime(t)
+
+
+    def _noon(self, julianDays: numpy.ndarray, longitudes: numpy.ndarray) -> numpy.ndarray:
+        """ Microseconds after UTC midnight of solar noon, truncated to the second like astral """
+        t = (julianDays - 2451545.0) / 36525.0
+        time_utc = (720.0 - (4 * longitudes) - self._eqOfTime(t)) / 60.0
+
+        hour = numpy.trunc(time_utc)
+        minute = numpy.trunc((time_utc - hour) * 60)
+        second = numpy.trunc((((time_utc - hour) * 60) - minute) * 60)
+        return ((hour * 3600 + minute * 60 + second) * 1000000).astype(numpy.int64)
+
+
+    @staticmethod
+    def _minutesToMicroseconds(minutes: numpy.ndarray) -> numpy.ndarray:
+        days = numpy.trunc(minutes / 1440)
+        seconds = (minutes - days * 1440) * 60
+        whole_seconds = numpy.trunc(seconds)
+        microseconds = numpy.trunc((seconds - whole_seconds) * 1000000)
+        result = (days * 86400 + whole_seconds) * 1000000 + microseconds
+        return numpy.nan_to_num(result).astype(numpy.int64)
+
+
+    @staticmethod
+    def _sunDeclination(t: numpy.ndarray) -> numpy.ndarray:
+        obliquity, apparent_longitude = SolarTimeTable._obliquityAndApparentLongitude(t)
+        return numpy.degrees(numpy.arcsin(numpy.sin(numpy.radians(obliquity)) * numpy.sin(numpy.radians(apparent_longitude))))
+
+
+    @staticmethod
+    def _obliquityAndApparentLongitude(t: numpy.ndarray):
+        mean_longitude = (280.46646 + t * (36000.76983 + 0.0003032 * t)) % 360.0
+        mean_anomaly = numpy.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+        center = (numpy.sin(mean_anomaly) * (1.914602 - t * (0.004817 + 0.000014 * t))
+                  + numpy.sin(mean_anomaly + mean_anomaly) * (0.019993 - 0.000101 * t)
+                  + numpy.sin(mean_anomaly + mean_anomaly + mean_anomaly) * 0.000289)
+        omega = numpy.radians(125.04 - 1934.136 * t)
+        apparent_longitude = mean_longitude + center - 0.00569 - 0.00478 * numpy.sin(omega)
+
+        seconds = 21.448 - t * (46.815 + t * (0.00059 - t * (0.001813)))
+        obliquity = 23.0 + (26.0 + (seconds / 60.0)) / 60.0 + 0.00256 * numpy.cos(omega)
+        return obliquity, apparent_longitude
+
+
+    @staticmethod
+    def _eqOfTime(t: numpy.ndarray) -> numpy.ndarray:
+        mean_longitude = (280.46646 + t * (36000.76983 + 0.0003032 * t)) % 360.0
+        eccentricity = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+        mean_anomaly = 357.52911 + t * (35999.05029 - 0.0001537 * t)
+        obliquity, _ = SolarTimeTable._obliquityAndApparentLongitude(t)
+        y = numpy.tan(numpy.radians(obliquity) / 2.0)
+        y = y * y
+
+        sin2l0 = numpy.sin(2.0 * numpy.radians(mean_longitude))
+        sinm = numpy.sin(numpy.radians(mean_anomaly))
+        cos2l0 = numpy.cos(2.0 * numpy.radians(mean_longitude))
+        sin4l0 = numpy.sin(4.0 * numpy.radians(mean_longitude))
+        sin2m = numpy.sin(2.0 * numpy.radians(mean_anomaly))
+
+        e_time = (y * sin2l0
+                  - 2.0 * eccentricity * sinm
+                  + 4.0 * eccentricity * y * sinm * cos2l0
+                  - 0.5 * y * y * sin4l0
+                  - 1.25 * eccentricity * eccentricity * sin2m)
+        return numpy.degrees(e_time) * 4.0
+
+
+    @staticmethod
+    def _hourAngle(latitudes: numpy.ndarray, declinations: numpy.ndarray, zenith: float, direction: float) -> numpy.ndarray:
+        latitude_rad = numpy.radians(latitudes)
+        declination_rad = numpy.radians(declinations)
+        h = ((numpy.cos(numpy.radians(zenith)) - numpy.sin(latitude_rad) * numpy.sin(declination_rad))
+             / (numpy.cos(latitude_rad) * numpy.cos(declination_rad)))
+        return direction * numpy.arccos(h)
+
+
+    @staticmethod
+    def _refractionAtZenith(zenith: float) -> float:
+        # The horizon zenith always falls in astral's low elevation branch
+        elevation = 90 - zenith
+        step1 = -12.79 + elevation * 0.711
+        step2 = 103.4 + elevation * step1
+        step3 = -518.2 + elevation * step2
+        return (1735.0 + elevation * step3) / 3600.0
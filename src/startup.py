@@ -0,0 +1,60 @@
+import sys
+import time
+
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+
+
+class StartupTimer(object):
+    """
+    Times the phases of starting the application, such as loading and
+    creating each subsystem, and summarizes them in a single report. The
+    report also names the packages that each phase imported first, so a
+    slow phase can be traced to the import that made it slow, much like
+    python -X importtime but per subsystem.
+    """
+
+    # Standard library modules are left out, they are rarely what makes a phase slow
+    _STDLIB_NAMES = frozenset(getattr(sys, "stdlib_module_names", ()))
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._phases: List[Tuple[str, float, List[str]]] = []
+
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Time the body of a with statement as a phase of the startup.
+
+        Parameters:
+            name (str): The name of the phase, e.g. the subsystem it starts
+        """
+
+        modules_before = set(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            packages = {module.split(".")[0] for module in set(sys.modules) - modules_before}
+            self._phases.append((name, elapsed, sorted(package for package in packages
+                                                       if package not in self._STDLIB_NAMES
+                                                       and not package.startswith("_"))))
+
+
+    def report(self) -> str:
+        """
+        Summarize the phases timed so far.
+
+        Returns:
+            str: One line for the whole startup followed by one line per phase
+        """
+
+        lines = ["Startup took {:.3f} seconds".format(time.perf_counter() - self._start)]
+        for name, elapsed, packages in self._phases:
+            line = "  {:<12} {:8.3f} s".format(name, elapsed)
+            if (packages):
+                line += "  imported " + ", ".join(packages)
+            lines.append(line)
+        return "\n".join(lines)
@@ -0,0 +1,310 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from const import DATA_FILE_EXT
+from metrics import REGISTRY
+from pathlib import Path
+from scheduler import Scheduler
+from typing import Callable, Dict, List, Tuple
+from util import getDataDir, initDataDir
+
+
+class FileStateBackend(object):
+    """
+    Stores each state in its own JSON file, data/<task>/<location>/<task>.json.
+    A file is replaced atomically and the previous version is kept as a backup,
+    so an interrupted write can never leave a task without its state.
+    """
+
+    LOGGER = logging.getLogger()
+    _BACKUP_SUFFIX = ".bak"
+    _TEMP_SUFFIX = ".tmp"
+    _CORRUPT_SUFFIX = ".corrupt"
+
+    def read(self, taskName: str, locationKey: str) -> Dict:
+        filePath = Path.joinpath(getDataDir(taskName, locationKey), taskName + DATA_FILE_EXT)
+        backup_path = Path(str(filePath) + self._BACKUP_SUFFIX)
+        for path in (filePath, backup_path):
+            if (not path.exists() or path.stat().st_size == 0):
+                continue
+            try:
+                with open(path, 'r') as fp:
+                    state = json.load(fp)
+                if (path == backup_path):
+                    self.LOGGER.warning("Recovered state from backup " + str(backup_path))
+                return state
+            except ValueError:
+                corrupt_path = Path(str(path) + self._CORRUPT_SUFFIX + "-" + str(int(time.time())))
+                self.LOGGER.error("State file {} is unreadable, moved it to {}".format(path, corrupt_path))
+                os.replace(path, corrupt_path)
+        return None
+
+
+    def write(self, states: List[Tuple[Tuple[str, str], Dict]]) -> List[Tuple[str, str]]:
+        """
+        Write a batch of states.
+
+        Parameters:
+            states (List): Pairs of (task name, location key) and the state to write
+
+        Returns:
+            List: The (task name, location key) of every state that could not be written
+        """
+
+        failed = list()
+        for key, state in states:
+            try:
+                self._writeState(self._getFilePath(*key), state)
+            except Exception:
+                self.LOGGER.exception("Problem occurred while writing the state of " + "/".join(key))
+                failed.append(key)
+        return failed
+
+
+    def close(self) -> None:
+        pass
+
+
+    def _getFilePath(self, taskName: str, locationKey: str) -> Path:
+        return Path.joinpath(initDataDir(taskName, locationKey), taskName + DATA_FILE_EXT)
+
+
+    def _writeState(self, filePath: Path, state: Dict) -> None:
+        temp_path = Path(str(filePath) + self._TEMP_SUFFIX)
+        with open(temp_path, 'w') as fw:
+            json.dump(state, fw)
+            fw.flush()
+            os.fsync(fw.fileno())
+
+        if (filePath.exists()):
+            os.replace(filePath, Path(str(filePath) + self._BACKUP_SUFFIX))
+        os.replace(temp_path, filePath)
+
+
+class SQLiteStateBackend(object):
+    """
+    Stores every state as a row of a single SQLite database, keyed by task
+    and location, so a large number of locations costs one open file rather
+    than one file per task and location. The database runs in WAL mode and a
+    batch of states is upserted in a single transaction. States that are not
+    in the database yet are read from the file layout, so switching backends
+    keeps the state that was already saved.
+    """
+
+    LOGGER = logging.getLogger()
+    _DATABASE_FILE_NAME = "state.sqlite3"
+
+    def __init__(self, databasePath: Path = None):
+        """
+        Constructor for the SQLite State Backend.
+
+        Parameters:
+            databasePath (Path): (optional) The database file, data/state.sqlite3 by default
+        """
+        if (databasePath is None):
+            databasePath = Path.joinpath(initDataDir(""), self._DATABASE_FILE_NAME)
+        self._lock = threading.Lock()
+        self._legacy = FileStateBackend()
+        self._connection = sqlite3.connect(str(databasePath), check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " task TEXT NOT NULL,"
+            " location TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (task, location)"
+            ") WITHOUT ROWID")
+        self.LOGGER.info("Keeping task state in " + str(databasePath))
+
+
+    def read(self, taskName: str, locationKey: str) -> Dict:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM state WHERE task = ? AND location = ?",
+                (taskName, locationKey)).fetchone()
+        if (row is None):
+            return self._legacy.read(taskName, locationKey)
+        return json.loads(row[0])
+
+
+    def write(self, states: List[Tuple[Tuple[str, str], Dict]]) -> List[Tuple[str, str]]:
+        """
+        Upsert a batch of states in one transaction.
+
+        Parameters:
+            states (List): Pairs of (task name, location key) and the state to write
+
+        Returns:
+            List: The (task name, location key) of every state that could not be written
+        """
+
+        now = time.time()
+        rows = [(task, location, json.dumps(state), now) for (task, location), state in states]
+        with self._lock:
+            try:
+                self._connection.execute("BEGIN")
+                self._connection.executemany(
+                    "INSERT INTO state (task, location, state, updated_at) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (task, location) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                    rows)
+                self._connection.execute("COMMIT")
+            except sqlite3.Error:
+                self.LOGGER.exception("Problem occurred while writing {} state(s)".format(len(rows)))
+                if (self._connection.in_transaction):
+                    self._connection.execute("ROLLBACK")
+                return [key for key, _ in states]
+        return list()
+
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class MemoryStateBackend(object):
+    """
+    Keeps nothing, so a store that uses it only holds states in memory.
+    """
+
+    def read(self, taskName: str, locationKey: str) -> Dict:
+        return None
+
+
+    def write(self, states: List[Tuple[Tuple[str, str], Dict]]) -> List[Tuple[str, str]]:
+        return list()
+
+
+    def close(self) -> None:
+        pass
+
+
+class StateStore(object):
+    """
+    Keeps the last known state of every task and location in memory. Saved
+    states are written behind, in batches, by a scheduled flush that hands
+    everything saved since the previous flush to the storage backend.
+    """
+
+    LOGGER = logging.getLogger()
+    _IO_SECONDS = REGISTRY.histogram("wxbot_state_io_seconds", "Time spent reading and writing task state")
+    _JOB_NAME = "statestore"
+    _FLUSH_INTERVAL_SECONDS = 5
+
+    def __init__(self, flushIntervalSeconds: float = _FLUSH_INTERVAL_SECONDS, backend=None):
+        """
+        Constructor for the State Store.
+
+        Parameters:
+            flushIntervalSeconds (float): How often saved states are written to disk
+            backend (FileStateBackend | SQLiteStateBackend): (optional) Where states are kept, files by default
+        """
+        self._flush_interval_seconds = flushIntervalSeconds
+        self._backend = FileStateBackend() if backend is None else backend
+        self._states: Dict[Tuple[str, str], Dict] = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+
+    def start(self, scheduler: Scheduler) -> None:
+        scheduler.schedule(self._JOB_NAME, self._flushStep, self._flush_interval_seconds)
+
+
+    def load(self, taskName: str, locationKey: str) -> Dict:
+        """
+        Retrieve the last saved state, reading it from disk on first use.
+
+        Parameters:
+            taskName (str): The name of the task that owns the state
+            locationKey (str): The key of the location the state belongs to
+
+        Returns:
+            Dict: The state, or None when there is none
+        """
+
+        key = (taskName, locationKey)
+        with self._lock:
+            if (key in self._states):
+                return self._states[key]
+
+        with self._IO_SECONDS.time({"operation": "read"}):
+            state = self._backend.read(taskName, locationKey)
+        with self._lock:
+            # A save may have happened while reading, in which case it wins
+            return self._states.setdefault(key, state)
+
+
+    def save(self, taskName: str, locationKey: str, state: Dict, converter: Callable = None) -> None:
+        """
+        Replace the state in memory and mark it to be written by the next flush.
+
+        Parameters:
+            taskName (str): The name of the task that owns the state
+            locationKey (str): The key of the location the state belongs to
+            state (Dict): The state to save
+            converter (callable): (optional) Converts values that JSON does not support
+        """
+
+        # Keep the same representation that would be read back from disk
+        state = json.loads(json.dumps(state, default=converter))
+        key = (taskName, locationKey)
+        with self._lock:
+            self._states[key] = state
+            self._dirty.add(key)
+
+
+    def flush(self) -> None:
+        """
+        Write every state saved since the last flush.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                pending = [(key, self._states[key]) for key in self._dirty]
+                self._dirty.clear()
+
+            if (not pending):
+                return
+
+            with self._IO_SECONDS.time({"operation": "write"}):
+                failed = self._backend.write(pending)
+            if (failed):
+                with self._lock:
+                    self._dirty.update(failed)
+            self.LOGGER.debug("Flushed {} state(s)".format(len(pending) - len(failed)))
+
+
+    def evict(self, locationKey: str) -> None:
+        """
+        Write every pending state and forget the states of a location, so they
+        are read again should it be served again, e.g. after another replica
+        served it in the meantime.
+
+        Parameters:
+            locationKey (str): The key of the location
+        """
+
+        self.flush()
+        with self._lock:
+            for key in [key for key in self._states if key[1] == locationKey and key not in self._dirty]:
+                del self._states[key]
+
+
+    def close(self) -> None:
+        """
+        Write every pending state and release the backend.
+        """
+
+        self.flush()
+        self._backend.close()
+
+
+    def _flushStep(self) -> float:
+        self.flush()
+        return self._flush_interval_seconds
@@ -1,17 +1,17 @@
-import json
 import logging
-import threading
 
-from airnowpy import API, Category, Observation
-from const import DATA_FILE_EXT
+from airnowpy import Category, Observation
+from airnow import AirNowFetcher
+from config import getConfig
 from datetime import datetime, timedelta
-from envvarname import EnvVarName
-from pathlib import Path
-from pytz import timezone
-from time import sleep
+from location import Location
+from pytz import utc
+from resilience import CircuitOpenError
+from scheduler import Scheduler
+from statestore import StateStore
+from tweetledger import createTweetKey
 from twitter import TwitterUtil
-from typing import List
-from util import generateHashtag, getEnvVar, initDataDir, isEmpty
+from typing import Callable, List
 
 
 class AirQualityTask(object):
@@ -23,102 +23,95 @@ class AirQualityTask(object):
     _TASK_NAME = "airquality"
     _TIME_FORMAT = "%I:%M %p"
     _MESSAGE_TEMPLATE = "Hello {}! At {} the air quality {} from {} to {}.{}"
-    _EXECUTION_INTERVAL_SECONDS = 360
-
-    def __init__(self):
+    EXECUTION_INTERVAL_SECONDS = 360
+
+    def __init__(self,
+                 scheduler: Scheduler,
+                 location: Location,
+                 stateStore: StateStore,
+                 fetcher: AirNowFetcher,
+                 publisher: Callable[[str, str], None] = None):
         """
-        Constructor for the Air Quality Task. 
+        Constructor for the Air Quality Task. The publisher receives each
+        message and its idempotency key, and tweets it unless another one is
+        given.
         """
-        self._thread = threading.Thread(name=self._TASK_NAME, target=self._run, args=())
-        self._thread.daemon = True                            # Daemonize thread
-        self._thread.start()                                  # Start the execution
+        self._location = location
+        self._state_store = stateStore
+        self._fetcher = fetcher
+        self._publish = TwitterUtil.tweet if publisher is None else publisher
+        self._clock = scheduler.getClock()
+        self._is_setup = False
+        scheduler.schedule(self._TASK_NAME, self._run, labels={"location": self._location.name})
 
 
-    def _run(self):
-        self.LOGGER.info("Starting the '" + self._TASK_NAME + "' task")
-        self._setup()
+    def _run(self) -> float:
+        """ A single iteration of the routine, returns the seconds until the next one """
+        if (not self._is_setup):
+            self.LOGGER.info("Starting the '" + self._TASK_NAME + "' task for " + self._location.name)
+            self._setup()
+            self._is_setup = True
 
-        """ Routine that runs forever """
-        while True:
-            self.now = datetime.now(tz=self._tzone)
+        self.now = self._clock.now(self._tzone)
 
-            self.LOGGER.debug("Getting air quality for now {}".format(self.now.isoformat()))
-            observations = self._getCurrentObservations()
+        self.LOGGER.debug("Getting air quality for now {}".format(self.now.isoformat()))
+        observations = self._getCurrentObservations()
 
-            # Get prior 'air_quality' from the saved data file
-            prior_observation = self._loadAirQualityFromFile()
-            current_observation = self._getPrimaryObservation(observations)
+        # Get prior 'air_quality' from the saved state
+        prior_observation = self._loadAirQuality()
+        current_observation = self._getPrimaryObservation(observations)
 
-            if (current_observation is None):
-                self._sleep()
-                continue
+        if (current_observation is None):
+            return self._getSleepSeconds()
 
-            # Save the current observation if there never was a prior recorded observation
-            if (prior_observation is None):
-                self._saveAirQuality(current_observation)
-                self._sleep()
-                continue
+        # Save the current observation if there never was a prior recorded observation
+        if (prior_observation is None):
+            self._saveAirQuality(current_observation)
+            return self._getSleepSeconds()
 
-            has_category_changed = prior_observation.category.getValue() != current_observation.category.getValue()
-            deadline_after_prior_observation = prior_observation.timestamp + timedelta(hours=2)
-            adjusted_current_timestamp = current_observation.timestamp.astimezone(self._tzone)
-            is_current_within_threshold_of_prior = adjusted_current_timestamp <= deadline_after_prior_observation
-            is_current_newer_than_prior = adjusted_current_timestamp > prior_observation.timestamp
+        has_category_changed = prior_observation.category.getValue() != current_observation.category.getValue()
+        deadline_after_prior_observation = prior_observation.timestamp + timedelta(hours=2)
+        adjusted_current_timestamp = current_observation.timestamp.astimezone(self._tzone)
+        is_current_within_threshold_of_prior = adjusted_current_timestamp <= deadline_after_prior_observation
+        is_current_newer_than_prior = adjusted_current_timestamp > prior_observation.timestamp
 
-            # Determine if a message should be delivered
-            if (has_category_changed and is_current_within_threshold_of_prior and is_current_newer_than_prior):
-                self._tweetAirQuality(prior_observation, current_observation)
+        # Determine if a message should be delivered
+        if (has_category_changed and is_current_within_threshold_of_prior and is_current_newer_than_prior):
+            self._tweetAirQuality(prior_observation, current_observation)
 
-            # Determine if the current observations should be saved
-            if (is_current_newer_than_prior):
-                self._saveAirQuality(current_observation)
+        # Determine if the current observations should be saved
+        if (is_current_newer_than_prior):
+            self._saveAirQuality(current_observation)
 
-            # Go to sleep for a little while
-            self._sleep()
+        # Go to sleep for a little while
+        return self._getSleepSeconds()
 
 
     def _setup(self):
-        # Data Directory
-        self._data_dir = initDataDir(self._TASK_NAME)
-
         # Latitude
-        latitude_str = getEnvVar(EnvVarName.LATITUDE)
-        if isEmpty(latitude_str):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LATITUDE.name)
-        self._latitude = float(latitude_str)
-        self.LOGGER.debug("Latitude = " + latitude_str)
+        self._latitude = self._location.latitude
+        self.LOGGER.debug("Latitude = " + str(self._latitude))
 
         # Longitude
-        longitude_str = getEnvVar(EnvVarName.LONGITUDE)
-        if isEmpty(longitude_str):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LONGITUDE.name)
-        self._longitude = float(longitude_str)
-        self.LOGGER.debug("Longitude = " + longitude_str)
+        self._longitude = self._location.longitude
+        self.LOGGER.debug("Longitude = " + str(self._longitude))
 
         # Location
-        self._location_str = getEnvVar(EnvVarName.LOCATION)
-        if isEmpty(self._location_str):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LOCATION.name)
+        self._location_str = self._location.name
         self.LOGGER.debug("Location = " + self._location_str)
 
         # Timezone
-        self._timezone_str = getEnvVar(EnvVarName.TIMEZONE)
-        if isEmpty(self._timezone_str):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.TIMEZONE.name)
-        self._tzone = timezone(self._timezone_str)
+        self._timezone_str = self._location.timezone
+        self._tzone = self._location.getTimeZone()
         self.LOGGER.debug("Timezone = " + self._timezone_str)
 
-        # API Key
-        self._api_key = getEnvVar(EnvVarName.AIRNOW_API_KEY)
-        if isEmpty(self._api_key):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.AIRNOW_API_KEY.name)
-        self.LOGGER.debug("API Key = " + self._api_key)
-
 
     def _getCurrentObservations(self) -> List[Observation]:
-        api = API(self._api_key)
         try:
-            return api.getCurrentObservationByLatLon(self._latitude, self._longitude)
+            return self._fetcher.getCurrentObservations(self._location)
+        except CircuitOpenError as e:
+            self.LOGGER.warning(str(e))
+            return list()
         except Exception:
             self.LOGGER.exception("Problem occurned while retrieving current observations")
             return list()
@@ -158,41 +151,42 @@ class AirQualityTask(object):
             type_of_change,
             prior_observation.category.getLabel(),
             current_observation.category.getLabel(),
-            generateHashtag()
+            getConfig().formatHashtag()
         )
         self.LOGGER.info("A message will be tweeted!")
         self.LOGGER.info(message)
-        TwitterUtil.tweet(message)
+        observation_hour = current_observation.timestamp.astimezone(utc).strftime("%Y-%m-%dT%H")
+        self._publish(message, createTweetKey(self._TASK_NAME, self._location.key, observation_hour))
 
 
-    def _sleep(self) -> None:
-        sleep_seconds = self._EXECUTION_INTERVAL_SECONDS
+    def _getSleepSeconds(self) -> float:
+        # Wake with the other locations of the reporting area so they share a request
+        sleep_seconds = self._fetcher.getSecondsUntilNextFetch(self._location)
         self.LOGGER.debug("Sleep for {:.0f} seconds".format(sleep_seconds))
-        sleep(sleep_seconds)
-
-
-    def _loadAirQualityFromFile(self) -> Observation:
-        filePath = Path.joinpath(self._data_dir, self._TASK_NAME + DATA_FILE_EXT)
-        filePath.touch(exist_ok=True)
-        with open(filePath, 'r') as fp:
-            try: 
-                air_quality = json.load(fp)
-                return Observation(datetime.fromisoformat(air_quality["timestamp"]),
-                                   air_quality["reportingArea"],
-                                   air_quality["stateCode"],
-                                   air_quality["latitude"],
-                                   air_quality["longitude"],
-                                   air_quality["parameterName"],
-                                   air_quality["aqiValue"],
-                                   Category.lookupByValue(air_quality["category"]))
-            except:
-                return None
+        return sleep_seconds
+
+
+    def _loadAirQuality(self) -> Observation:
+        air_quality = self._state_store.load(self._TASK_NAME, self._location.key)
+        if (air_quality is None):
+            return None
+
+        try:
+            return Observation(datetime.fromisoformat(air_quality["timestamp"]),
+                               air_quality["reportingArea"],
+                               air_quality["stateCode"],
+                               air_quality["latitude"],
+                               air_quality["longitude"],
+                               air_quality["parameterName"],
+                               air_quality["aqiValue"],
+                               Category.lookupByValue(air_quality["category"]))
+        except (KeyError, LookupError, TypeError, ValueError):
+            self.LOGGER.warning("Ignoring saved air quality that is not a valid observation")
+            return None
 
 
     def _saveAirQuality(self, air_quality: Observation) -> None:
-        fw = open(Path.joinpath(self._data_dir, self._TASK_NAME + DATA_FILE_EXT), 'w+')
-        json.dump(air_quality.__dict__, fw, default=self._dumpConverter, indent=2)
-        fw.close()
+        self._state_store.save(self._TASK_NAME, self._location.key, air_quality.__dict__, self._dumpConverter)
 
 
     def _dumpConverter(self, o):
@@ -1,17 +1,19 @@
-import json
 import logging
-import threading
 
-from const import DATA_FILE_EXT
-from datetime import datetime, time, timedelta
-from envvarname import EnvVarName
-from pathlib import Path
+from cache import TTLCache
+from config import getConfig
+from datetime import date, datetime, time, timedelta
+from ephemeris import EphemerisPool, computeMoonTimes
+from location import Location
+from metrics import REGISTRY
 from pylunar import MoonInfo
-from pytz import timezone, utc
-from time import sleep
+from pytz import utc
+from scheduler import Scheduler
+from statestore import StateStore
+from tweetledger import createTweetKey
 from twitter import TwitterUtil
-from typing import Dict
-from util import decToDegMinSec, generateHashtag, getEnvVar, initDataDir, isEmpty, tupleToDateTime
+from typing import Callable, Dict, List, Tuple
+from util import decToDegMinSec, tupleToDateTime
 
 
 class LunarTimeTask(object):
@@ -21,80 +23,121 @@ class LunarTimeTask(object):
     _TIME_FORMAT = "%I:%M %p"
     _MESSAGE_TEMPLATE = "Hello {}! The moon will be {}% illuminated. Moonrise is at {} and Moonset is at {}.{}"
     _THRESHOLD_SECONDS = 3600
-
-    def __init__(self):
+    # Rise, transit and set times shared by all lunar tasks, with the illuminated fraction at the
+    # transit once it is known, keyed by (location, local date) until the day after has passed
+    _EPHEMERIS_CACHE = TTLCache(4096)
+    _EPHEMERIS_SECONDS = REGISTRY.histogram("wxbot_ephemeris_seconds", "Time spent computing sun and moon ephemerides")
+
+    def __init__(self,
+                 scheduler: Scheduler,
+                 location: Location,
+                 stateStore: StateStore,
+                 ephemeris: EphemerisPool = None,
+                 publisher: Callable[[str, str], None] = None):
         """
         Constructor for the Lunar Time Task. This task is responsible for
-        determining the desired information to publish.
+        determining the desired information to publish for a location. The
+        publisher receives each message and its idempotency key, and tweets
+        it unless another one is given.
         """
-        self._thread = threading.Thread(name=self._TASK_NAME, target=self._run, args=())
-        self._thread.daemon = True                            # Daemonize thread
-        self._thread.start()                                  # Start the execution
-
-
-    def _run(self):
-        self.LOGGER.info("Starting the '" + self._TASK_NAME + "' task")
-        self._setup()
+        self._location = location
+        self._state_store = stateStore
+        self._ephemeris = ephemeris
+        self._publish = TwitterUtil.tweet if publisher is None else publisher
+        self._clock = scheduler.getClock()
+        self._is_setup = False
+        scheduler.schedule(self._TASK_NAME, self._run, labels={"location": self._location.name})
 
-        """ Routine that runs forever """
-        while True:
-            self.now = datetime.now(tz=self._tzone)
 
-            self.LOGGER.info("Getting lunar times for now {}".format(self.now.isoformat()))
-            lunar_time_current = self._getLunarTimeCurrent()
-            moonrise_current = lunar_time_current["rise"]
-
-            # Get prior 'lunar_time' from the saved data file
-            lunar_time_from_file = self._loadLunarTime()
-
-            if (lunar_time_from_file):
-                transit_from_file = datetime.fromisoformat(lunar_time_from_file["transit"])
-                self.LOGGER.info("Got lunar times from file for {}".format(transit_from_file.isoformat()))
-                if (transit_from_file == lunar_time_current["transit"]):
-                    self.LOGGER.info("Current lunar times are the same as the file")
-                    self._sleep(moonrise_current)
-                    continue
+    @staticmethod
+    def prefetchMoonTimes(requests: List[Tuple[Location, date]], now: float, ephemeris: EphemerisPool = None) -> None:
+        """
+        Compute the rise, transit and set times of many locations and dates
+        at once, ahead of the lunar tasks that look them up.
 
-            threshold_before_moonrise_current = moonrise_current - timedelta(seconds=self._THRESHOLD_SECONDS)
-            if (self.now < threshold_before_moonrise_current or moonrise_current < self.now):
-                self.LOGGER.info("Now is not within the threshold before moonrise")
-                self._sleep(moonrise_current)
-                continue
+        Parameters:
+            requests (List): Pairs of a location and a local date
+            now (float): The epoch seconds on the clock of the tasks
+            ephemeris (EphemerisPool): (optional) Computes them in worker processes
+        """
 
-            self._tweetLunarTime(lunar_time_current)
-            self._saveLunarTime(lunar_time_current)
-            self._sleep(moonrise_current)
+        requests = [request for request in requests if LunarTimeTask._EPHEMERIS_CACHE.get(request) is None]
+        if (not requests):
+            return
+        with LunarTimeTask._EPHEMERIS_SECONDS.time({"kind": "lunar"}):
+            if (ephemeris is not None):
+                results = ephemeris.moonTimes(requests)
+            else:
+                results = list()
+                for location, day in requests:
+                    try:
+                        results.append(computeMoonTimes(location.latitude, location.longitude, location.timezone, day))
+                    except Exception as e:
+                        results.append(e)
+        for request, moon_times in zip(requests, results):
+            # A failed request is computed again by the task that needs it
+            if (not isinstance(moon_times, Exception)):
+                LunarTimeTask._EPHEMERIS_CACHE.put(request, (moon_times, None), LunarTimeTask._getExpiry(request, now))
+
+
+    @staticmethod
+    def _getExpiry(key: Tuple[Location, date], now: float) -> float:
+        """ When a cache entry expires: once the day after its date has passed on the clock of the tasks """
+        location, day = key
+        passed_at = location.getTimeZone().localize(datetime.combine(day + timedelta(days=2), time())).timestamp()
+        # The cache expires its entries on the system clock, which a virtual clock does not follow
+        return datetime.now(utc).timestamp() + passed_at - now
+
+
+    def _run(self) -> float:
+        """ A single iteration of the routine, returns the seconds until the next one """
+        if (not self._is_setup):
+            self.LOGGER.info("Starting the '" + self._TASK_NAME + "' task for " + self._location.name)
+            self._setup()
+            self._is_setup = True
+
+        self.now = self._clock.now(self._tzone)
+
+        self.LOGGER.info("Getting lunar times for now {}".format(self.now.isoformat()))
+        lunar_time_current = self._getLunarTimeCurrent()
+        moonrise_current = lunar_time_current["rise"]
+
+        # Get prior 'lunar_time' from the saved data file
+        lunar_time_from_file = self._loadLunarTime()
+
+        if (lunar_time_from_file):
+            transit_from_file = datetime.fromisoformat(lunar_time_from_file["transit"])
+            self.LOGGER.info("Got lunar times from file for {}".format(transit_from_file.isoformat()))
+            if (transit_from_file == lunar_time_current["transit"]):
+                self.LOGGER.info("Current lunar times are the same as the file")
+                return self._getSleepSeconds(moonrise_current)
+
+        threshold_before_moonrise_current = moonrise_current - timedelta(seconds=self._THRESHOLD_SECONDS)
+        if (self.now < threshold_before_moonrise_current or moonrise_current < self.now):
+            self.LOGGER.info("Now is not within the threshold before moonrise")
+            return self._getSleepSeconds(moonrise_current)
+
+        self._tweetLunarTime(lunar_time_current)
+        self._saveLunarTime(lunar_time_current)
+        return self._getSleepSeconds(moonrise_current)
 
 
     def _setup(self):
-        # Data Directory
-        self._data_dir = initDataDir(self._TASK_NAME)
-
         # Latitude
-        latitude_str = getEnvVar(EnvVarName.LATITUDE)
-        if isEmpty(latitude_str):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LATITUDE.name)
-        self._latitude_dms = decToDegMinSec(float(latitude_str))
+        self._latitude_dms = decToDegMinSec(self._location.latitude)
         self.LOGGER.debug("Latitude = " + ','.join(map(str, self._latitude_dms)))
 
         # Longitude
-        longitude_str = getEnvVar(EnvVarName.LONGITUDE)
-        if isEmpty(longitude_str):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LONGITUDE.name)
-        self._longitude_dms = decToDegMinSec(float(longitude_str))
+        self._longitude_dms = decToDegMinSec(self._location.longitude)
         self.LOGGER.debug("Longitude = " + ','.join(map(str, self._longitude_dms)))
 
         # Location
-        self._location_str = getEnvVar(EnvVarName.LOCATION)
-        if isEmpty(self._location_str):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LOCATION.name)
+        self._location_str = self._location.name
         self.LOGGER.debug("Location = " + self._location_str)
 
         # Timezone
-        self._timezone_str = getEnvVar(EnvVarName.TIMEZONE)
-        if isEmpty(self._timezone_str):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.TIMEZONE.name)
-        self._tzone = timezone(self._timezone_str)
+        self._timezone_str = self._location.timezone
+        self._tzone = self._location.getTimeZone()
         self.LOGGER.debug("Timezone = " + self._timezone_str)
 
 
@@ -102,12 +145,21 @@ class LunarTimeTask(object):
         lunar_time_now = self._getLunarTime(self.now, True)
         if (lunar_time_now["transit"] < self.now):
             lunarTimeTomorrow = self._getLunarTimeTomorrow(self.now)
-            return self._getLunarTime(lunarTimeTomorrow["transit"], True)
+            lunar_time = self._getLunarTime(lunarTimeTomorrow["transit"], True)
+        else:
+            lunar_time = self._getLunarTime(lunar_time_now["transit"], True)
 
-        return self._getLunarTime(lunar_time_now["transit"], True)
+        # Only the phase of the lunar time that is tweeted is needed
+        lunar_time["fraction"] = self._getTransitFraction(lunar_time["transit"])
+        return lunar_time
 
 
     def _getLunarTime(self, asOf: datetime, doFinalCorrections: bool) -> Dict:
+        moon_times = self._getMoonTimes(asOf)
+        return self._getLunarTimeFromMoonTimes(moon_times, asOf, doFinalCorrections)
+
+
+    def _createMoonInfo(self, asOf: datetime) -> MoonInfo:
         utcAsOf = utc.normalize(asOf)
         utcAsOfTuple = (
             utcAsOf.year,
@@ -120,20 +172,60 @@ class LunarTimeTask(object):
 
         moon_info = MoonInfo(self._latitude_dms, self._longitude_dms)
         moon_info.update(utcAsOfTuple)
-        moon_times = moon_info.rise_set_times(self._timezone_str)
-        return self._getLunarTimeFromMoonTimes(moon_times, asOf, moon_info.fractional_phase(), doFinalCorrections)
+        return moon_info
+
+
+    def _getMoonTimes(self, asOf: datetime) -> list:
+        # The rise, transit and set times only depend on the local date, unlike the phase
+        key = (self._location, asOf.date())
+        entry = self._EPHEMERIS_CACHE.get(key)
+        if (entry is not None):
+            return entry[0]
+        if (self._ephemeris is not None):
+            return self._fetchMoonTimes(asOf.date())
+        with self._EPHEMERIS_SECONDS.time({"kind": "lunar"}):
+            moon_times = self._createMoonInfo(asOf).rise_set_times(self._timezone_str)
+        self._EPHEMERIS_CACHE.put(key, (moon_times, None), self._getExpiry(key, self._clock.time()))
+        return moon_times
+
+
+    def _getTransitFraction(self, transit: datetime) -> float:
+        # A day has one transit, so its phase is kept with the moon times of the day
+        key = (self._location, transit.date())
+        entry = self._EPHEMERIS_CACHE.get(key)
+        if (entry is not None and entry[1] is not None):
+            return entry[1]
+        fraction = self._createMoonInfo(transit).fractional_phase()
+        if (entry is not None):
+            self._EPHEMERIS_CACHE.put(key, (entry[0], fraction), self._getExpiry(key, self._clock.time()))
+        return fraction
+
+
+    def _fetchMoonTimes(self, day: date) -> List:
+        # The days either side are nearly always needed as well, so they are computed alongside
+        days = [day] + [other for other in (day - timedelta(days=1), day + timedelta(days=1))
+                        if self._EPHEMERIS_CACHE.get((self._location, other)) is None]
+        with self._EPHEMERIS_SECONDS.time({"kind": "lunar"}):
+            results = self._ephemeris.moonTimes([(self._location, other) for other in days])
+        for other, moon_times in zip(days, results):
+            if (not isinstance(moon_times, Exception)):
+                key = (self._location, other)
+                self._EPHEMERIS_CACHE.put(key, (moon_times, None), self._getExpiry(key, self._clock.time()))
+        if (isinstance(results[0], Exception)):
+            raise results[0]
+        return results[0]
 
 
     def _getLunarTimeFromMoonTimes(self,
                                    moonTimes: list,
                                    asOf: datetime,
-                                   fractPhase: float,
                                    doFinalCorrections: bool) -> Dict:
+        # The fraction is only filled in for the current lunar time
         lunarTimeDict = {
             "asOf": asOf,
             "rise": None,
             "transit": None,
-            "fraction": fractPhase,
+            "fraction": None,
             "set": None
         }
 
@@ -189,14 +281,15 @@ class LunarTimeTask(object):
             str(round(100 * lunar_time["fraction"])),
             lunar_time["rise"].strftime(self._TIME_FORMAT),
             lunar_time["set"].strftime(self._TIME_FORMAT),
-            generateHashtag()
+            getConfig().formatHashtag()
         )
         self.LOGGER.info("A message will be tweeted!")
         self.LOGGER.info(message)
-        TwitterUtil.tweet(message)
+        # The moon rises at most once a day, so the date of the moonrise identifies it
+        self._publish(message, createTweetKey(self._TASK_NAME, self._location.key, lunar_time["rise"].date().isoformat()))
 
 
-    def _sleep(self, moonrise: datetime) -> None:
+    def _getSleepSeconds(self, moonrise: datetime) -> float:
         seconds_until_moonrise = (moonrise - self.now).total_seconds()
 
         if (seconds_until_moonrise > self._THRESHOLD_SECONDS):
@@ -211,25 +304,16 @@ class LunarTimeTask(object):
             sleep_seconds = seconds_until_moonrise_next - self._THRESHOLD_SECONDS
 
         self.LOGGER.info("Sleep for {:.0f} seconds".format(sleep_seconds))
-        sleep(sleep_seconds)
+        return sleep_seconds
 
 
     def _loadLunarTime(self) -> Dict:
-        filePath = Path.joinpath(self._data_dir, self._TASK_NAME + DATA_FILE_EXT)
-        filePath.touch(exist_ok=True)
-        with open(filePath, 'r') as fp:
-            try: 
-                # TODO: convert datetime string into datetime object
-                lunar_time = json.load(fp)
-                return lunar_time
-            except:
-                return None
+        # TODO: convert datetime string into datetime object
+        return self._state_store.load(self._TASK_NAME, self._location.key)
 
 
     def _saveLunarTime(self, lunar_time: Dict) -> None:
-        fw = open(Path.joinpath(self._data_dir, self._TASK_NAME + DATA_FILE_EXT), 'w+')
-        json.dump(lunar_time, fw, default=self._dumpConverter, indent=2)
-        fw.close()
+        self._state_store.save(self._TASK_NAME, self._location.key, lunar_time, self._dumpConverter)
 
 
     def _dumpConverter(self, o):
@@ -1,18 +1,19 @@
-import json
 import logging
-import threading
 
 from astral import LocationInfo
 from astral.sun import sun
-from const import DATA_FILE_EXT
-from datetime import datetime, timedelta
-from envvarname import EnvVarName
-from pathlib import Path
-from pytz import timezone
-from time import sleep
+from config import getConfig
+from datetime import date, datetime, timedelta
+from ephemeris import EphemerisPool
+from location import Location
+from metrics import REGISTRY
+from scheduler import Scheduler
+from solartable import SolarTimeTable
+from statestore import StateStore
+from tweetledger import createTweetKey
 from twitter import TwitterUtil
-from typing import Dict
-from util import generateHashtag, getEnvVar, initDataDir, isEmpty
+from typing import Callable, Dict
+from util import isEmpty
 
 
 class SolarTimeTask(object):
@@ -23,84 +24,90 @@ class SolarTimeTask(object):
     _TIME_FORMAT = "%I:%M %p"
     _MESSAGE_TEMPLATE = "Hello {}! Today is {}. Sunrise is at {}, Solar Noon is at {}, and Sunset is at {}.{}"
     _THRESHOLD_SECONDS = 3600
-
-    def __init__(self):
+    _EPHEMERIS_SECONDS = REGISTRY.histogram("wxbot_ephemeris_seconds", "Time spent computing sun and moon ephemerides")
+
+    def __init__(self,
+                 scheduler: Scheduler,
+                 location: Location,
+                 stateStore: StateStore,
+                 solarTable: SolarTimeTable = None,
+                 ephemeris: EphemerisPool = None,
+                 publisher: Callable[[str, str], None] = None):
         """
         Constructor for the Solar Time Task. This task is responsible for
-        determining the desired information to publish.
+        determining the desired information to publish for a location. The
+        publisher receives each message and its idempotency key, and tweets
+        it unless another one is given.
         """
-        self._thread = threading.Thread(name=self._TASK_NAME, target=self._run, args=())
-        self._thread.daemon = True                            # Daemonize thread
-        self._thread.start()                                  # Start the execution
-
-
-    def _run(self):
-        self.LOGGER.info("Starting the '" + self._TASK_NAME + "' task")
-        self._setup()
-
-        """ Routine that runs forever """
-        while True:
-            self.now = datetime.now(tz=self.location.timezone)
-            self.today = self.now.date()
-
-            self.LOGGER.info("Getting solar times for today {}".format(self.today.isoformat()))
-            solar_time_today = sun(self.location.observer, date=self.today, tzinfo=self.location.timezone)
-
-            # Get prior 'solar_time' from the saved data file
-            solar_time_from_file = self._loadSolarTime()
+        self._location = location
+        self._state_store = stateStore
+        self._solar_table = solarTable
+        self._ephemeris = ephemeris
+        self._publish = TwitterUtil.tweet if publisher is None else publisher
+        self._clock = scheduler.getClock()
+        self._is_setup = False
+        scheduler.schedule(self._TASK_NAME, self._run, labels={"location": self._location.name})
+
+
+    def _run(self) -> float:
+        """ A single iteration of the routine, returns the seconds until the next one """
+        if (not self._is_setup):
+            self.LOGGER.info("Starting the '" + self._TASK_NAME + "' task for " + self._location.name)
+            self._setup()
+            self._is_setup = True
+
+        self.now = self._clock.now(self.location.timezone)
+        self.today = self.now.date()
+
+        self.LOGGER.info("Getting solar times for today {}".format(self.today.isoformat()))
+        solar_time_today = self._getSolarTime(self.today)
+
+        # Get prior 'solar_time' from the saved data file
+        solar_time_from_file = self._loadSolarTime()
+
+        if (solar_time_from_file):
+            noon_from_file = datetime.fromisoformat(solar_time_from_file["noon"])
+            date_from_file = noon_from_file.date()
+            self.LOGGER.info("Got solar times from file for date {}".format(date_from_file.isoformat()))
+            if (self.today == date_from_file):
+                self.LOGGER.info("Today is the same as the date from the file")
+                return self._getSleepSeconds(solar_time_today)
 
-            if (solar_time_from_file):
-                noon_from_file = datetime.fromisoformat(solar_time_from_file["noon"])
-                date_from_file = noon_from_file.date()
-                self.LOGGER.info("Got solar times from file for date {}".format(date_from_file.isoformat()))
-                if (self.today == date_from_file):
-                    self.LOGGER.info("Today is the same as the date from the file")
-                    self._sleep(solar_time_today)
-                    continue
-
-            sunrise_today = solar_time_today["sunrise"]
-            threshold_before_sunrise_today = sunrise_today - timedelta(seconds=self._THRESHOLD_SECONDS)
-            if (self.now < threshold_before_sunrise_today or sunrise_today < self.now):
-                self.LOGGER.info("Now is not within the threshold before sunrise today")
-                self._sleep(solar_time_today)
-                continue
+        sunrise_today = solar_time_today["sunrise"]
+        threshold_before_sunrise_today = sunrise_today - timedelta(seconds=self._THRESHOLD_SECONDS)
+        if (self.now < threshold_before_sunrise_today or sunrise_today < self.now):
+            self.LOGGER.info("Now is not within the threshold before sunrise today")
+            return self._getSleepSeconds(solar_time_today)
 
-            self._tweetSolarTime(solar_time_today)
-            self._saveSolarTime(solar_time_today)
-            self._sleep(solar_time_today)
+        self._tweetSolarTime(solar_time_today)
+        self._saveSolarTime(solar_time_today)
+        return self._getSleepSeconds(solar_time_today)
 
 
     def _setup(self):
-        # Data Directory
-        self._data_dir = initDataDir(self._thread.name)
-
         # Region
-        region = getEnvVar(EnvVarName.REGION)
+        region = self._location.region
         if isEmpty(region):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.REGION.name)
-
-        # Timezone
-        tzString = getEnvVar(EnvVarName.TIMEZONE)
-        if isEmpty(tzString):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.TIMEZONE.name)
-        tz = timezone(tzString)
-
-        # Latitude
-        latitude = getEnvVar(EnvVarName.LATITUDE)
-        if isEmpty(latitude):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LATITUDE.name)
+            raise RuntimeError("Missing required region for location: " + self._location.name)
 
-        # Longitude
-        longitude = getEnvVar(EnvVarName.LONGITUDE)
-        if isEmpty(longitude):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LONGITUDE.name)
+        self.location = LocationInfo(self._location.name,
+                                     region,
+                                     self._location.getTimeZone(),
+                                     self._location.latitude,
+                                     self._location.longitude)
 
-        # Location
-        location = getEnvVar(EnvVarName.LOCATION)
-        if isEmpty(location):
-            raise RuntimeError("Missing required environment variable: " + EnvVarName.LOCATION.name)
 
-        self.location = LocationInfo(location, region, tz, latitude, longitude)
+    def _getSolarTime(self, day: date) -> Dict:
+        # Prefer the precomputed table, it holds the same values astral would compute
+        if (self._solar_table is not None and self._solar_table.contains(self._location)):
+            return self._solar_table.lookup(self._location, day)
+        with self._EPHEMERIS_SECONDS.time({"kind": "solar"}):
+            if (self._ephemeris is not None):
+                solar_time = self._ephemeris.sunTimes([(self._location, day)])[0]
+                if (isinstance(solar_time, Exception)):
+                    raise solar_time
+                return {event: datetime.fromtimestamp(value, self.location.timezone) for event, value in solar_time.items()}
+            return sun(self.location.observer, date=day, tzinfo=self.location.timezone)
 
 
     def _tweetSolarTime(self, solar_time: Dict) -> None:
@@ -117,14 +124,14 @@ class SolarTimeTask(object):
             solar_time["sunrise"].strftime(self._TIME_FORMAT),
             solar_time["noon"].strftime(self._TIME_FORMAT),
             solar_time["sunset"].strftime(self._TIME_FORMAT),
-            generateHashtag()
+            getConfig().formatHashtag()
         )
         self.LOGGER.info("A message will be tweeted!")
         self.LOGGER.info(message)
-        TwitterUtil.tweet(message)
+        self._publish(message, createTweetKey(self._TASK_NAME, self._location.key, self.today.isoformat()))
 
 
-    def _sleep(self, solar_time_today: Dict) -> None:
+    def _getSleepSeconds(self, solar_time_today: Dict) -> float:
         sunrise_today = solar_time_today["sunrise"]
 
         if (self.today != sunrise_today.date()):
@@ -138,31 +145,22 @@ class SolarTimeTask(object):
         else:
             self.LOGGER.info("Sleeping until tomorrow")
             tomorrow = self.today + timedelta(days=1)
-            solar_time_tomorrow = sun(self.location.observer, date=tomorrow, tzinfo=self.location.timezone)
+            solar_time_tomorrow = self._getSolarTime(tomorrow)
             sunrise_tomorrow = solar_time_tomorrow["sunrise"]
             seconds_until_sunrise_tomorrow = (sunrise_tomorrow - self.now).total_seconds()
             sleep_seconds = seconds_until_sunrise_tomorrow - self._THRESHOLD_SECONDS
 
         self.LOGGER.info("Sleep for {:.0f} seconds".format(sleep_seconds))
-        sleep(sleep_seconds)
+        return sleep_seconds
 
 
     def _loadSolarTime(self) -> Dict:
-        filePath = Path.joinpath(self._data_dir, self._TASK_NAME + DATA_FILE_EXT)
-        filePath.touch(exist_ok=True)
-        with open(filePath, 'r') as fp:
-            try: 
-                # TODO: convert datetime string into datetime object
-                solar_time = json.load(fp)
-                return solar_time
-            except:
-                return None
+        # TODO: convert datetime string into datetime object
+        return self._state_store.load(self._TASK_NAME, self._location.key)
 
 
     def _saveSolarTime(self, solar_time: Dict) -> None:
-        fw = open(Path.joinpath(self._data_dir, self._TASK_NAME + DATA_FILE_EXT), 'w+')
-        json.dump(solar_time, fw, default=self._dumpConverter, indent=2)
-        fw.close()
+        self._state_store.save(self._TASK_NAME, self._location.key, solar_time, self._dumpConverter)
 
 
     def _dumpConverter(self, o):
@@ -0,0 +1,294 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from pathlib import Path
+from typing import Callable, Dict
+from util import initDataDir
+
+
+def createTweetKey(taskName: str, locationKey: str, event: str) -> str:
+    """
+    The idempotency key of a tweet, which is the same for every attempt to
+    tweet about the same event.
+
+    Parameters:
+        taskName (str): The name of the task that tweets
+        locationKey (str): The key of the location the tweet is about
+        event (str): Identifies the event, e.g. its date or the hour of an observation
+
+    Returns:
+        str: The key
+    """
+
+    return "/".join((taskName, locationKey, event))
+
+
+def _digest(key: str) -> bytes:
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=FileTweetLedger.DIGEST_SIZE).digest()
+
+
+class FileTweetLedger(object):
+    """
+    Remembers which tweets were sent, so a tweet is not sent again when the
+    task runs again before it saved its state, e.g. after a crash or a
+    restart. The ledger is an append-only file of fixed-width records, each
+    a digest of the idempotency key and the time it was claimed, which is
+    read into memory once and then only followed as it grows.
+
+    Replicas that share the data directory share the ledger and take turns
+    through an exclusive lock on a file next to it. Claims older than the
+    retention are forgotten; once they make up most of the file, it is
+    rewritten without them.
+    """
+
+    LOGGER = logging.getLogger()
+    DIGEST_SIZE = 12
+    # digest of the key, claimed at (epoch s)
+    RECORD = struct.Struct("<12sI")
+    _DIR_NAME = "ledger"
+    _LEDGER_FILE_NAME = "tweets.ledger"
+    _LOCK_FILE_NAME = "tweets.lock"
+    _TEMP_SUFFIX = ".tmp"
+    _RETENTION_SECONDS = 7 * 24 * 3600
+    # Too few records are not worth rewriting the file for
+    _COMPACT_MIN_RECORDS = 4096
+
+    def __init__(self,
+                 dataDir: Path = None,
+                 retentionSeconds: float = _RETENTION_SECONDS,
+                 clock: Callable[[], float] = time.time):
+        """
+        Constructor for the File Tweet Ledger.
+
+        Parameters:
+            dataDir (Path): (optional) The directory of the ledger, data/ledger by default
+            retentionSeconds (float): (optional) How long a claim is remembered
+            clock (callable): (optional) Returns the current epoch seconds
+        """
+        try:
+            import fcntl
+        except ImportError:
+            raise RuntimeError("The tweet ledger in files needs advisory file locks, use the sqlite state backend instead") from None
+        self._fcntl = fcntl
+        if (dataDir is None):
+            dataDir = initDataDir(self._DIR_NAME)
+        self._ledger_path = Path.joinpath(dataDir, self._LEDGER_FILE_NAME)
+        self._lock_path = Path.joinpath(dataDir, self._LOCK_FILE_NAME)
+        self._retention_seconds = retentionSeconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._claims: Dict[bytes, int] = {}
+        self._inode = None
+        self._offset = 0
+
+
+    def claim(self, key: str) -> bool:
+        """
+        Record that a tweet was sent, unless it was already.
+
+        Parameters:
+            key (str): The idempotency key of the tweet
+
+        Returns:
+            bool: True when it was recorded, False when it was claimed before
+        """
+
+        digest = _digest(key)
+        now = int(self._clock())
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            self._fcntl.flock(lock_file, self._fcntl.LOCK_EX)
+            try:
+                self._catchUp()
+                claimed_at = self._claims.get(digest)
+                if (claimed_at is not None and claimed_at > now - self._retention_seconds):
+                    return False
+
+                with open(self._ledger_path, "ab") as fw:
+                    fw.write(self.RECORD.pack(digest, now))
+                    fw.flush()
+                    os.fsync(fw.fileno())
+                self._offset += self.RECORD.size
+                self._claims[digest] = now
+                self._compactIfWorthIt(now)
+                return True
+            finally:
+                self._fcntl.flock(lock_file, self._fcntl.LOCK_UN)
+
+
+    def contains(self, key: str) -> bool:
+        """
+        Whether a tweet was claimed within the retention.
+
+        Parameters:
+            key (str): The idempotency key of the tweet
+
+        Returns:
+            bool: True when the tweet was claimed before
+        """
+
+        digest = _digest(key)
+        now = int(self._clock())
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            self._fcntl.flock(lock_file, self._fcntl.LOCK_SH)
+            try:
+                self._catchUp()
+                claimed_at = self._claims.get(digest)
+                return claimed_at is not None and claimed_at > now - self._retention_seconds
+            finally:
+                self._fcntl.flock(lock_file, self._fcntl.LOCK_UN)
+
+
+    def close(self) -> None:
+        pass
+
+
+    def _catchUp(self) -> None:
+        # Read the records other replicas appended since the last claim
+        try:
+            stat = os.stat(self._ledger_path)
+        except FileNotFoundError:
+            self._claims.clear()
+            self._inode = None
+            self._offset = 0
+            return
+
+        if (stat.st_ino != self._inode):
+            # Another replica rewrote the file
+            self._claims.clear()
+            self._inode = stat.st_ino
+            self._offset = 0
+
+        end = stat.st_size - stat.st_size % self.RECORD.size
+        if (end < stat.st_size):
+            # A claim was interrupted while being written, so it never happened
+            self.LOGGER.warning("Dropping a partial record at the end of " + str(self._ledger_path))
+            os.truncate(self._ledger_path, end)
+        if (end > self._offset):
+            with open(self._ledger_path, "rb") as fp:
+                fp.seek(self._offset)
+                data = fp.read(end - self._offset)
+            for digest, claimed_at in self.RECORD.iter_unpack(data):
+                self._claims[digest] = claimed_at
+            self._offset = end
+
+
+    def _compactIfWorthIt(self, now: int) -> None:
+        records = self._offset // self.RECORD.size
+        cutoff = now - self._retention_seconds
+        live = {digest: claimed_at for digest, claimed_at in self._claims.items() if claimed_at > cutoff}
+        if (records < self._COMPACT_MIN_RECORDS or len(live) * 2 > records):
+            return
+
+        temp_path = Path(str(self._ledger_path) + self._TEMP_SUFFIX)
+        with open(temp_path, "wb") as fw:
+            fw.write(b"".join(self.RECORD.pack(digest, claimed_at) for digest, claimed_at in live.items()))
+            fw.flush()
+            os.fsync(fw.fileno())
+        os.replace(temp_path, self._ledger_path)
+        self._claims = live
+        self._inode = os.stat(self._ledger_path).st_ino
+        self._offset = len(live) * self.RECORD.size
+        self.LOGGER.info("Compacted the tweet ledger from {} to {} record(s)".format(records, len(live)))
+
+
+class SQLiteTweetLedger(object):
+    """
+    Remembers which tweets were sent, like the File Tweet Ledger, in a table
+    of the SQLite state database keyed by the digest of the idempotency key.
+    A claim is a single statement, so replicas sharing the database never
+    both claim the same tweet.
+    """
+
+    # The database that SQLiteStateBackend keeps the task state in
+    _DATABASE_FILE_NAME = "state.sqlite3"
+    _BUSY_TIMEOUT_SECONDS = 30
+    _RETENTION_SECONDS = FileTweetLedger._RETENTION_SECONDS
+    # Forget the expired claims once every this many claims
+    _PRUNE_INTERVAL_CLAIMS = 1000
+
+    def __init__(self,
+                 databasePath: Path = None,
+                 retentionSeconds: float = _RETENTION_SECONDS,
+                 clock: Callable[[], float] = time.time):
+        """
+        Constructor for the SQLite Tweet Ledger.
+
+        Parameters:
+            databasePath (Path): (optional) The database file, data/state.sqlite3 by default
+            retentionSeconds (float): (optional) How long a claim is remembered
+            clock (callable): (optional) Returns the current epoch seconds
+        """
+        if (databasePath is None):
+            databasePath = Path.joinpath(initDataDir(""), self._DATABASE_FILE_NAME)
+        self._retention_seconds = retentionSeconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._claims_until_prune = 0
+        self._connection = sqlite3.connect(str(databasePath),
+                                           timeout=self._BUSY_TIMEOUT_SECONDS,
+                                           check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS tweet_ledger ("
+            " digest BLOB PRIMARY KEY,"
+            " claimed_at INTEGER NOT NULL"
+            ") WITHOUT ROWID")
+
+
+    def claim(self, key: str) -> bool:
+        """
+        Record that a tweet was sent, unless it was already.
+
+        Parameters:
+            key (str): The idempotency key of the tweet
+
+        Returns:
+            bool: True when it was recorded, False when it was claimed before
+        """
+
+        now = int(self._clock())
+        cutoff = now - self._retention_seconds
+        with self._lock:
+            # Inserts a new claim or renews an expired one; a live claim changes nothing
+            cursor = self._connection.execute(
+                "INSERT INTO tweet_ledger (digest, claimed_at) VALUES (?, ?)"
+                " ON CONFLICT (digest) DO UPDATE SET claimed_at = excluded.claimed_at"
+                " WHERE tweet_ledger.claimed_at <= ?",
+                (_digest(key), now, cutoff))
+            claimed = cursor.rowcount == 1
+
+            self._claims_until_prune -= 1
+            if (self._claims_until_prune <= 0):
+                self._connection.execute("DELETE FROM tweet_ledger WHERE claimed_at <= ?", (cutoff,))
+                self._claims_until_prune = self._PRUNE_INTERVAL_CLAIMS
+        return claimed
+
+
+    def contains(self, key: str) -> bool:
+        """
+        Whether a tweet was claimed within the retention.
+
+        Parameters:
+            key (str): The idempotency key of the tweet
+
+        Returns:
+            bool: True when the tweet was claimed before
+        """
+
+        cutoff = int(self._clock()) - self._retention_seconds
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM tweet_ledger WHERE digest = ? AND claimed_at > ?",
+                (_digest(key), cutoff)).fetchone()
+        return row is not None
+
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -1,13 +1,35 @@
 import logging
+import threading
 
+from config import getConfig
 from envvarname import EnvVarName
-from tweepy import Client
-from util import getEnvVar, isEmpty
+from metrics import REGISTRY
+from outbox import Outbox, PermanentError, RetryableError, TokenBucket
+from typing import TYPE_CHECKING, Callable, Dict, Mapping, Tuple
+from util import initDataDir, isEmpty
+
+if TYPE_CHECKING:
+    # tweepy takes a while to import, so it is only imported once a tweet is published
+    from tweepy import Client
 
 
 class TwitterUtil(object):
 
     LOGGER = logging.getLogger()
+    _PUBLISH_SECONDS = REGISTRY.histogram("wxbot_tweet_publish_seconds", "Latency of publishing a tweet")
+    _PUBLISH_FAILURES = REGISTRY.counter("wxbot_tweet_publish_failures_total", "Tweets that failed to publish, by reason")
+    # Clients are kept per credential set so their HTTP sessions stay alive between tweets
+    _CLIENTS: Dict[Tuple[str, ...], "Client"] = {}
+    _CLIENTS_LOCK = threading.Lock()
+    _OUTBOX: Outbox = None
+    _LEDGER = None
+    _REDIRECT: Callable[[str], None] = None
+    _OUTBOX_DIR_NAME = "outbox"
+    _OUTBOX_CONCURRENCY = 2
+    # Twitter API v2 allows 200 tweets per user per 15 minute window
+    _RATE_LIMIT_BURST = 10
+    _RATE_LIMIT_PER_SECOND = 200 / 900
+    _API_URL = "https://api.twitter.com"
 
     def __init__(self):
         # Do not instantiate
@@ -15,52 +37,224 @@ class TwitterUtil(object):
 
 
     @staticmethod
-    def tweet(message: str) -> None:
+    def tweet(message: str, idempotencyKey: str = None) -> None:
+        """
+        Queue a message to be tweeted by the outbox, or tweet it right away when
+        the outbox has not been started.
+
+        Parameters:
+            message (str): The text of the tweet
+            idempotencyKey (str): (optional) Identifies the tweet, which is skipped when
+                the ledger shows it was tweeted before, and recorded in the ledger once it is
+        """
+
+        if (TwitterUtil._REDIRECT is not None):
+            TwitterUtil._REDIRECT(message)
+            return
+
+        if (idempotencyKey is not None and TwitterUtil._LEDGER is not None):
+            try:
+                if (TwitterUtil._LEDGER.contains(idempotencyKey)):
+                    TwitterUtil.LOGGER.warning("Skipping a tweet that was already sent: " + idempotencyKey)
+                    return
+            except Exception:
+                # A missing tweet is worse than a duplicate one
+                TwitterUtil.LOGGER.exception("Problem occurred while checking the tweet ledger, tweeting anyway")
+
+        if (TwitterUtil._OUTBOX is not None):
+            # The outbox records the key once the tweet is delivered
+            TwitterUtil._OUTBOX.enqueue(message, idempotencyKey)
+            return
+
         try:
-            api = TwitterUtil.createTwitterAPI()
-            api.create_tweet(text=message)
+            TwitterUtil.publish(message)
         except Exception:
             TwitterUtil.LOGGER.exception("Problem occurned while tweeting message")
+            return
+
+        if (idempotencyKey is not None and TwitterUtil._LEDGER is not None):
+            try:
+                TwitterUtil._LEDGER.claim(idempotencyKey)
+            except Exception:
+                TwitterUtil.LOGGER.exception("Problem occurred while recording a sent tweet: " + idempotencyKey)
+
+
+    @staticmethod
+    def redirect(receiver: Callable[[str], None]) -> None:
+        """
+        Hand every message to a receiver instead of tweeting it, e.g. while simulating.
+
+        Parameters:
+            receiver (callable): Receives each message, or None to tweet again
+        """
+
+        TwitterUtil._REDIRECT = receiver
+
+
+    @staticmethod
+    def useLedger(ledger) -> None:
+        """
+        Check the tweets that have an idempotency key against a ledger, so they
+        are sent only once.
+
+        Parameters:
+            ledger (FileTweetLedger | SQLiteTweetLedger): The ledger, or None to not check
+        """
+
+        TwitterUtil._LEDGER = ledger
+
+
+    @staticmethod
+    def startOutbox(concurrency: int = _OUTBOX_CONCURRENCY, subDirName: str = None) -> Outbox:
+        """
+        Start delivering tweets through a durable, rate-limited outbox.
+
+        Parameters:
+            concurrency (int): The number of tweets that may be in flight at once
+            subDirName (str): (optional) Keeps the journal in a directory of its own, e.g. per replica
+
+        Returns:
+            Outbox: The started outbox
+        """
+
+        bucket = TokenBucket(TwitterUtil._RATE_LIMIT_BURST, TwitterUtil._RATE_LIMIT_PER_SECOND)
+        outbox = Outbox(initDataDir(TwitterUtil._OUTBOX_DIR_NAME, subDirName), TwitterUtil.publish, concurrency, bucket,
+                        TwitterUtil._LEDGER)
+        outbox.start()
+        TwitterUtil._OUTBOX = outbox
+        return outbox
+
+
+    @staticmethod
+    def stopOutbox() -> None:
+        if (TwitterUtil._OUTBOX is not None):
+            TwitterUtil._OUTBOX.stop()
+
+
+    @staticmethod
+    def publish(message: str) -> Mapping[str, str]:
+        """
+        Tweet a message, translating failures into the errors the outbox understands.
+
+        Parameters:
+            message (str): The text of the tweet
+
+        Returns:
+            Mapping: The response headers, which carry the rate-limit state
+        """
+
+        import requests
+        from tweepy import HTTPException, TooManyRequests, TwitterServerError, Unauthorized
+
+        try:
+            api = TwitterUtil.getTwitterAPI()
+        except RuntimeError as e:
+            TwitterUtil._PUBLISH_FAILURES.inc({"reason": "no_credentials"})
+            raise PermanentError("Twitter API credentials are not configured") from e
+        try:
+            with TwitterUtil._PUBLISH_SECONDS.time():
+                response = api.create_tweet(text=message)
+        except TooManyRequests as e:
+            TwitterUtil._PUBLISH_FAILURES.inc({"reason": "rate_limited"})
+            reset = e.response.headers.get("x-rate-limit-reset")
+            raise RetryableError("Twitter API rate limit reached", float(reset) if reset else None) from e
+        except Unauthorized as e:
+            TwitterUtil._PUBLISH_FAILURES.inc({"reason": "unauthorized"})
+            # The credentials may be corrected, so rebuild the client and try again later
+            TwitterUtil.resetTwitterAPI()
+            raise RetryableError("Twitter API rejected the credentials") from e
+        except TwitterServerError as e:
+            TwitterUtil._PUBLISH_FAILURES.inc({"reason": "server_error"})
+            raise RetryableError("Twitter API server error") from e
+        except HTTPException as e:
+            TwitterUtil._PUBLISH_FAILURES.inc({"reason": "rejected"})
+            raise PermanentError("Twitter API rejected the tweet") from e
+        except requests.RequestException as e:
+            TwitterUtil._PUBLISH_FAILURES.inc({"reason": "unreachable"})
+            raise RetryableError("Unable to reach the Twitter API") from e
+
+        TwitterUtil.LOGGER.info("Tweet delivered")
+        return response.headers
+
+
+    @staticmethod
+    def getTwitterAPI() -> "Client":
+        """
+        Retrieve the shared Twitter API client for the configured credentials,
+        creating it when the credentials have not been seen before.
+
+        Returns:
+            Client: The cached Twitter API client
+        """
+
+        credentials = TwitterUtil._getCredentials()
+        with TwitterUtil._CLIENTS_LOCK:
+            client = TwitterUtil._CLIENTS.get(credentials)
+            if (client is None):
+                # Credentials have changed, so any previous clients are stale
+                TwitterUtil._closeClients()
+                client = TwitterUtil.createTwitterAPI(credentials)
+                TwitterUtil._CLIENTS[credentials] = client
+            return client
 
 
     @staticmethod
-    def createTwitterAPI() -> Client:
+    def resetTwitterAPI() -> None:
+        """
+        Discard all cached clients so the next tweet builds a new one.
+        """
+
+        with TwitterUtil._CLIENTS_LOCK:
+            TwitterUtil._closeClients()
+
+
+    @staticmethod
+    def createTwitterAPI(credentials: Tuple[str, ...] = None) -> "Client":
+        import requests
+        from tweepy import Client
+
         TwitterUtil.LOGGER.debug("Creating the Twitter API")
 
-        consumer_key = getEnvVar(EnvVarName.TWITTER_CONSUMER_KEY)
-        if (isEmpty(consumer_key)):
-            message = "Environment Variable " + EnvVarName.TWITTER_CONSUMER_KEY.name + " is not set"
-            TwitterUtil.LOGGER.error(message)
-            raise RuntimeError(message)
-
-        consumer_secret = getEnvVar(EnvVarName.TWITTER_CONSUMER_SECRET)
-        if (isEmpty(consumer_secret)):
-            message = "Environment Variable " + EnvVarName.TWITTER_CONSUMER_SECRET.name + " is not set"
-            TwitterUtil.LOGGER.error(message)
-            raise RuntimeError(message)
-
-        access_token = getEnvVar(EnvVarName.TWITTER_ACCESS_TOKEN)
-        if (isEmpty(access_token)):
-            message = "Environment Variable " + EnvVarName.TWITTER_ACCESS_TOKEN.name + " is not set"
-            TwitterUtil.LOGGER.error(message)
-            raise RuntimeError(message)
-
-        access_token_secret = getEnvVar(EnvVarName.TWITTER_ACCESS_TOKEN_SECRET)
-        if (isEmpty(access_token_secret)):
-            message = "Environment Variable " + EnvVarName.TWITTER_ACCESS_TOKEN_SECRET.name + " is not set"
-            TwitterUtil.LOGGER.error(message)
-            raise RuntimeError(message)
-        
-        bearer_token = getEnvVar(EnvVarName.TWITTER_BEARER_TOKEN)
-        if (isEmpty(bearer_token)):
-            message = "Environment Variable " + EnvVarName.TWITTER_BEARER_TOKEN.name + " is not set"
-            TwitterUtil.LOGGER.error(message)
-            raise RuntimeError(message)
+        if (credentials is None):
+            credentials = TwitterUtil._getCredentials()
+        consumer_key, consumer_secret, access_token, access_token_secret, bearer_token = credentials
 
         client = Client(consumer_key=consumer_key,
                         consumer_secret=consumer_secret,
                         access_token=access_token,
                         access_token_secret=access_token_secret,
-                        bearer_token=bearer_token)
+                        bearer_token=bearer_token,
+                        return_type=requests.Response)
+
+        api_url = getConfig().twitterApiUrl
+        if (not isEmpty(api_url)):
+            from hostredirect import HostRedirectAdapter
+            # tweepy always calls the real host, so its requests are redirected below it
+            client.session.mount(TwitterUtil._API_URL, HostRedirectAdapter(TwitterUtil._API_URL, api_url))
+            TwitterUtil.LOGGER.info("Sending Twitter API requests to " + api_url)
         TwitterUtil.LOGGER.info("Twitter API created successfully")
         return client
+
+
+    @staticmethod
+    def _getCredentials() -> Tuple[str, ...]:
+        # Read from the current configuration every time, so a reload can replace them
+        credentials = getConfig().twitterCredentials
+        for name, value in zip((EnvVarName.TWITTER_CONSUMER_KEY,
+                                EnvVarName.TWITTER_CONSUMER_SECRET,
+                                EnvVarName.TWITTER_ACCESS_TOKEN,
+                                EnvVarName.TWITTER_ACCESS_TOKEN_SECRET,
+                                EnvVarName.TWITTER_BEARER_TOKEN), credentials):
+            if (isEmpty(value)):
+                message = "Environment Variable " + name.name + " is not set"
+                TwitterUtil.LOGGER.error(message)
+                raise RuntimeError(message)
+
+        return credentials
+
+
+    @staticmethod
+    def _closeClients() -> None:
+        for client in TwitterUtil._CLIENTS.values():
+            client.session.close()
+        TwitterUtil._CLIENTS.clear()
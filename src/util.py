@@ -2,19 +2,37 @@ import os
 
 from const import APP_ROOT_DEFAULT
 from datetime import datetime, MINYEAR, MAXYEAR
-from dotenv import load_dotenv
+from dotenv import dotenv_values
 from envvarname import EnvVarName
 from pathlib import Path
 from pytz import timezone
 
 
 globalAppRootDir = APP_ROOT_DEFAULT
+# Variables set by the environment of the process always win over the .env file
+globalProcessEnvVarNames = frozenset(os.environ)
+globalDotEnvVarNames = set()
 
 
 def loadEnvVars(appRootDir: Path) -> None:
+    """
+    Load the .env file of the application root directory into the environment.
+    Loading it again applies the changes made to the file since, including
+    variables that were removed from it.
+
+    Parameters:
+        appRootDir (Path): The application root directory
+    """
+
     global globalAppRootDir
     globalAppRootDir = appRootDir
-    load_dotenv(Path.joinpath(appRootDir, ".env"))
+    values = {name: value for name, value in dotenv_values(Path.joinpath(appRootDir, ".env")).items()
+              if name not in globalProcessEnvVarNames and value is not None}
+    for name in globalDotEnvVarNames - values.keys():
+        os.environ.pop(name, None)
+    os.environ.update(values)
+    globalDotEnvVarNames.clear()
+    globalDotEnvVarNames.update(values.keys())
 
 
 def getEnvVar(name: EnvVarName) -> str:
@@ -36,6 +54,10 @@ def isEmpty(value: str) -> bool:
     return value == "" or value is None
 
 
+def isTruthy(value: str) -> bool:
+    return not isEmpty(value) and value.strip().lower() in ("1", "true", "yes", "on")
+
+
 def decToDegMinSec(dd: float) -> tuple:
     """
     Converts decimal degrees to deg/min/sec.
@@ -56,9 +78,19 @@ def decToDegMinSec(dd: float) -> tuple:
     return (round(degrees),round(minutes),round(seconds))
 
 
-def initDataDir(dirName: str) -> Path:
+def getAppRootDir() -> Path:
+    return globalAppRootDir
+
+
+def getDataDir(dirName: str, subDirName: str = None) -> Path:
     dataDir = Path.joinpath(globalAppRootDir, "data", dirName)
+    if not isEmpty(subDirName):
+        dataDir = Path.joinpath(dataDir, subDirName)
+    return dataDir
+
 
+def initDataDir(dirName: str, subDirName: str = None) -> Path:
+    dataDir = getDataDir(dirName, subDirName)
     if not(os.path.exists(dataDir)):
         os.makedirs(dataDir, exist_ok=True)
 
@@ -69,14 +101,6 @@ def getLogDir() -> Path:
     return Path.joinpath(globalAppRootDir, "log")
 
 
-def generateHashtag() -> str:
-    hashtag = getEnvVar(EnvVarName.TWITTER_HASHTAG)
-    if (isEmpty(hashtag)):
-        return ""
-
-    return " #" + hashtag
-
-
 def tupleToDateTime(dtTuple: tuple, tzone: timezone) -> datetime:
     """
     Converts a given typle representation of a datetime into a datatime object.
@@ -0,0 +1,6 @@
+import sys
+
+from pathlib import Path
+
+# The modules of the application import each other by their plain names
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("src")))
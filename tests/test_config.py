@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+import util
+
+from config import getConfig, loadConfig, setConfig
+from pathlib import Path
+
+
+_ENV = {
+    "ENABLED_TASKS": "solartime,lunartime",
+    "LOCATION": "Chicago",
+    "REGION": "Illinois",
+    "TIMEZONE": "America/Chicago",
+    "LATITUDE": "41.88",
+    "LONGITUDE": "-87.63",
+    "TWITTER_HASHTAG": "wxbot",
+    "LOG_BACKUP_COUNT": "7",
+}
+
+
+class ConfigReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self._appRootDir = tempfile.TemporaryDirectory()
+        self._emptyDir = tempfile.TemporaryDirectory()
+        self._previousAppRootDir = util.getAppRootDir()
+        self._previousConfig = getConfig()
+
+
+    def tearDown(self):
+        # Loading a directory without a .env file removes the variables the test loaded
+        util.loadEnvVars(Path(self._emptyDir.name))
+        util.globalAppRootDir = self._previousAppRootDir
+        setConfig(self._previousConfig)
+        self._appRootDir.cleanup()
+        self._emptyDir.cleanup()
+
+
+    def writeEnv(self, values: dict) -> Path:
+        appRootDir = Path(self._appRootDir.name)
+        with open(Path.joinpath(appRootDir, ".env"), "w") as file:
+            for name, value in values.items():
+                file.write("{}={}\n".format(name, value))
+        return appRootDir
+
+
+    def testLoadsTheEnvFile(self):
+        util.loadEnvVars(self.writeEnv(_ENV))
+        config = loadConfig()
+
+        self.assertEqual(config.enabledTasks, ("solartime", "lunartime"))
+        self.assertEqual([location.name for location in config.locations], ["Chicago"])
+        self.assertEqual(config.formatHashtag(), " #wxbot")
+        self.assertEqual(config.logBackupCount, 7)
+
+
+    def testReloadAppliesTheChangedFile(self):
+        appRootDir = self.writeEnv(_ENV)
+        util.loadEnvVars(appRootDir)
+        before = loadConfig()
+
+        values = dict(_ENV, TWITTER_HASHTAG="weather", SCHEDULER_WORKERS="4")
+        del values["LOG_BACKUP_COUNT"]
+        util.loadEnvVars(self.writeEnv(values))
+        after = loadConfig()
+
+        self.assertNotIn("LOG_BACKUP_COUNT", os.environ)
+        self.assertEqual(after.formatHashtag(), " #weather")
+        self.assertEqual(after.logBackupCount, 5)
+        self.assertEqual(after.schedulerWorkers, 4)
+        self.assertEqual(before.getRestartRequiredChanges(after), ["schedulerWorkers", "logBackupCount"])
+
+
+    def testReloadOfReloadableSettingsNeedsNoRestart(self):
+        util.loadEnvVars(self.writeEnv(_ENV))
+        before = loadConfig()
+
+        util.loadEnvVars(self.writeEnv(dict(_ENV, TWITTER_HASHTAG="", LATITUDE="41.9")))
+        after = loadConfig()
+
+        self.assertEqual(after.formatHashtag(), "")
+        self.assertEqual(after.locations[0].latitude, 41.9)
+        self.assertEqual(before.getRestartRequiredChanges(after), [])
@@ -0,0 +1,77 @@
+import tempfile
+import unittest
+import util
+
+from cache import TTLCache
+from clock import VirtualClock
+from config import Config, setConfig
+from datetime import datetime
+from eventplan import EventPlanner
+from location import Location
+from pathlib import Path
+from scheduler import VirtualScheduler
+from solartable import SolarTimeTable
+from statestore import MemoryStateBackend, StateStore
+from tasks.lunartime import LunarTimeTask
+from unittest import mock
+
+
+# More locations than the tasks a virtual scheduler would once run at a single instant
+LOCATIONS = [Location("plan-{}".format(i), "Plan {}".format(i), "Illinois", "America/Chicago", 25.0 + i * 0.4, -120.0 + i * 0.8)
+             for i in range(60)]
+PLANNED_AT = datetime(2023, 6, 1, 21, 30).timestamp()
+
+
+class EventPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._app_root_dir = util.globalAppRootDir
+        util.globalAppRootDir = Path(self._temp_dir.name)
+        self._config = setConfig(Config())
+        self._cache = LunarTimeTask._EPHEMERIS_CACHE
+        LunarTimeTask._EPHEMERIS_CACHE = TTLCache(4096)
+
+
+    def tearDown(self):
+        LunarTimeTask._EPHEMERIS_CACHE = self._cache
+        setConfig(self._config)
+        util.globalAppRootDir = self._app_root_dir
+        self._temp_dir.cleanup()
+
+
+    def createPlanner(self, solarTable: SolarTimeTable = None) -> EventPlanner:
+        return EventPlanner(VirtualScheduler(VirtualClock(PLANNED_AT)),
+                            StateStore(backend=MemoryStateBackend()),
+                            lambda: LOCATIONS,
+                            solarTable=solarTable)
+
+
+    def testEveryLocationIsPlanned(self):
+        tweets = self.createPlanner(SolarTimeTable(LOCATIONS))._plan(LOCATIONS, PLANNED_AT)
+
+        # Every location sees a sunrise and a moonrise within two days
+        for task_name in EventPlanner.TASK_NAMES:
+            planned = set(tweet.locationKey for tweet in tweets if tweet.taskName == task_name)
+            self.assertEqual([location.key for location in LOCATIONS if location.key not in planned], [], task_name)
+
+
+    def testBatchedEphemeridesPlanTheSameTweets(self):
+        with mock.patch.object(LunarTimeTask, "prefetchMoonTimes"):
+            expected = self.createPlanner(SolarTimeTable(LOCATIONS))._plan(LOCATIONS, PLANNED_AT)
+        LunarTimeTask._EPHEMERIS_CACHE = TTLCache(4096)
+
+        # Without a solar table, the planner computes one for all the locations
+        tweets = self.createPlanner()._plan(LOCATIONS, PLANNED_AT)
+
+        self.assertEqual(tweets, expected)
+
+
+    def testMoonTimesAreComputedBeforeTheTasksRun(self):
+        planner = self.createPlanner(SolarTimeTable(LOCATIONS))
+        planner._computeEphemerides(LOCATIONS, PLANNED_AT)
+
+        with mock.patch("tasks.lunartime.MoonInfo.rise_set_times") as rise_set_times:
+            planner._plan(LOCATIONS, PLANNED_AT)
+
+        rise_set_times.assert_not_called()
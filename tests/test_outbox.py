@@ -0,0 +1,150 @@
+import json
+import tempfile
+import threading
+import unittest
+
+from outbox import Outbox, PermanentError, TokenBucket
+from pathlib import Path
+
+
+class FakeLedger(object):
+
+    def __init__(self, keys=()):
+        self.keys = set(keys)
+
+
+    def contains(self, key: str) -> bool:
+        return key in self.keys
+
+
+    def claim(self, key: str) -> bool:
+        if (key in self.keys):
+            return False
+        self.keys.add(key)
+        return True
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._data_dir = Path(self._temp_dir.name)
+        self._journal_path = self._data_dir.joinpath("outbox.journal")
+        self._delivered = list()
+        self._done = threading.Event()
+        self._outbox = None
+
+
+    def tearDown(self):
+        if (self._outbox is not None):
+            self._outbox.stop()
+        self._temp_dir.cleanup()
+
+
+    def publish(self, message: str):
+        self._delivered.append(message)
+        if (message == "last"):
+            self._done.set()
+        return None
+
+
+    def writeJournal(self, lines):
+        with open(self._journal_path, "w") as fw:
+            fw.write("".join(lines))
+
+
+    def startOutbox(self, ledger=None, publisher=None) -> Outbox:
+        self._outbox = Outbox(self._data_dir, publisher or self.publish, 1, TokenBucket(100, 100), ledger)
+        self._outbox.start()
+        return self._outbox
+
+
+    def readJournal(self):
+        with open(self._journal_path, "r") as fp:
+            return [json.loads(line) for line in fp]
+
+
+    def testRecoversTheMessagesThatWereNotAcknowledged(self):
+        self.writeJournal([
+            json.dumps({"op": "put", "id": "a", "text": "sent", "created": 1}) + "\n",
+            json.dumps({"op": "put", "id": "b", "key": "k/b", "text": "pending", "created": 2}) + "\n",
+            json.dumps({"op": "ack", "id": "a"}) + "\n",
+            json.dumps({"op": "put", "id": "c", "text": "dropped", "created": 3}) + "\n",
+            json.dumps({"op": "drop", "id": "c"}) + "\n",
+            # A torn final line from an interrupted write
+            '{"op": "put", "id": "d", "te'
+        ])
+
+        outbox = Outbox(self._data_dir, self.publish, 1, TokenBucket(100, 100))
+        pending = outbox._recoverJournal()
+
+        self.assertEqual([(entry["id"], entry["key"], entry["text"]) for entry in pending], [("b", "k/b", "pending")])
+        self.assertEqual([record["id"] for record in self.readJournal()], ["b"])
+
+
+    def testDeliversRecoveredMessagesInOrder(self):
+        self.writeJournal([
+            json.dumps({"op": "put", "id": "a", "text": "first", "created": 1}) + "\n",
+            json.dumps({"op": "put", "id": "b", "text": "last", "created": 2}) + "\n"
+        ])
+
+        self.startOutbox()
+
+        self.assertTrue(self._done.wait(5))
+        self.assertEqual(self._delivered, ["first", "last"])
+
+
+    def testSkipsRecoveredMessagesTheLedgerShowsWereDelivered(self):
+        self.writeJournal([
+            json.dumps({"op": "put", "id": "a", "key": "k/a", "text": "delivered", "created": 1}) + "\n",
+            json.dumps({"op": "put", "id": "b", "key": "k/b", "text": "last", "created": 2}) + "\n"
+        ])
+        ledger = FakeLedger(["k/a"])
+
+        self.startOutbox(ledger)
+
+        self.assertTrue(self._done.wait(5))
+        self.assertEqual(self._delivered, ["last"])
+        self.assertIn("k/b", ledger.keys)
+
+
+    def testRecordsTheKeyOnceDelivered(self):
+        ledger = FakeLedger()
+        outbox = self.startOutbox(ledger)
+
+        outbox.enqueue("last", "k/a")
+
+        self.assertTrue(self._done.wait(5))
+        outbox.stop()
+        self.assertEqual(ledger.keys, {"k/a"})
+        self.assertEqual([record["op"] for record in self.readJournal()], ["put", "ack"])
+        self.assertEqual(self.readJournal()[0]["key"], "k/a")
+
+
+    def testDoesNotQueueAKeyThatIsStillQueued(self):
+        outbox = Outbox(self._data_dir, self.publish, 1, TokenBucket(100, 100))
+        outbox._journal = open(self._journal_path, "a")
+        try:
+            first = outbox.enqueue("message", "k/a")
+            second = outbox.enqueue("message", "k/a")
+        finally:
+            outbox._journal.close()
+
+        self.assertEqual(first, second)
+        self.assertEqual(outbox.pending(), 1)
+
+
+    def testDropsARejectedMessage(self):
+        def publish(message: str):
+            if (message == "rejected"):
+                raise PermanentError("rejected")
+            return self.publish(message)
+
+        outbox = self.startOutbox(publisher=publish)
+        outbox.enqueue("rejected")
+        outbox.enqueue("last")
+
+        self.assertTrue(self._done.wait(5))
+        outbox.stop()
+        self.assertCountEqual([record["op"] for record in self.readJournal()], ["put", "put", "drop", "ack"])
+        self.assertEqual(Outbox(self._data_dir, self.publish, 1, TokenBucket(100, 100))._recoverJournal(), [])
@@ -0,0 +1,120 @@
+import threading
+import unittest
+
+from clock import VirtualClock
+from metrics import REGISTRY
+from scheduler import ScheduledJob, Scheduler, VirtualScheduler
+from unittest import mock
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        # One worker runs the steps one after the other, in the order they fall due
+        self._scheduler = Scheduler(workers=1)
+        self._ran = list()
+        self._lock = threading.Lock()
+
+
+    def tearDown(self):
+        self._scheduler.stop()
+
+
+    def createStep(self, name: str, done: threading.Event = None, delays=()):
+        delays = list(delays)
+
+        def step():
+            with self._lock:
+                self._ran.append(name)
+            if (done is not None):
+                done.set()
+            return delays.pop(0) if delays else None
+        return step
+
+
+    def testRunsTheJobsInTheOrderTheyFallDue(self):
+        done = threading.Event()
+        self._scheduler.schedule("last", self.createStep("last", done), 0.3)
+        self._scheduler.schedule("first", self.createStep("first"), 0.1)
+        self._scheduler.schedule("second", self.createStep("second"), 0.2)
+        self._scheduler.start()
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self._ran, ["first", "second", "last"])
+
+
+    def testRepeatsAJobUntilItsStepReturnsNone(self):
+        done = threading.Event()
+        self._scheduler.schedule("repeat", self.createStep("repeat", delays=(0.05, 0.05)), 0)
+        self._scheduler.schedule("last", self.createStep("last", done), 0.5)
+        self._scheduler.start()
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self._ran, ["repeat", "repeat", "repeat", "last"])
+        self.assertEqual(self._scheduler.jobs(), [])
+
+
+    def testCancelledJobDoesNotRun(self):
+        done = threading.Event()
+        job = self._scheduler.schedule("cancelled", self.createStep("cancelled"), 0.1, {"location": "cancelled"})
+        self._scheduler.schedule("last", self.createStep("last", done), 0.3)
+        self._scheduler.cancel(job)
+        self._scheduler.start()
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self._ran, ["last"])
+        self.assertTrue(job.cancelled)
+        self.assertNotIn('location="cancelled"', REGISTRY.render())
+
+
+    def testRetriesAFailedStepAfterABackoff(self):
+        done = threading.Event()
+        failures = list()
+
+        def step():
+            failures.append(len(failures))
+            if (len(failures) < 3):
+                raise ValueError("failed")
+            done.set()
+            return None
+
+        with mock.patch.object(ScheduledJob, "_RETRY_BASE_SECONDS", 0.01):
+            self._scheduler.schedule("failing", step)
+            self._scheduler.start()
+            self.assertTrue(done.wait(5))
+        self.assertEqual(len(failures), 3)
+
+
+class ScheduledJobTest(unittest.TestCase):
+
+    def testRetryBackoffDoublesUpToAnHour(self):
+        job = ScheduledJob("job", lambda: None)
+        seconds = list()
+        for failures in range(1, 9):
+            job.failures = failures
+            seconds.append(job.getRetrySeconds())
+
+        self.assertEqual(seconds, [60, 120, 240, 480, 960, 1920, 3600, 3600])
+
+
+class VirtualSchedulerTest(unittest.TestCase):
+
+    def testRunsTheStepsAtTheirVirtualTimes(self):
+        clock = VirtualClock(1000)
+        scheduler = VirtualScheduler(clock)
+        ran = list()
+
+        def step(name: str, delaySeconds: float):
+            def run():
+                ran.append((name, clock.time()))
+                return delaySeconds
+            return run
+
+        scheduler.schedule("hourly", step("hourly", 3600))
+        cancelled = scheduler.schedule("cancelled", step("cancelled", 60), 60)
+        scheduler.schedule("once", step("once", None), 1800)
+        scheduler.cancel(cancelled)
+
+        self.assertEqual(scheduler.runUntil(1000 + 2 * 3600), 3)
+        self.assertEqual(ran, [("hourly", 1000), ("once", 2800), ("hourly", 4600)])
+        self.assertEqual(clock.time(), 1000 + 2 * 3600)
@@ -0,0 +1,74 @@
+import unittest
+
+from astral import LocationInfo
+from astral.sun import noon, sun, sunrise, sunset
+from datetime import date, timedelta
+from location import Location
+from solartable import SolarTimeTable
+
+
+CHICAGO = Location("chicago", "Chicago", "Illinois", "America/Chicago", 41.88, -87.63)
+SYDNEY = Location("sydney", "Sydney", "New South Wales", "Australia/Sydney", -33.87, 151.21)
+TROMSO = Location("tromso", "Tromso", "Norway", "Europe/Oslo", 69.65, 18.96)
+MCMURDO = Location("mcmurdo", "McMurdo", "Antarctica", "Antarctica/McMurdo", -77.85, 166.67)
+LOCATIONS = [CHICAGO, SYDNEY, TROMSO, MCMURDO]
+DAYS = [date(2023, 1, 1) + timedelta(days=i) for i in range(365)]
+
+
+def getObserver(location: Location):
+    return LocationInfo(location.name, location.region, location.getTimeZone(), location.latitude, location.longitude).observer
+
+
+class SolarTimeTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self._table = SolarTimeTable(LOCATIONS)
+
+
+    def testMatchesAstral(self):
+        for location in (CHICAGO, SYDNEY):
+            tzone = location.getTimeZone()
+            for day in DAYS:
+                expected = sun(getObserver(location), date=day, tzinfo=tzone)
+                actual = self._table.lookup(location, day)
+                for event in SolarTimeTable.EVENTS:
+                    self.assertEqual(actual[event], expected[event], "{} {} {}".format(location.key, day, event))
+                    self.assertEqual(actual[event].utcoffset(), expected[event].utcoffset())
+
+
+    def testRaisesWhereTheSunDoesNotRiseOrSet(self):
+        # Midnight sun and polar night
+        for location, day in ((TROMSO, date(2023, 6, 21)), (TROMSO, date(2023, 12, 21)),
+                              (MCMURDO, date(2023, 6, 21)), (MCMURDO, date(2023, 12, 21))):
+            with self.assertRaises(ValueError):
+                sunrise(getObserver(location), date=day, tzinfo=location.getTimeZone())
+            with self.assertRaises(ValueError):
+                self._table.lookup(location, day)
+
+
+    def testGivesTheTimesAstralSunRefusesForMissingTwilight(self):
+        # sun() also needs dawn and dusk, which do not occur on the nights around the midnight sun
+        for location in (TROMSO, MCMURDO):
+            observer = getObserver(location)
+            tzone = location.getTimeZone()
+            days = list()
+            for day in DAYS:
+                try:
+                    sun(observer, date=day, tzinfo=tzone)
+                    continue
+                except ValueError:
+                    pass
+                try:
+                    expected = {"sunrise": sunrise(observer, day, tzone), "noon": noon(observer, day, tzone), "sunset": sunset(observer, day, tzone)}
+                except ValueError:
+                    continue
+                days.append(day)
+                self.assertEqual(self._table.lookup(location, day), expected, "{} {}".format(location.key, day))
+            self.assertTrue(days, location.key)
+
+
+    def testComputesEachYearOnce(self):
+        first = self._table.getYear(2023)
+
+        self.assertIs(self._table.getYear(2023), first)
+        self.assertEqual(first.shape, (len(SolarTimeTable.EVENTS), len(LOCATIONS), 365))
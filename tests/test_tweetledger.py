@@ -0,0 +1,70 @@
+import tempfile
+import unittest
+
+from pathlib import Path
+from tweetledger import FileTweetLedger, SQLiteTweetLedger, createTweetKey
+
+
+class FileTweetLedgerTest(unittest.TestCase):
+
+    _RETENTION_SECONDS = 3600
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._now = 1000000.0
+        self._ledgers = list()
+
+
+    def tearDown(self):
+        for ledger in self._ledgers:
+            ledger.close()
+        self._temp_dir.cleanup()
+
+
+    def createLedger(self):
+        ledger = FileTweetLedger(Path(self._temp_dir.name), self._RETENTION_SECONDS, lambda: self._now)
+        self._ledgers.append(ledger)
+        return ledger
+
+
+    def testClaimsAKeyOnce(self):
+        ledger = self.createLedger()
+        key = createTweetKey("solartime", "chicago", "2023-06-01")
+
+        self.assertFalse(ledger.contains(key))
+        self.assertTrue(ledger.claim(key))
+        self.assertTrue(ledger.contains(key))
+        self.assertFalse(ledger.claim(key))
+        self.assertFalse(ledger.contains(createTweetKey("solartime", "chicago", "2023-06-02")))
+
+
+    def testClaimsAreSharedAndKept(self):
+        key = createTweetKey("lunartime", "chicago", "2023-06-01")
+        self.assertTrue(self.createLedger().claim(key))
+
+        # Another replica, or this one after a restart
+        other = self.createLedger()
+
+        self.assertTrue(other.contains(key))
+        self.assertFalse(other.claim(key))
+
+
+    def testClaimsExpireAfterTheRetention(self):
+        ledger = self.createLedger()
+        key = createTweetKey("airquality", "chicago", "2023-06-01T10")
+        ledger.claim(key)
+
+        self._now += self._RETENTION_SECONDS - 1
+        self.assertTrue(ledger.contains(key))
+        self._now += 1
+        self.assertFalse(ledger.contains(key))
+        self.assertTrue(ledger.claim(key))
+        self.assertTrue(ledger.contains(key))
+
+
+class SQLiteTweetLedgerTest(FileTweetLedgerTest):
+
+    def createLedger(self):
+        ledger = SQLiteTweetLedger(Path(self._temp_dir.name).joinpath("state.sqlite3"), self._RETENTION_SECONDS, lambda: self._now)
+        self._ledgers.append(ledger)
+        return ledger